@@ -0,0 +1,277 @@
+"""
+Load generator and latency benchmark of the sandbox server.
+
+Boots the server (`serve.py`) against a synthetic repository, drives
+`/run_code` at a given concurrency and reports the latency percentiles, the
+throughput and the mean duration of the evaluation stages (from `/metrics`):
+
+  python benchmarks/benchmark.py --files 1000 --depth 3 --eval-time 0.05 \\
+    --concurrency 8 --requests 200
+
+It runs offline. The server is configured from the environment as usual (e.g.
+`OVERLAY_BACKEND`, `WORKSPACE_POOL_SIZE`, `WORKER_POOL_SIZE`, `SERVER_MODE`),
+so configurations can be compared by running it once for each.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+# The sandbox server, run from the sources.
+LIBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "hive_cli", "libs")
+
+# Subdirectories per directory of the synthetic repository.
+FANOUT = 8
+
+_STAGE_SAMPLE = re.compile(r'^sandbox_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+EVALUATOR = """\
+import json
+import time
+
+from lib import f
+
+time.sleep({eval_time})
+print(json.dumps({{"score": f()}}))
+"""
+
+
+def module_path(index: int, depth: int) -> str:
+    """Path of the `index`-th module of the synthetic repository."""
+    dirs = [f"d{(index // FANOUT**level) % FANOUT}" for level in range(depth)]
+    return os.path.join(*dirs, f"m{index}.py")
+
+
+def make_repo(path: str, files: int, depth: int, eval_time: float) -> None:
+    """
+    Write a synthetic repository of `files` modules spread over `depth` levels
+    of directories, with an evaluator that sleeps `eval_time` seconds.
+    """
+    for index in range(files):
+        module = os.path.join(path, module_path(index, depth))
+        os.makedirs(os.path.dirname(module), exist_ok=True)
+        with open(module, "w", encoding="utf-8") as f:
+            f.write(f"VALUE = {index}\n")
+    with open(os.path.join(path, "lib.py"), "w", encoding="utf-8") as f:
+        f.write("def f():\n  return 0\n")
+    with open(os.path.join(path, "evaluator.py"), "w", encoding="utf-8") as f:
+        f.write(EVALUATOR.format(eval_time=eval_time))
+
+
+def make_payload(index: int, files: int, depth: int, timeout: float) -> dict:
+    """
+    A distinct `/run_code` request (so that results are never cached), which
+    also overrides a module deep in the repository when there is one.
+    """
+    code = {"lib.py": f"def f():\n  return {index}\n"}
+    if files:
+        code[module_path(index % files, depth)] = f"VALUE = -{index}\n"
+    return {"code": code, "timeout": timeout}
+
+
+def percentile(values: list[float], q: float) -> float:
+    """The nearest-rank `q`-th percentile of `values`."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(repo_dir: str, work_dir: str, port: int) -> subprocess.Popen:
+    """Start the sandbox server on `port`, logging to `work_dir`/server.log."""
+    env = {
+        **os.environ,
+        "REPO_DIR": repo_dir,
+        "PORT": str(port),
+        "WARMUP": os.getenv("WARMUP", "compile"),
+    }
+    with open(os.path.join(work_dir, "server.log"), "wb") as log:
+        return subprocess.Popen(
+            [sys.executable, os.path.join(LIBS_DIR, "serve.py")],
+            cwd=work_dir,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}.")
+        try:
+            with urllib.request.urlopen(f"{url}/ready", timeout=5):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    raise RuntimeError(f"The server was not ready after {timeout} seconds.")
+
+
+def post(url: str, payload: dict, timeout: float) -> tuple[float, int]:
+    """POST `payload` to `url`, returning the latency and the status code."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.monotonic() - start, status
+
+
+def scrape_stages(url: str) -> dict[str, list[float]]:
+    """The [total seconds, count] of every stage in the server metrics."""
+    with urllib.request.urlopen(f"{url}/metrics", timeout=10) as response:
+        text = response.read().decode("utf-8")
+    stages = {}
+    for line in text.splitlines():
+        match = _STAGE_SAMPLE.match(line)
+        if match:
+            kind, stage, value = match.groups()
+            stages.setdefault(stage, [0.0, 0.0])[kind == "count"] += float(value)
+    return stages
+
+
+def drive(
+    url: str, payloads: list[dict], concurrency: int, timeout: float
+) -> list[tuple[float, int]]:
+    """Send `payloads` to `url` from `concurrency` clients."""
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lambda p: post(url, p, timeout), payloads))
+
+
+def run(
+    files: int = 100,
+    depth: int = 2,
+    eval_time: float = 0.0,
+    concurrency: int = 1,
+    requests: int = 50,
+    warmup_requests: int = 5,
+    timeout: float = 60,
+    ready_timeout: float = 120,
+) -> dict:
+    """Run the benchmark in a temporary directory and return its report."""
+    with tempfile.TemporaryDirectory(prefix="hive-benchmark-") as work_dir:
+        repo_dir = os.path.join(work_dir, "repo")
+        make_repo(repo_dir, files, depth, eval_time)
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        process = start_server(repo_dir, work_dir, port)
+        try:
+            try:
+                wait_until_ready(url, process, ready_timeout)
+            except RuntimeError:
+                with open(os.path.join(work_dir, "server.log"), encoding="utf-8") as f:
+                    sys.stderr.write(f.read()[-4000:])
+                raise
+
+            payloads = [
+                make_payload(index, files, depth, timeout)
+                for index in range(warmup_requests + requests)
+            ]
+            drive(f"{url}/run_code", payloads[:warmup_requests], concurrency, timeout)
+            before = scrape_stages(url)
+            start = time.monotonic()
+            results = drive(f"{url}/run_code", payloads[warmup_requests:], concurrency, timeout)
+            elapsed = time.monotonic() - start
+            after = scrape_stages(url)
+        finally:
+            stop_server(process)
+
+    latencies = [latency for latency, _ in results]
+    latency = {f"p{q}": percentile(latencies, q) for q in (50, 95, 99)}
+    latency["mean"] = sum(latencies) / len(latencies)
+    stages = {}
+    for stage, (total, count) in after.items():
+        total -= before.get(stage, [0.0, 0.0])[0]
+        count -= before.get(stage, [0.0, 0.0])[1]
+        if count:
+            stages[stage] = total / count
+    return {
+        "requests": len(results),
+        "errors": sum(status != 200 for _, status in results),
+        "concurrency": concurrency,
+        "throughput": len(results) / elapsed,
+        "latency": latency,
+        "stages": stages,
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['requests']} requests ({report['errors']} errors) from "
+        f"{report['concurrency']} clients: {report['throughput']:.1f} req/s",
+        "latency: "
+        + ", ".join(
+            f"{name} {seconds * 1000:.1f} ms" for name, seconds in report["latency"].items()
+        ),
+        "mean stage durations:",
+    ]
+    for stage, seconds in sorted(report["stages"].items()):
+        lines.append(f"  {stage:<12} {seconds * 1000:9.2f} ms")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=100, help="Modules in the repository.")
+    parser.add_argument("--depth", type=int, default=2, help="Directory levels of the modules.")
+    parser.add_argument(
+        "--eval-time",
+        type=float,
+        default=0.0,
+        help="Seconds each evaluation sleeps for.",
+    )
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument(
+        "--warmup-requests",
+        type=int,
+        default=5,
+        help="Requests sent before measuring.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args()
+
+    report = run(
+        args.files,
+        args.depth,
+        args.eval_time,
+        args.concurrency,
+        args.requests,
+        args.warmup_requests,
+    )
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
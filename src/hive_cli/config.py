@@ -35,6 +35,22 @@ class SandboxConfig(BaseModel):
         default=None,
         description="The pre-processing script to run before the experiment. Use the `/data` directory to load/store datasets.",
     )
+    platforms: Optional[list[str]] = Field(
+        default=None,
+        description="The platforms to build the sandbox image for, e.g. `linux/amd64`. Default to the architectures of the cluster nodes.",
+    )
+    build_context_warning_mb: Optional[int] = Field(
+        default=100,
+        description="Warn when a build context of the sandbox image is larger than this, in MB.",
+    )
+    build_context_limit_mb: Optional[int] = Field(
+        default=None,
+        description="Fail when a build context of the sandbox image is larger than this, in MB.",
+    )
+    build_cache: str = Field(
+        default="local",
+        description="Where the layers of the image builds are cached: 'local' (~/.hive/cache/buildkit), 'registry' (the `buildcache` tag of the image registry) or 'none'.",
+    )
 
 
 class RepoConfig(BaseModel):
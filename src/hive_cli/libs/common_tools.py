@@ -1,87 +1,443 @@
 """Common functionality across sandboxex."""
 
+import collections
+import contextlib
+import dataclasses
 import io
+import os
+import re
+import select
 import signal
 import subprocess
+import tempfile
 import threading
 import time
+import typing
 
 import psutil
 import requests
 
+import memory_limits
+
 GCR_SANDBOX_BUCKET = "hi-sandbox"
 
+# Number of characters of stdout and stderr kept per process (the head and the
+# tail of the output), and the directory the complete output of processes
+# exceeding it is spilled to, up to OUTPUT_SPILL_LIMIT characters.
+OUTPUT_LIMIT = int(os.getenv("OUTPUT_LIMIT", str(16 * 1024 * 1024)))
+OUTPUT_SPILL_DIR = os.getenv("OUTPUT_SPILL_DIR")
+OUTPUT_SPILL_LIMIT = int(os.getenv("OUTPUT_SPILL_LIMIT", str(1024**3)))
+# Seconds a spilled output is kept for if it is never fetched, see
+# `take_spill_file`.
+OUTPUT_SPILL_TTL = int(os.getenv("OUTPUT_SPILL_TTL", "600"))
+
+# Runs its arguments once a line is read from stdin, see `run_command`.
+HOLD_SCRIPT = 'read -r _ && exec "$@" </dev/null'
+
+# Maximum number of characters read at once, so that long lines do not have to
+# be buffered completely.
+READ_CHUNK_SIZE = 64 * 1024
+
+# Seconds the output readers get to drain the pipes once the processes holding
+# them were killed.
+READER_GRACE = 1
+
+
+# Names of the spill files, see `BoundedOutput`.
+SPILL_FILE_PATTERN = re.compile(r"(stdout|stderr)-\w+\.log")
+
+
+def remove_stale_spill_files(spill_dir: str) -> None:
+  """Delete the spill files of `spill_dir` older than OUTPUT_SPILL_TTL."""
+  cutoff = time.time() - OUTPUT_SPILL_TTL
+  with contextlib.suppress(FileNotFoundError):
+    for entry in os.scandir(spill_dir):
+      if SPILL_FILE_PATTERN.fullmatch(entry.name):
+        with contextlib.suppress(FileNotFoundError):
+          if entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+
+
+def take_spill_file(name: str) -> typing.IO[bytes] | None:
+  """
+  Open the spill file `name` of OUTPUT_SPILL_DIR, if there is one, and delete
+  it: a spilled output can be fetched once. The ones nobody fetches are
+  deleted after OUTPUT_SPILL_TTL seconds.
+  """
+  if not OUTPUT_SPILL_DIR or not SPILL_FILE_PATTERN.fullmatch(name):
+    return None
+  path = os.path.join(OUTPUT_SPILL_DIR, name)
+  try:
+    f = open(path, "rb")
+  except FileNotFoundError:
+    return None
+  with contextlib.suppress(FileNotFoundError):
+    os.remove(path)
+  return f
+
+
+class BoundedOutput:
+  """
+  Captures an output stream, keeping at most `limit` characters: the head and
+  the tail of the output, with the middle dropped. If `spill_dir` is set, the
+  complete output (up to `spill_limit` characters) is written to a file in it
+  once it exceeds the limit.
+
+  Safe to read with `getvalue` while a reader thread appends to it.
+  """
+
+  def __init__(
+    self,
+    limit: int | None = None,
+    spill_dir: str | None = None,
+    spill_limit: int | None = None,
+    name: str = "output",
+  ):
+    self.limit = limit
+    self.size = 0
+    self.spill_dir = spill_dir
+    self.spill_limit = spill_limit
+    self.spill_path = None
+    self._name = name
+    self._spill = None
+    self._head, self._head_size = [], 0
+    self._tail, self._tail_size = collections.deque(), 0
+    self._lock = threading.Lock()
+
+  @property
+  def truncated(self) -> bool:
+    return self.limit is not None and self.size > self.limit
+
+  def append(self, chunk: str) -> None:
+    with self._lock:
+      self._append(chunk)
+
+  def _append(self, chunk: str) -> None:
+    if (
+      self.spill_dir
+      and self._spill is None
+      and self.limit is not None
+      and self.size + len(chunk) > self.limit
+    ):
+      remove_stale_spill_files(self.spill_dir)
+      # Nothing was dropped yet, so the file starts with what we have.
+      fd, self.spill_path = tempfile.mkstemp(
+        prefix=f"{self._name}-", suffix=".log", dir=self.spill_dir
+      )
+      self._spill = os.fdopen(fd, "w")
+      self._spill.write("".join(self._head) + "".join(self._tail))
+    if self._spill is not None and not self._spill.closed:
+      if self.spill_limit is None or self.size < self.spill_limit:
+        self._spill.write(chunk)
+
+    self.size += len(chunk)
+    if self.limit is None:
+      self._head.append(chunk)
+      return
+
+    head_limit = self.limit // 2
+    if self._head_size < head_limit:
+      head = chunk[: head_limit - self._head_size]
+      self._head.append(head)
+      self._head_size += len(head)
+      chunk = chunk[len(head) :]
+    if not chunk:
+      return
+
+    tail_limit = self.limit - head_limit
+    self._tail.append(chunk)
+    self._tail_size += len(chunk)
+    while self._tail_size > tail_limit:
+      excess = self._tail_size - tail_limit
+      if len(self._tail[0]) <= excess:
+        self._tail_size -= len(self._tail.popleft())
+      else:
+        self._tail[0] = self._tail[0][excess:]
+        self._tail_size -= excess
+
+  def close(self) -> None:
+    with self._lock:
+      if self._spill is not None:
+        self._spill.close()
+
+  def discard(self) -> None:
+    """Close and delete the spill file, if any."""
+    self.close()
+    if self.spill_path is not None:
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(self.spill_path)
+      self.spill_path = None
+
+  def getvalue(self) -> str:
+    with self._lock:
+      head, tail = "".join(self._head), "".join(self._tail)
+    if not self.truncated:
+      return head + tail
+    dropped = self.size - len(head) - len(tail)
+    return f"{head}\n[... {dropped} characters truncated ...]\n{tail}"
+
 
 def read_stream(stream, output_list):
-  """Helper function to read stream line by line and store it in a list."""
+  """
+  Helper function to read stream chunk by chunk and store it in a list or a
+  `BoundedOutput`.
+  """
   try:
-    for line in iter(stream.readline, ""):
+    for line in iter(lambda: stream.readline(READ_CHUNK_SIZE), ""):
       output_list.append(line)
   except (io.UnsupportedOperation, UnicodeDecodeError) as e:
     output_list.append(f"[Error reading stream] {e}")
   finally:
     stream.close()
+    if isinstance(output_list, BoundedOutput):
+      output_list.close()
 
 
-def monitor_memory(proc, limit_mb, timeout=None, check_interval=1):
+def wait_readable(fd: int, timeout: float | None = None) -> bool:
+  """Wait up to `timeout` seconds for `fd` to become readable."""
+  poller = select.poll()
+  poller.register(fd, select.POLLIN)
+  return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+
+def _reap(proc) -> bool:
+  """Reap `proc` if it exited, recording its exit code and CPU time."""
+  try:
+    pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+  except ChildProcessError:  # Already reaped
+    return proc.poll() is not None
+  if pid == 0:
+    return False
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  proc.cpu_time = rusage.ru_utime + rusage.ru_stime
+  return True
+
+
+def wait_for_exit(proc, timeout: float | None = None) -> bool:
+  """
+  Wait up to `timeout` seconds for `proc` to exit and return whether it did.
+
+  Wakes up as soon as the process exits, through the `sentinel` file
+  descriptor of worker pool processes or a pidfd for subprocesses, instead of
+  polling.
+  """
+  if proc.returncode is not None:
+    return True
+
+  sentinel = getattr(proc, "sentinel", None)
+  if sentinel is not None:
+    wait_readable(sentinel, timeout)
+    return proc.poll() is not None
+
+  try:
+    pidfd = os.pidfd_open(proc.pid)
+  except (AttributeError, OSError):  # No pidfd support, let Popen poll
+    try:
+      proc.wait(timeout)
+      return True
+    except subprocess.TimeoutExpired:
+      return False
+  try:
+    wait_readable(pidfd, timeout)
+  finally:
+    os.close(pidfd)
+  return _reap(proc)
+
+
+def monitor_memory(
+  proc, limit_mb=None, timeout=None, check_interval=1, stats=None
+):
   """
   Monitors a subprocess's memory usage, captures stdout and stderr,
   and kills it if it exceeds `limit_mb`. Returns (stdout, stderr, exit_code).
+
+  Without `limit_mb` only the timeout is enforced. Returns as soon as the
+  process exits, memory is only sampled every `check_interval` seconds.
+  The captured output is bounded by OUTPUT_LIMIT, `stats` records whether it
+  was truncated.
   """
-  p = psutil.Process(proc.pid)
+  stdout_lines, stderr_lines = (
+    BoundedOutput(OUTPUT_LIMIT, OUTPUT_SPILL_DIR, OUTPUT_SPILL_LIMIT, name)
+    for name in ("stdout", "stderr")
+  )
 
-  stdout_lines, stderr_lines = [], []
+  def result(exit_code):
+    if stats is not None:
+      stats.stdout_truncated = stdout_lines.truncated
+      stats.stderr_truncated = stderr_lines.truncated
+      stats.stdout_file = stdout_lines.spill_path
+      stats.stderr_file = stderr_lines.spill_path
+    else:  # Nobody would know where to fetch the complete output from
+      stdout_lines.discard()
+      stderr_lines.discard()
+    return stdout_lines.getvalue(), stderr_lines.getvalue(), exit_code
 
   # Start non-blocking reading of stdout and stderr
   stdout_thread = threading.Thread(
-    target=read_stream, args=(proc.stdout, stdout_lines)
+    target=read_stream, args=(proc.stdout, stdout_lines), daemon=True
   )
   stderr_thread = threading.Thread(
-    target=read_stream, args=(proc.stderr, stderr_lines)
+    target=read_stream, args=(proc.stderr, stderr_lines), daemon=True
   )
   stdout_thread.start()
   stderr_thread.start()
 
-  start_time = time.time()
+  deadline = None if timeout is None else time.monotonic() + timeout
 
-  while proc.poll() is None:  # Process is still running
-    try:
-      mem_usage = p.memory_info().rss / (1024 * 1024)  # Convert to MB
-      if mem_usage > limit_mb:
-        proc.kill()
-        return (
-          "".join(stdout_lines),
-          "".join(stderr_lines),
-          -9,
-        )  # Indicate forced termination
-    except psutil.NoSuchProcess:
-      break  # Process is already terminated
+  while proc.returncode is None:  # Process is still running
+    if limit_mb:
+      try:
+        mem_usage = psutil.Process(proc.pid).memory_info().rss / (1024 * 1024)
+        if mem_usage > limit_mb:
+          kill_process_group(proc)
+          wait_for_exit(proc)
+          return result(-9)  # Indicate forced termination
+      except psutil.NoSuchProcess:
+        pass  # Process is already terminated
 
     # Check timeout
-    if timeout and (time.time() - start_time) > timeout:
+    remaining = None if deadline is None else deadline - time.monotonic()
+    if remaining is not None and remaining <= 0:
       print(f"Process timed out after {timeout} seconds. Killing...")
+      kill_process_group(proc)
+      wait_for_exit(proc)
+      return result(-1)  # Indicate timeout
+
+    if limit_mb:
+      # Wake up for the next memory sample, unless the process exits first.
+      remaining = (
+        check_interval if remaining is None else min(check_interval, remaining)
+      )
+    wait_for_exit(proc, remaining)
+
+  # Ensure threads finish reading. A background process left behind may still
+  # hold the pipes open, so this is bounded by the timeout too.
+  for thread in (stdout_thread, stderr_thread):
+    thread.join(
+      None if deadline is None else max(deadline - time.monotonic(), 0)
+    )
+  if stdout_thread.is_alive() or stderr_thread.is_alive():
+    print(f"Output still open after {timeout} seconds. Killing...")
+    # The readers close the pipes once the processes holding them are gone.
+    kill_process_group(proc)
+    stdout_thread.join(READER_GRACE)
+    stderr_thread.join(READER_GRACE)
+    return result(-1)  # Indicate timeout
+
+  return result(proc.wait())  # Return output and exit code
+
+
+@dataclasses.dataclass
+class ExecutionStats:
+  """Timing (in seconds) and output capture details of an evaluation process."""
+
+  # Taken to start the process, before `wall_time`.
+  spawn_time: float | None = None
+  # From the start of the process until it exited or was killed.
+  wall_time: float | None = None
+  # User plus system CPU time of the process, when it could be measured.
+  cpu_time: float | None = None
+  # Whether the middle of the output was dropped, see `BoundedOutput`.
+  stdout_truncated: bool = False
+  stderr_truncated: bool = False
+  # Files holding the complete output, if it was spilled.
+  stdout_file: str | None = None
+  stderr_file: str | None = None
+  # Whether the evaluation failed, with the partial result or checkpoint it
+  # left returned instead of the error.
+  fallback: bool = False
+
+
+class FunctionExecutionError(Exception):
+  """Exception raised when a function execution fails."""
+
+
+class ExecutionTimeoutError(FunctionExecutionError):
+  """Raised when the process was killed because it timed out."""
+
+
+class MemoryLimitError(FunctionExecutionError):
+  """Raised when the process was stopped for exceeding its memory limit."""
+
+
+class ProcessCrashedError(FunctionExecutionError):
+  """Raised when the process was killed by a signal not sent by the sandbox."""
+
+
+class EvaluationCancelledError(FunctionExecutionError):
+  """Raised when the evaluation was cancelled, see `Cancellation`."""
+
+
+def kill_process_group(proc) -> None:
+  """
+  Kill `proc` and the rest of its process group, including the background
+  processes it left behind after exiting. Evaluation processes lead their own
+  group, see `run_command` and the fork server.
+  """
+  with contextlib.suppress(ProcessLookupError, PermissionError):
+    os.killpg(proc.pid, signal.SIGKILL)
+  if proc.returncode is None:
+    with contextlib.suppress(ProcessLookupError):
       proc.kill()
-      return (
-        "".join(stdout_lines),
-        "".join(stderr_lines),
-        -1,
-      )  # Indicate timeout
 
-    time.sleep(check_interval)  # Reduce CPU overhead
 
-  # Ensure threads finish reading
-  stdout_thread.join()
-  stderr_thread.join()
+def kill_process_tree(pid: int) -> None:
+  """Kill the process `pid` and all its descendants."""
+  try:
+    parent = psutil.Process(pid)
+    processes = [parent] + parent.children(recursive=True)
+  except psutil.NoSuchProcess:
+    return
+  for process in processes:
+    with contextlib.suppress(psutil.NoSuchProcess):
+      process.kill()
 
-  return (
-    "".join(stdout_lines),
-    "".join(stderr_lines),
-    proc.wait(),
-  )  # Return output and exit code
 
+def _kill_evaluation(pid: int) -> None:
+  """
+  Kill the process group led by `pid`, like `kill_process_group`, so that
+  daemonized processes re-parented away from `pid` die as well. Falls back to
+  the process tree when `pid` does not lead a group.
+  """
+  try:
+    os.killpg(pid, signal.SIGKILL)
+  except (ProcessLookupError, PermissionError):
+    kill_process_tree(pid)
 
-class FunctionExecutionError(Exception):
-  """Exception raised when a function execution fails."""
+
+class Cancellation:
+  """
+  Lets other threads cancel an evaluation: kills the process group of the
+  process it is attached to, if any, and makes `wait_for_process` raise an
+  `EvaluationCancelledError`.
+  """
+
+  def __init__(self):
+    self.cancelled = False
+    # The working directory of the evaluation while it runs, for other threads
+    # to read its records from, see `result_channel`.
+    self.work_dir = None
+    self._pid = None
+    self._lock = threading.Lock()
+
+  def cancel(self) -> None:
+    with self._lock:
+      self.cancelled = True
+      if self._pid is not None:
+        _kill_evaluation(self._pid)
+
+  @contextlib.contextmanager
+  def attach(self, process):
+    """Attach to `process` for the duration of the `with` block."""
+    with self._lock:
+      if self.cancelled:
+        _kill_evaluation(process.pid)
+      self._pid = process.pid
+    try:
+      yield
+    finally:
+      with self._lock:
+        self._pid = None
 
 
 def error_code_to_string(sig: int) -> str:
@@ -96,44 +452,102 @@ def run_command(
   cwd: str = ".",
   timeout: float = 10.0,
   memory_limit: int | None = None,
+  stats: ExecutionStats | None = None,
+  cancellation: Cancellation | None = None,
+) -> str:
+  """
+  Run a command with timeout and return the output. Fills in `stats`, if
+  given, with the timing of the command.
+  """
+
+  with memory_limits.limit(memory_limit) as limit:
+    spawn_start = time.monotonic()
+    held = bool(limit.child_settings)
+    if held:
+      # The command is held in a shell until its limits are applied from
+      # here, as `preexec_fn` is unsafe in a threaded server.
+      release_fd, hold_fd = os.pipe()
+      cmd = ["sh", "-c", HOLD_SCRIPT, "hive-hold", *cmd]
+    try:
+      process = subprocess.Popen(
+        cmd,
+        stdin=release_fd if held else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        bufsize=1,  # Allows real-time output
+        start_new_session=True,  # Its own process group, see kill_process_group
+        universal_newlines=True,
+        text=True,
+      )
+    finally:
+      if held:
+        os.close(release_fd)
+    with process:
+      if held:
+        try:
+          limit.apply(process.pid)
+          os.write(hold_fd, b"\n")
+        except BaseException:
+          process.kill()
+          raise
+        finally:
+          os.close(hold_fd)
+      if stats is not None:
+        stats.spawn_time = time.monotonic() - spawn_start
+      return wait_for_process(
+        process, timeout, memory_limit, limit, stats, cancellation
+      )
+
+
+def wait_for_process(
+  process,
+  timeout: float = 10.0,
+  memory_limit: int | None = None,
+  limit: memory_limits.MemoryLimit | None = None,
+  stats: ExecutionStats | None = None,
+  cancellation: Cancellation | None = None,
 ) -> str:
-  """Run a command with timeout and return the output."""
-
-  with subprocess.Popen(
-    cmd,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE,
-    cwd=cwd,
-    bufsize=1,  # Allows real-time output
-    universal_newlines=True,
-    text=True,
-  ) as process:
-    if memory_limit:
+  """
+  Wait for a started process, enforcing the timeout and memory limit, and
+  return its stdout. Raises `FunctionExecutionError` on failure, or
+  `EvaluationCancelledError` if `cancellation` is cancelled meanwhile.
+
+  `process` only needs the `subprocess.Popen` interface used here, so the same
+  semantics apply to processes started by the worker pool. Unless `limit` is
+  enforced by the kernel, the memory usage is polled.
+  """
+  poll_limit = memory_limit if limit is None or limit.needs_polling else None
+  start_time = time.monotonic()
+  try:
+    with (
+      cancellation.attach(process)
+      if cancellation is not None
+      else contextlib.nullcontext()
+    ):
       stdout, stderr, exit_code = monitor_memory(
-        process, limit_mb=memory_limit, timeout=timeout
+        process, limit_mb=poll_limit, timeout=timeout, stats=stats
       )
-      match exit_code:
-        case -1:
-          raise FunctionExecutionError("Timeout")
-        case -9:
-          raise FunctionExecutionError("Memory limit exceeded")
-        case 0:
-          return stdout
-        case _:
-          if exit_code < 0:
-            raise FunctionExecutionError(error_code_to_string(-exit_code))
-          raise FunctionExecutionError(f"Error: {stderr}")
-    else:
-      try:
-        stdout, stderr = process.communicate(timeout=timeout)
-        if process.returncode < 0:
-          raise FunctionExecutionError(error_code_to_string(-exit_code))
-        if process.returncode != 0:
-          raise FunctionExecutionError(f"Error: {stderr}")
-        return stdout
-      except subprocess.TimeoutExpired as exc:
-        process.kill()
-        raise FunctionExecutionError("Timeout") from exc
+  finally:
+    if stats is not None:
+      stats.wall_time = time.monotonic() - start_time
+      stats.cpu_time = getattr(process, "cpu_time", None)
+
+  if cancellation is not None and cancellation.cancelled:
+    raise EvaluationCancelledError("Cancelled")
+  match exit_code:
+    case -1:
+      raise ExecutionTimeoutError("Timeout")
+    case -9 if poll_limit:
+      raise MemoryLimitError("Memory limit exceeded")
+    case _ if limit is not None and limit.exceeded(exit_code, stderr):
+      raise MemoryLimitError("Memory limit exceeded")
+    case 0:
+      return stdout
+    case _:
+      if exit_code < 0:
+        raise ProcessCrashedError(error_code_to_string(-exit_code))
+      raise FunctionExecutionError(f"Error: {stderr}")
 
 
 def wait_for_url(url: str, timeout: int = 300, interval: int = 1) -> bool:
@@ -0,0 +1,99 @@
+"""Tracking of in-flight evaluations, so that clients can cancel them."""
+
+import collections
+import contextlib
+import logging
+import select
+import socket
+import threading
+from collections.abc import Callable
+
+import common_tools
+
+# How often a client connection is checked for a disconnect, in seconds.
+DISCONNECT_CHECK_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class EvaluationRegistry:
+  """
+  The cancellations of in-flight evaluations by ID. An evaluation may be
+  registered under several IDs (e.g. its own and the one of its batch), and
+  several evaluations under the same ID.
+  """
+
+  def __init__(self):
+    self._evaluations = collections.defaultdict(list)
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def register(self, *ids: str):
+    """Register an evaluation under `ids` for the duration of the block."""
+    cancellation = common_tools.Cancellation()
+    with self._lock:
+      for evaluation_id in ids:
+        self._evaluations[evaluation_id].append(cancellation)
+    try:
+      yield cancellation
+    finally:
+      with self._lock:
+        for evaluation_id in ids:
+          self._evaluations[evaluation_id].remove(cancellation)
+          if not self._evaluations[evaluation_id]:
+            del self._evaluations[evaluation_id]
+
+  def get(self, evaluation_id: str) -> list[common_tools.Cancellation]:
+    """The cancellations of the evaluations registered under `evaluation_id`."""
+    with self._lock:
+      return list(self._evaluations.get(evaluation_id, ()))
+
+  def cancel(self, evaluation_id: str) -> bool:
+    """Cancel the evaluations registered under `evaluation_id`, if any."""
+    cancellations = self.get(evaluation_id)
+    for cancellation in cancellations:
+      cancellation.cancel()
+    return bool(cancellations)
+
+
+def _client_socket(environ: dict) -> socket.socket | None:
+  return environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+
+
+@contextlib.contextmanager
+def on_disconnect(environ: dict, callback: Callable[[], None]):
+  """
+  Call `callback` if the client of the WSGI request `environ` disconnects
+  before the end of the `with` block. A no-op if the server does not expose
+  the client socket.
+  """
+  sock = _client_socket(environ)
+  if sock is None:
+    yield
+    return
+
+  done = threading.Event()
+
+  def watch():
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLIN)
+    while not done.is_set():
+      try:
+        if not poller.poll(DISCONNECT_CHECK_INTERVAL * 1000):
+          continue
+        data = sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+      except BlockingIOError:
+        continue
+      except OSError:
+        data = b""
+      if not data and not done.is_set():
+        logger.info("Client disconnected, cancelling its evaluations.")
+        callback()
+      # Otherwise the client sent its next request, so it is still there.
+      return
+
+  threading.Thread(target=watch, daemon=True).start()
+  try:
+    yield
+  finally:
+    done.set()
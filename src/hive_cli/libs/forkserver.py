@@ -0,0 +1,259 @@
+"""
+A fork server that runs Python scripts from a pre-warmed interpreter.
+
+The server imports a list of (usually heavy, third-party) modules once, then
+for every job received over its Unix socket forks a child which runs the
+requested script as `__main__`. Children therefore skip interpreter startup and
+the preloaded imports. Only the standard library is used in this module so that
+nothing unexpected ends up in the children's `sys.modules`.
+
+With `--repo-dir`, modules of the repository may be preloaded too (in-process
+evaluation). Before running a job, a child then evicts the repository modules
+whose files the job evolved, along with the ones referring to them, so that
+they are imported again from the job's overlay.
+
+Usage: python forkserver.py <socket-fd> [--repo-dir <dir>] [module ...]
+"""
+
+import importlib
+import json
+import os
+import runpy
+import socket
+import struct
+import sys
+import traceback
+import types
+
+_HEADER = struct.Struct("!I")
+
+
+def send_message(
+  sock: socket.socket, message: dict, fds: tuple[int, ...] = ()
+) -> None:
+  """Send a length-prefixed JSON message, optionally passing `fds` along."""
+  payload = json.dumps(message).encode()
+  header = _HEADER.pack(len(payload))
+  if fds:
+    socket.send_fds(sock, [header], list(fds))
+  else:
+    sock.sendall(header)
+  sock.sendall(payload)
+
+
+def recv_message(
+  sock: socket.socket, maxfds: int = 0
+) -> tuple[dict | None, list[int]]:
+  """
+  Receive a message sent with `send_message`.
+
+  Returns (message, fds), where message is None if the peer closed the socket.
+  """
+  fds = []
+  if maxfds:
+    header, fds, _, _ = socket.recv_fds(sock, _HEADER.size, maxfds)
+  else:
+    header = sock.recv(_HEADER.size)
+  if not header:
+    return None, fds
+  header += _recv_exactly(sock, _HEADER.size - len(header))
+  (length,) = _HEADER.unpack(header)
+  return json.loads(_recv_exactly(sock, length)), fds
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+  data = b""
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if not chunk:
+      raise EOFError("Connection closed by peer")
+    data += chunk
+  return data
+
+
+def _exit_code(code) -> int:
+  """Map a `SystemExit.code` to a process exit code, like the interpreter."""
+  if code is None:
+    return 0
+  if isinstance(code, int):
+    return code & 0xFF
+  print(code, file=sys.stderr)
+  return 1
+
+
+def _is_under(path: str | None, directory: str) -> bool:
+  return bool(path) and os.path.realpath(path).startswith(directory + os.sep)
+
+
+def _locations(module: types.ModuleType) -> list[str]:
+  """The file of `module` and, for a package, its directories."""
+  locations = [getattr(module, "__file__", None)]
+  try:
+    locations += list(getattr(module, "__path__", None) or ())
+  except Exception:  # Some lazy modules fail on attribute access
+    pass
+  return [path for path in locations if isinstance(path, str)]
+
+
+def _refers_to(module: types.ModuleType, names: set[str]) -> bool:
+  """Whether `module` holds one of the modules `names` or objects from them."""
+  for value in list(vars(module).values()):
+    if isinstance(value, types.ModuleType):
+      name = value.__name__
+    else:
+      try:
+        name = getattr(value, "__module__", None)
+      except Exception:
+        continue
+    if name in names:
+      return True
+  return False
+
+
+def evict_evolved_modules(repo_dir: str, evolved: list[str]) -> list[str]:
+  """
+  Remove the modules of `repo_dir` defined in the `evolved` files (relative to
+  `repo_dir`) from `sys.modules`, along with the repository modules referring
+  to them, directly or not. Returns the names of the evicted modules.
+
+  The packages containing an evolved file are evicted too, even if the module
+  of the file was not imported yet: their `__path__` points to `repo_dir`, so
+  it would later be imported from there instead of the overlay.
+
+  References are found by scanning module globals, so state derived from an
+  evolved module some other way (e.g. a constant computed at import) is not
+  detected. This is only meant for trusted evaluators.
+  """
+  repo_dir = os.path.realpath(repo_dir)
+  evolved_files = {
+    os.path.realpath(os.path.join(repo_dir, path)) for path in evolved
+  }
+  # Their directories, up to the repository root.
+  evolved_dirs = set()
+  for path in evolved_files:
+    parent = os.path.dirname(path)
+    while parent.startswith(repo_dir + os.sep):
+      evolved_dirs.add(parent)
+      parent = os.path.dirname(parent)
+
+  repo_modules = {}
+  for name, module in list(sys.modules.items()):
+    locations = [
+      os.path.realpath(path)
+      for path in _locations(module)
+      if _is_under(path, repo_dir)
+    ]
+    if locations:
+      repo_modules[name] = locations
+  stale = {
+    name
+    for name, locations in repo_modules.items()
+    if any(path in evolved_files or path in evolved_dirs for path in locations)
+  }
+  changed = bool(stale)
+  while changed:
+    changed = False
+    for name in repo_modules:
+      if name not in stale and _refers_to(sys.modules[name], stale):
+        stale.add(name)
+        changed = True
+  for name in stale:
+    del sys.modules[name]
+  return sorted(stale)
+
+
+def run_job(
+  job: dict,
+  stdout_fd: int,
+  stderr_fd: int,
+  base_path: list[str],
+  repo_dir: str | None = None,
+) -> None:
+  """
+  Run `job["argv"]` as `python <argv>` in `job["cwd"]`, with `base_path`
+  following the script's directory on `sys.path`. Never returns.
+  """
+  exit_code = 1
+  try:
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    os.close(stdout_fd)
+    os.close(stderr_fd)
+
+    # Imported here so that only the children pay for it.
+    import memory_limits
+
+    memory_limits.apply_child_limits(job.get("limits", {}))
+    sys.modules.pop("memory_limits", None)
+    os.chdir(job["cwd"])
+    script = job["argv"][0]
+    sys.argv = list(job["argv"])
+    # Mimic `python script.py`: the script's directory replaces ours and the
+    # repository's, so evicted modules are imported from the overlay and the
+    # server modules cannot be imported.
+    sys.path[:] = [os.path.dirname(os.path.abspath(script)), *base_path]
+    if repo_dir is not None:
+      evict_evolved_modules(repo_dir, job.get("evolved", []))
+
+    try:
+      runpy.run_path(script, run_name="__main__")
+      exit_code = 0
+    except SystemExit as e:
+      exit_code = _exit_code(e.code)
+    except BaseException:
+      traceback.print_exc()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(exit_code)
+
+
+def serve(
+  sock: socket.socket, preload: list[str], repo_dir: str | None = None
+) -> None:
+  """Preload modules, then fork one child per job until the socket closes."""
+  # The `sys.path` of a `python script.py` process, after the script's
+  # directory (the one of this module, as it runs as a script).
+  base_path = sys.path[1:]
+  if repo_dir is not None:
+    sys.path.insert(0, repo_dir)
+  for name in preload:
+    try:
+      importlib.import_module(name)
+    except Exception:
+      traceback.print_exc()
+  sys.stdout.flush()
+  sys.stderr.flush()
+
+  while True:
+    job, fds = recv_message(sock, maxfds=2)
+    if job is None:
+      return
+
+    pid = os.fork()
+    if pid == 0:
+      sock.close()
+      os.setsid()  # Its own process group, see common_tools.kill_process_group
+      run_job(job, *fds, base_path, repo_dir=repo_dir)
+
+    for fd in fds:
+      os.close(fd)
+    send_message(sock, {"pid": pid})
+    _, status, rusage = os.wait4(pid, 0)
+    send_message(
+      sock,
+      {
+        "returncode": os.waitstatus_to_exitcode(status),
+        "cpu_time": rusage.ru_utime + rusage.ru_stime,
+      },
+    )
+
+
+if __name__ == "__main__":
+  args = sys.argv[2:]
+  repo_dir = None
+  if args[:1] == ["--repo-dir"]:
+    repo_dir, args = args[1], args[2:]
+  serve(socket.socket(fileno=int(sys.argv[1])), args, repo_dir)
@@ -1,50 +1,332 @@
 """A simple Python sandbox server that executes Python functions."""
 
+import concurrent.futures
+import contextlib
+import contextvars
+import json
 import logging
 import os
 import subprocess
 import tempfile
-import threading
+import time
+import uuid
 from functools import wraps
 
-from flask import Flask, jsonify, request
+from flask import (
+  Flask,
+  Response,
+  after_this_request,
+  g,
+  jsonify,
+  request,
+  send_file,
+)
 
 import common_tools
+import evaluations
+import metrics
 import overlay
+import payloads
+import result_cache
+import result_channel
+import scheduler
+import tracing
+import warmup
+import worker_pool
 
-REPO_DIR = "/app/repo"  # Directory where the repository is mounted
+# Directory where the repository is mounted
+REPO_DIR = os.getenv("REPO_DIR", "/app/repo")
 
 app = Flask(__name__)
-sandbox_lock = threading.Lock()
 enable_lock_sandbox = os.getenv("LOCK_SANDBOX", "false") == "true"
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Listings of the (read-only) repository and the evaluation scripts, indexed
+# once at startup and reused by every overlay.
+repo_index = overlay.DirectoryIndex()
+if os.path.isdir(REPO_DIR):
+  repo_index.warm(REPO_DIR)
 
-def lock_sandbox(enable: bool = False):
-  def decorator(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-      if not enable:
-        return f(*args, **kwargs)
+# Opt-in pool of persistent symlink overlays, reset in the background instead of
+# being built and deleted for every request. `WORKSPACE_TMPFS_SIZE` places them
+# on a tmpfs (needs CAP_SYS_ADMIN).
+workspace_pool_size = int(os.getenv("WORKSPACE_POOL_SIZE", "0"))
+
+# How overlays are built: "overlayfs", "reflink", "symlink" or "auto" to pick
+# overlayfs when it works in this container and symlink otherwise, or when the
+# workspace pool is enabled, see `overlay.select_backend`.
+overlay_backend = overlay.select_backend(
+  REPO_DIR,
+  name=os.getenv("OVERLAY_BACKEND", "auto"),
+  scratch_dir=os.getenv("OVERLAY_SCRATCH_DIR"),
+  workspace_pool=workspace_pool_size > 0,
+)
+
+workspaces = None
+if workspace_pool_size > 0:
+  if overlay_backend.name != overlay.SymlinkOverlay.name:
+    logger.warning(
+      "Workspace pools need the symlink overlay backend, not %s.",
+      overlay_backend.name,
+    )
+  else:
+    # One directory per server process, see `serve.py`.
+    workspace_root = os.getenv("WORKSPACE_DIR", "workspaces")
+    overlay.remove_stale_workspace_dirs(workspace_root)
+    workspace_dir = os.path.join(workspace_root, str(os.getpid()))
+    if os.getenv("WORKSPACE_TMPFS_SIZE"):
+      overlay.mount_tmpfs(workspace_dir, os.environ["WORKSPACE_TMPFS_SIZE"])
+    workspaces = overlay.WorkspacePool(
+      REPO_DIR, workspace_dir, workspace_pool_size, repo_index
+    )
+
+
+def read_repo_commit(repo_dir: str) -> str:
+  """The commit of the repository, from `REPO_COMMIT` or its git metadata."""
+  commit = os.getenv("REPO_COMMIT")
+  if commit:
+    return commit
+  git_dir = os.path.join(repo_dir, ".git")
+  try:
+    with open(os.path.join(git_dir, "HEAD"), encoding="utf-8") as f:
+      head = f.read().strip()
+    if not head.startswith("ref: "):
+      return head
+    ref = head.removeprefix("ref: ")
+    try:
+      with open(os.path.join(git_dir, ref), encoding="utf-8") as f:
+        return f.read().strip()
+    except FileNotFoundError:
+      with open(os.path.join(git_dir, "packed-refs"), encoding="utf-8") as f:
+        for line in f:
+          if line.rstrip().endswith(f" {ref}"):
+            return line.split()[0]
+  except OSError:
+    pass
+  return ""
+
+
+# Opt-in cache of evaluation results, keyed by everything an evaluation
+# depends on. Only useful for deterministic evaluators.
+repo_commit = read_repo_commit(REPO_DIR)
+results = (
+  result_cache.ResultCache(
+    os.environ["RESULT_CACHE_DIR"],
+    int(os.getenv("RESULT_CACHE_MAX_BYTES", str(1024**3))),
+  )
+  if os.getenv("RESULT_CACHE_DIR")
+  else None
+)
+
+# In-flight evaluations by ID, see `track_evaluation`.
+in_flight = evaluations.EvaluationRegistry()
+
+# Recently received file contents, which `code` deltas can refer to by hash.
+contents = payloads.ContentStore(
+  int(os.getenv("CONTENT_STORE_MAX_BYTES", str(64 * 1024**2)))
+)
 
-      if not sandbox_lock.acquire(blocking=False):
-        logger.info(
-          "Experiment already running on sandbox. Rejecting new request."
+# Admission control: at most `SANDBOX_SLOTS` concurrent evaluations ("auto"
+# derives it from the container limits) and `SANDBOX_QUEUE_SIZE` waiting
+# requests, each waiting up to `queue_timeout` seconds. `LOCK_SANDBOX=true` is
+# equivalent to a single slot without a queue. Without either, every request
+# runs immediately.
+sandbox_slots = os.getenv("SANDBOX_SLOTS", "1" if enable_lock_sandbox else "")
+sandbox_queue_size = int(os.getenv("SANDBOX_QUEUE_SIZE", "0"))
+sandbox_queue_timeout = float(os.getenv("SANDBOX_QUEUE_TIMEOUT", "60"))
+if sandbox_slots == "auto":
+  slot_memory_mb = int(os.getenv("SANDBOX_SLOT_MEMORY_MB", "0")) or None
+  slot_scheduler = scheduler.SlotScheduler(
+    scheduler.default_slots(slot_memory_mb), sandbox_queue_size
+  )
+elif sandbox_slots:
+  slot_scheduler = scheduler.SlotScheduler(
+    int(sandbox_slots), sandbox_queue_size
+  )
+else:
+  slot_scheduler = None
+if slot_scheduler is not None:
+  logger.info(
+    "Running up to %d evaluations with a queue of %d requests.",
+    slot_scheduler.slots,
+    slot_scheduler.queue_size,
+  )
+
+# Opt-in pool of pre-warmed interpreters, see `worker_pool.WorkerPool`. With
+# `IN_PROCESS_EVALUATION=true`, `WORKER_POOL_PRELOAD` may include repository
+# modules, which are reused unless evolved. Only for trusted evaluators: state
+# left in preloaded modules is not isolated from the evolved code. A fork server
+# runs one evaluation at a time, so there is one per evaluation slot unless
+# `WORKER_POOL_SIZE` is set.
+in_process_evaluation = os.getenv("IN_PROCESS_EVALUATION", "false") == "true"
+default_pool_size = 0
+if in_process_evaluation:
+  default_pool_size = (
+    slot_scheduler.slots
+    if slot_scheduler is not None
+    else scheduler.default_slots()
+  )
+worker_pool_size = int(os.getenv("WORKER_POOL_SIZE", str(default_pool_size)))
+python_workers = (
+  worker_pool.WorkerPool(
+    worker_pool_size,
+    os.getenv("WORKER_POOL_PRELOAD", "").split(","),
+    repo_dir=REPO_DIR if in_process_evaluation else None,
+  )
+  if worker_pool_size > 0
+  else None
+)
+
+
+def run_in_slot(slots: scheduler.SlotScheduler | None, queue_timeout, f):
+  """
+  Call `f` within an evaluation slot of `slots`, if configured, and return its
+  (body, status, headers). Returns a 429 when the queue is full and a 503 when
+  no slot frees up within `queue_timeout` seconds.
+  """
+  if slots is None:
+    with metrics.RUNNING.track_inprogress():
+      return f()
+
+  start = time.monotonic()
+  queued = True
+  metrics.QUEUED.inc()
+  try:
+    with slots.slot(
+      timeout=None if queue_timeout is None else float(queue_timeout)
+    ):
+      queued = False
+      metrics.QUEUED.dec()
+      metrics.STAGE_SECONDS.labels("queue").observe(time.monotonic() - start)
+      with metrics.RUNNING.track_inprogress():
+        return f()
+  except scheduler.QueueFullError as e:
+    logger.info("Rejecting request: %s", e)
+    metrics.REJECTIONS.labels("queue_full").inc()
+    return {"output": None, "metainfo": str(e)}, 429, {}
+  except scheduler.SlotTimeoutError as e:
+    logger.info("Rejecting request: %s", e)
+    metrics.REJECTIONS.labels("queue_timeout").inc()
+    return {"output": None, "metainfo": str(e)}, 503, {}
+  finally:
+    if queued:
+      metrics.QUEUED.dec()
+
+
+def request_payload():
+  """
+  The JSON body of the request, decompressed according to its
+  `Content-Encoding`, or None if it is not JSON. Raises `PayloadError`.
+  """
+  if "payload" not in g:
+    if not request.is_json:
+      g.payload = None
+    else:
+      with metrics.stage("decode"):
+        body = payloads.decode_body(
+          request.get_data(), request.headers.get("Content-Encoding", "")
         )
-        return jsonify(
-          {"output": None, "metainfo": "Only one experiment can run at a time."}
-        ), 429
+        try:
+          payload = json.loads(body)
+        except ValueError as e:
+          raise payloads.PayloadError(f"Invalid JSON body: {e}") from e
+        if not isinstance(payload, dict):
+          raise payloads.PayloadError("The JSON body must be an object")
+        g.payload = payload
+  return g.payload
 
-      try:
+
+def track_evaluation(f):
+  """
+  Register the request as an evaluation, which is cancelled on
+  `DELETE /run_code/<id>` or when the client disconnects. The ID comes from the
+  `X-Evaluation-Id` request header (generated if absent) and is returned in the
+  response header of the same name. The endpoint finds the evaluation's
+  `Cancellation` in `g.cancellation`.
+
+  The request is traced as the root span of the evaluation, continuing the
+  coordinator's trace if it sends a `traceparent` header.
+  """
+  @wraps(f)
+  def decorated_function(*args, **kwargs):
+    evaluation_id = request.headers.get("X-Evaluation-Id") or uuid.uuid4().hex
+    root_span = None
+
+    @after_this_request
+    def add_evaluation_id(response):
+      response.headers["X-Evaluation-Id"] = evaluation_id
+      if root_span is not None and root_span.trace_id:
+        response.headers["X-Trace-Id"] = root_span.trace_id
+      return response
+
+    with (
+      tracing.span(
+        request.path,
+        request.headers.get("traceparent"),
+        evaluation_id=evaluation_id,
+      ) as root_span,
+      in_flight.register(evaluation_id) as cancellation,
+    ):
+      # Read the body before watching the connection, which would otherwise
+      # take its unread end for a next request. Errors are left to `f`.
+      request.get_data()
+      with contextlib.suppress(payloads.PayloadError):
+        request_payload()
+      with evaluations.on_disconnect(request.environ, cancellation.cancel):
+        g.cancellation = cancellation
         return f(*args, **kwargs)
-      finally:
-        sandbox_lock.release()
 
-    return decorated_function
-  return decorator
+  return decorated_function
+
+
+def run_evaluation(
+  argv: list,
+  cwd: str,
+  timeout: float,
+  memory_limit: int | None,
+  stats: common_tools.ExecutionStats | None,
+  evolved: list[str],
+  cancellation: common_tools.Cancellation | None = None,
+) -> str:
+  """
+  Run `python <argv>` in the worker pool, if enabled, or in a subprocess.
+  In-process evaluations that crash are retried in a subprocess.
+  """
+  if python_workers is not None:
+    try:
+      with tracing.span("run_command", mode="pool"):
+        return python_workers.run_script(
+          argv, cwd, timeout, memory_limit, stats, evolved, cancellation
+        )
+    except (
+      common_tools.ProcessCrashedError,
+      subprocess.SubprocessError,
+      OSError,
+      EOFError,
+    ) as e:
+      if not in_process_evaluation:
+        raise
+      logger.warning(
+        "In-process evaluation crashed: %s. Retrying in a subprocess.", e
+      )
+  with tracing.span("run_command", mode="subprocess"):
+    return common_tools.run_command(
+      ["python"] + argv, cwd, timeout, memory_limit, stats, cancellation
+    )
+
+
+def failure_reason(error: common_tools.FunctionExecutionError) -> str:
+  """The reason label of a failed evaluator process in the metrics."""
+  if isinstance(error, common_tools.ExecutionTimeoutError):
+    return "timeout"
+  if isinstance(error, common_tools.MemoryLimitError):
+    return "memory"
+  if isinstance(error, common_tools.ProcessCrashedError):
+    return "crash"
+  return "error"
 
 
 def execute_python_function(
@@ -53,39 +335,84 @@ def execute_python_function(
   timeout: float,
   memory_limit: int | None,
   evaluation_script: str,
+  stats: common_tools.ExecutionStats | None = None,
+  cancellation: common_tools.Cancellation | None = None,
 ) -> str:
-  """Execute a Python function in a temporary directory."""
-  with tempfile.TemporaryDirectory(dir=".") as temp_dir:
-    args = [f'"{arg}"' if isinstance(arg, str) else f"{arg}" for arg in args]
+  """
+  Execute a Python function in a temporary directory, recording the timing of
+  the evaluation in `stats`. Raises `EvaluationCancelledError` once
+  `cancellation` is cancelled.
+  """
+  args = [f'"{arg}"' if isinstance(arg, str) else f"{arg}" for arg in args]
+
+  # We (over)write the evaluation script in `code_files`
+  code_files[evaluation_script] = repo_index.read_text(
+    os.path.join(REPO_DIR, evaluation_script)
+  )
 
-    # We (over)write the evaluation script in `code_files`
-    with open(os.path.join(REPO_DIR, evaluation_script), encoding="utf-8") as f:
-      evaluation_script_content = f.read()
-      code_files[evaluation_script] = evaluation_script_content
+  with (
+    tracing.span("execute_python_function", script=evaluation_script),
+    contextlib.ExitStack() as stack,
+  ):
+    with (
+      metrics.stage("overlay"),
+      tracing.span("overlay", backend=overlay_backend.name),
+    ):
+      if workspaces is not None:
+        temp_dir = stack.enter_context(workspaces.overlay(code_files))
+      else:
+        temp_dir = stack.enter_context(tempfile.TemporaryDirectory(dir="."))
+        stack.enter_context(
+          overlay_backend.overlay(REPO_DIR, temp_dir, code_files, repo_index)
+        )
 
-    overlay.mirror_overlay_and_overwrite(REPO_DIR, temp_dir, code_files)
+    result_channel.reset(temp_dir, code_files)
+    if cancellation is not None:
+      cancellation.work_dir = temp_dir
+      stack.callback(setattr, cancellation, "work_dir", None)
 
     # Run the Python program
     try:
-      output = common_tools.run_command(
-        ["python", evaluation_script] + args, temp_dir, timeout, memory_limit
-      )
-      return output
+      with metrics.stage("run"):
+        try:
+          output = run_evaluation(
+            [evaluation_script] + args,
+            temp_dir,
+            timeout,
+            memory_limit,
+            stats,
+            list(code_files),
+            cancellation,
+          )
+        finally:
+          if stats is not None and stats.spawn_time is not None:
+            metrics.STAGE_SECONDS.labels("spawn").observe(stats.spawn_time)
+      try:
+        records = result_channel.read_records(temp_dir)
+      except ValueError as e:
+        raise common_tools.FunctionExecutionError(
+          f"Invalid result record: {e}"
+        ) from e
+      return result_channel.response(records) if records else output
+    except common_tools.EvaluationCancelledError:
+      raise
     except common_tools.FunctionExecutionError as e:
       logger.info(
-        "Run command failed: %s. Attempting to read checkpoint data.", e
+        "Run command failed: %s. Attempting to read partial results.", e
       )
-      try:
-        # If the script leaves checkpointed json data, find and return it
-        output = common_tools.run_command(["cat", "checkpoint.json"], temp_dir)
-        return f'{{"output": {output}, "metainfo": "Checkpoint"}}'
-      except common_tools.FunctionExecutionError as ee:
-        logger.info(
-          "Failed to read checkpoint data: %s. Returning original error.", ee
-        )
-        raise common_tools.FunctionExecutionError(
-          f"Execution failed: {e}"
-        )
+      metrics.PROCESS_FAILURES.labels(failure_reason(e)).inc()
+      # If the script leaves partial results or checkpointed json data,
+      # return them instead of the error
+      with metrics.stage("fallback"), tracing.span("checkpoint_fallback"):
+        output = result_channel.fallback_response(temp_dir, str(e))
+      if output is None:
+        logger.info("No partial results found. Returning original error.")
+        metrics.FALLBACKS.labels("failed").inc()
+        raise common_tools.FunctionExecutionError(f"Execution failed: {e}")
+      metrics.FALLBACKS.labels("recovered").inc()
+      if stats is not None:
+        stats.fallback = True
+      return output
 
 
 @app.route("/health", methods=["GET"])
@@ -94,24 +421,58 @@ def health_check():
   return jsonify({"status": "healthy"}), 200
 
 
-@app.route("/run_code", methods=["POST"])
-@lock_sandbox(enable=enable_lock_sandbox)
-def run_function():
-  """Run the Python function provided in the request."""
+@app.route("/ready", methods=["GET"])
+def readiness_check():
+  """Readiness endpoint, passing once the warm-up is done, see `warmup`."""
+  return jsonify(sandbox_warmup.status()), 200 if sandbox_warmup.ready else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+  """Prometheus metrics of the evaluations, see `metrics`."""
+  return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def evaluate(
+  payload: dict,
+  cancellation: common_tools.Cancellation | None = None,
+  slots: scheduler.SlotScheduler | None = None,
+  queue_timeout=None,
+) -> tuple[str | dict, int, dict]:
+  """
+  Evaluate a single `/run_code` payload and return the response (body, status,
+  headers). A successful body is the evaluator's output, an error body a JSON
+  dict. The headers report the wall and CPU time of the evaluation, or
+  `X-Cached` when the result comes from the result cache. Evaluations cancelled
+  through `cancellation` return a 409.
+
+  Only evaluations missing from the result cache wait for a slot of `slots`,
+  see `run_in_slot`.
+  """
+  return _evaluate(payload, cancellation, slots, queue_timeout)
+
+
+def _evaluate(
+  payload: dict,
+  cancellation: common_tools.Cancellation | None,
+  slots: scheduler.SlotScheduler | None,
+  queue_timeout,
+) -> tuple[str | dict, int, dict]:
+  stats = common_tools.ExecutionStats()
   try:
-    if not request.is_json:
-      logger.error("Request content type is not application/json")
-      return jsonify(
-        {"output": None, "metainfo": "Content-Type must be application/json"}
-      ), 400
-
-    code = request.json.get("code")
-    timeout = float(request.json.get("timeout"))
-    memory_limit = request.json.get("memory_limit", None)
-    if memory_limit is not None:
-      memory_limit = int(memory_limit)
-    args = request.json.get("args", ())
-    evaluation_script = request.json.get("evaluation_script", "evaluator.py")
+    with metrics.stage("parse"):
+      code = payloads.resolve_code(
+        payload.get("code"),
+        lambda path: repo_index.read_text(os.path.join(REPO_DIR, path)),
+        contents,
+        repo_commit,
+      )
+      timeout = float(payload.get("timeout"))
+      memory_limit = payload.get("memory_limit", None)
+      if memory_limit is not None:
+        memory_limit = int(memory_limit)
+      args = payload.get("args", ())
+      evaluation_script = payload.get("evaluation_script", "evaluator.py")
 
     logger.info(
       "Executing code with timeout=%s, memory_limit=%s, evaluation_script=%s",
@@ -120,24 +481,352 @@ def run_function():
       evaluation_script,
     )
 
-    result = execute_python_function(
-      code, args, timeout, memory_limit, evaluation_script
-    )
-    return result, 200
+    key = None
+    if results is not None:
+      key = result_cache.cache_key(
+        commit=repo_commit,
+        code=code,
+        args=list(args),
+        timeout=timeout,
+        memory_limit=memory_limit,
+        evaluation_script=evaluation_script,
+        evaluation_script_content=repo_index.read_text(
+          os.path.join(REPO_DIR, evaluation_script)
+        ),
+      )
+      cached = results.get(key)
+      if cached is not None:
+        logger.info("Returning the cached result %s.", key)
+        metrics.EVALUATIONS.labels("cached").inc()
+        return cached, 200, {"X-Cached": "true"}
+
+    # The evaluation stage excludes the wait for the slot, timed as the queue
+    # stage.
+    @metrics.stage("evaluation")
+    def execute():
+      if cancellation is not None and cancellation.cancelled:
+        raise common_tools.EvaluationCancelledError("Cancelled")
+      result = execute_python_function(
+        code, args, timeout, memory_limit, evaluation_script, stats,
+        cancellation,
+      )
+      # Only complete results are cached, a failed evaluation may succeed when
+      # retried.
+      if key is not None and not stats.fallback:
+        results.put(key, result)
+      metrics.EVALUATIONS.labels("success").inc()
+      return result, 200, stats_headers(stats)
+
+    return run_in_slot(slots, queue_timeout, execute)
 
+  except payloads.PayloadError as e:
+    logger.error("Invalid code: %s", e)
+    metrics.EVALUATIONS.labels("invalid").inc()
+    return {"output": None, "metainfo": str(e)}, e.status, {}
+  except worker_pool.PoolTimeoutError as e:
+    logger.info("Rejecting request: %s", e)
+    metrics.REJECTIONS.labels("pool_timeout").inc()
+    return {"output": None, "metainfo": str(e)}, 503, stats_headers(stats)
+  except common_tools.EvaluationCancelledError:
+    logger.info("Evaluation cancelled.")
+    metrics.EVALUATIONS.labels("cancelled").inc()
+    return {"output": None, "metainfo": "Cancelled"}, 409, stats_headers(stats)
   except common_tools.FunctionExecutionError as e:
     logger.error("Function execution failed: %s", e)
-    return jsonify({"output": None, "metainfo": str(e)}), 400
+    metrics.EVALUATIONS.labels("failed").inc()
+    return {"output": None, "metainfo": str(e)}, 400, stats_headers(stats)
   except subprocess.SubprocessError as e:
     logger.error("Unexpected error: %s", e)
-    if str(e) == "Exception occurred in preexec_fn.":
-      return jsonify(
-        {"output": None, "metainfo": "Execution failed: Memory limit exceeded"}
-      ), 500
-    return jsonify({"output": None, "metainfo": "Internal server error"}), 500
+    metrics.EVALUATIONS.labels("error").inc()
+    return {"output": None, "metainfo": "Internal server error"}, 500, {}
+
+
+def stats_headers(stats: common_tools.ExecutionStats) -> dict[str, str]:
+  """
+  Response headers reporting the timing of an evaluation (in seconds), which of
+  its outputs were truncated and the names their complete versions were spilled
+  to, to fetch once from `/output/<name>`.
+  """
+  headers = {}
+  if stats.wall_time is not None:
+    headers["X-Wall-Time"] = f"{stats.wall_time:.6f}"
+  if stats.cpu_time is not None:
+    headers["X-Cpu-Time"] = f"{stats.cpu_time:.6f}"
+  truncated = [
+    name
+    for name, flag in (
+      ("stdout", stats.stdout_truncated),
+      ("stderr", stats.stderr_truncated),
+    )
+    if flag
+  ]
+  if truncated:
+    headers["X-Output-Truncated"] = ",".join(truncated)
+  if stats.stdout_file:
+    headers["X-Stdout-File"] = os.path.basename(stats.stdout_file)
+  if stats.stderr_file:
+    headers["X-Stderr-File"] = os.path.basename(stats.stderr_file)
+  return headers
+
+
+@app.route("/output/<name>", methods=["GET"])
+def spilled_output(name: str):
+  """
+  The complete output spilled to `name` (see `stats_headers`), deleted once
+  fetched.
+  """
+  f = common_tools.take_spill_file(name)
+  if f is None:
+    return jsonify({"error": "Unknown output"}), 404
+  return send_file(f, mimetype="text/plain")
+
+
+@app.route("/run_code", methods=["POST"])
+@track_evaluation
+def run_function():
+  """
+  Run the Python function provided in the request. The body may be gzip or
+  zstd compressed and `code` may hold deltas, see `payloads`.
+  """
+  try:
+    payload = request_payload()
+  except payloads.PayloadError as e:
+    logger.error("Invalid request body: %s", e)
+    return {"output": None, "metainfo": str(e)}, e.status
+  if payload is None:
+    logger.error("Request content type is not application/json")
+    return {
+      "output": None,
+      "metainfo": "Content-Type must be application/json",
+    }, 400
+
+  return evaluate(
+    payload,
+    g.cancellation,
+    slot_scheduler,
+    payload.get("queue_timeout", sandbox_queue_timeout),
+  )
+
+
+@app.route("/run_code/<evaluation_id>", methods=["DELETE"])
+def cancel_evaluation(evaluation_id: str):
+  """
+  Cancel the in-flight evaluations with the given ID (or batch ID), killing
+  their process trees. Only the evaluations of this server process are found,
+  see `serve.py` for multiple workers.
+  """
+  if not in_flight.cancel(evaluation_id):
+    return jsonify({"status": "not found"}), 404
+  logger.info("Cancelled evaluation %s.", evaluation_id)
+  return jsonify({"status": "cancelled"}), 200
+
+
+@app.route("/run_code/<evaluation_id>/records", methods=["GET"])
+def evaluation_records(evaluation_id: str):
+  """
+  The records written so far to the result channel by the in-flight
+  evaluations with the given ID (or batch ID), see `result_channel`.
+  """
+  cancellations = in_flight.get(evaluation_id)
+  if not cancellations:
+    return jsonify({"status": "not found"}), 404
+  records = []
+  for cancellation in cancellations:
+    work_dir = cancellation.work_dir
+    try:
+      records.append(result_channel.read_records(work_dir) if work_dir else [])
+    except ValueError:
+      records.append([])
+  return jsonify({"records": records}), 200
+
+
+def evaluate_candidate(
+  index: int,
+  evaluation_id: str,
+  payload: dict,
+  queue_timeout,
+  cancellation: common_tools.Cancellation,
+) -> str:
+  """Evaluate one candidate of a batch and return its JSON line."""
+  try:
+    with tracing.span("candidate", index=index, evaluation_id=evaluation_id):
+      result, status, headers = evaluate(
+        payload, cancellation, slot_scheduler, queue_timeout
+      )
+  except Exception:
+    logger.exception("Candidate %d of the batch failed.", index)
+    result = {"output": None, "metainfo": "Internal server error"}
+    status, headers = 500, {}
+  if isinstance(result, dict):
+    result = json.dumps(result)
+  return json.dumps(
+    {
+      "index": index,
+      "id": evaluation_id,
+      "status": status,
+      "response": result,
+      "headers": headers,
+      "cached": headers.get("X-Cached") == "true",
+    }
+  )
+
+
+@app.route("/run_code_batch", methods=["POST"])
+def run_function_batch():
+  """
+  Run a batch of candidates in parallel and stream back one JSON line per
+  candidate as soon as it finishes.
+
+  The body holds `candidates`, a list of `/run_code` payloads. Any other
+  top-level field (`code`, `args`, `timeout`, ...) is a default shared by all
+  candidates; a candidate's `code` is merged over the shared `code`. Each line
+  is `{"index": i, "id": <evaluation ID>, "status": <HTTP status>, "response":
+  <run_code body>, "headers": <run_code headers>, "cached": <bool>}`.
+
+  Candidate `i` can be cancelled as `<batch ID>-<i>`, and the whole batch as
+  `<batch ID>` (see `track_evaluation` for the batch ID). Disconnecting cancels
+  the remaining candidates.
+  """
+  try:
+    body = request_payload()
+  except payloads.PayloadError as e:
+    logger.error("Invalid request body: %s", e)
+    return jsonify({"output": None, "metainfo": str(e)}), e.status
+  if not isinstance(body, dict) or not isinstance(
+    body.get("candidates"), list
+  ):
+    logger.error("Batch request is not JSON with a list of candidates")
+    return jsonify(
+      {"output": None, "metainfo": "Expected a JSON body with `candidates`"}
+    ), 400
+
+  defaults = dict(body)
+  candidates = defaults.pop("candidates")
+  queue_timeout = defaults.pop("queue_timeout", sandbox_queue_timeout)
+  shared_code = defaults.pop("code", None) or {}
+  if not isinstance(shared_code, dict) or not all(
+    isinstance(candidate, dict)
+    and isinstance(candidate.get("code") or {}, dict)
+    for candidate in candidates
+  ):
+    logger.error("Batch candidates or their code are not JSON objects")
+    return jsonify(
+      {
+        "output": None,
+        "metainfo": "Candidates and `code` fields must be JSON objects",
+      }
+    ), 400
+  batch = [
+    {
+      **defaults,
+      **candidate,
+      "code": {**shared_code, **(candidate.get("code") or {})},
+    }
+    for candidate in candidates
+  ]
+  if slot_scheduler is not None:
+    parallelism = slot_scheduler.slots
+  else:
+    parallelism = scheduler.default_slots()
+  logger.info(
+    "Executing a batch of %d candidates, %d at a time.",
+    len(batch),
+    parallelism,
+  )
+
+  batch_id = request.headers.get("X-Evaluation-Id") or uuid.uuid4().hex
+  traceparent = request.headers.get("traceparent")
+  environ = request.environ
+
+  def generate():
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=parallelism)
+    with contextlib.ExitStack() as stack:
+      stack.enter_context(
+        tracing.span("/run_code_batch", traceparent, batch_id=batch_id)
+      )
+      stack.enter_context(
+        evaluations.on_disconnect(environ, lambda: in_flight.cancel(batch_id))
+      )
+      try:
+        futures = []
+        for index, payload in enumerate(batch):
+          evaluation_id = f"{batch_id}-{index}"
+          cancellation = stack.enter_context(
+            in_flight.register(batch_id, evaluation_id)
+          )
+          futures.append(
+            executor.submit(
+              # Candidates are traced as children of the batch.
+              contextvars.copy_context().run,
+              evaluate_candidate,
+              index,
+              evaluation_id,
+              payload,
+              queue_timeout,
+              cancellation,
+            )
+          )
+        for future in concurrent.futures.as_completed(futures):
+          yield future.result() + "\n"
+      finally:
+        # Stop the remaining candidates if the client went away.
+        in_flight.cancel(batch_id)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+  return Response(
+    generate(),
+    mimetype="application/x-ndjson",
+    headers={"X-Evaluation-Id": batch_id},
+  )
+
+
+def warmup_steps(names: list[str]) -> list:
+  """The `warmup.Warmup` steps called `names`, see `warmup` for the list."""
+  script = os.getenv("PRE_PROCESSOR")
+  timeout = float(os.getenv("WARMUP_TIMEOUT", "600"))
+  steps = {
+    "preprocess": lambda: warmup.preprocess(
+      script,
+      REPO_DIR,
+      os.getenv("PRE_PROCESSOR_DATA_DIR", "/data"),
+      warmup.preprocessor_key(script, repo_commit),
+      os.getenv("PRE_PROCESSOR_CACHE_DIR"),
+      float(os.getenv("PRE_PROCESSOR_TIMEOUT", "3600")),
+    ),
+    "compile": lambda: warmup.compile_repo(REPO_DIR),
+    "imports": lambda: warmup.import_modules(
+      [m.strip() for m in os.getenv("WARMUP_IMPORTS", "").split(",") if m],
+      REPO_DIR,
+      timeout,
+    ),
+    "dry_run": lambda: execute_python_function(
+      {}, [], timeout, None, os.getenv("EVALUATION_SCRIPT", "evaluator.py")
+    ),
+  }
+  unknown = set(names) - set(steps)
+  if unknown:
+    raise ValueError(f"Unknown warm-up steps: {sorted(unknown)}")
+  return [
+    (name, steps[name], name == "preprocess")
+    for name in names
+    if name != "preprocess" or script
+  ]
+
+
+# Started last, as the steps use the whole module.
+sandbox_warmup = warmup.Warmup(
+  warmup_steps(
+    [
+      name.strip()
+      for name in os.getenv("WARMUP", "preprocess,compile,imports").split(",")
+      if name.strip()
+    ]
+  )
+)
+sandbox_warmup.start()
 
 
 if __name__ == "__main__":
   port = int(os.environ.get("PORT", "8080"))
   debug = os.environ.get("DEBUG", "false").lower() == "true"
-  app.run(debug=True, host="0.0.0.0", port=port)
+  app.run(debug=debug, host="0.0.0.0", port=port)
@@ -0,0 +1,301 @@
+"""
+Memory limit enforcement for evaluation processes.
+
+Three enforcers are available, selected with `MEMORY_ENFORCEMENT`:
+
+- "cgroup": every evaluation runs in its own cgroup v2 with `memory.max` set,
+  so the kernel accounts for the whole process tree and OOM-kills it as soon
+  as the limit is hit, which the OOM events of the cgroup report right away.
+  Needs a writable cgroup v2 hierarchy.
+- "rlimit": `RLIMIT_AS` is set on the child, so allocations beyond the limit
+  fail (usually with a `MemoryError`). Limits virtual rather than resident
+  memory, which is too strict for frameworks reserving large address spaces,
+  hence it is never picked automatically.
+- "poll": the RSS of the process is sampled with psutil, see
+  `common_tools.monitor_memory`.
+
+"auto" (the default) picks "cgroup" when available, otherwise "poll".
+
+The limits are applied to a started process from its parent (`apply_limits`),
+as `preexec_fn` is unsafe in the threaded server. Only the standard library is
+used here, the fork server imports this module to apply the limits in its
+children.
+"""
+
+import contextlib
+import functools
+import logging
+import os
+import resource
+import select
+import signal
+import threading
+import time
+import uuid
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# How often the OOM watcher of an evaluation checks whether to stop, in seconds.
+OOM_WATCH_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def apply_limits(settings: dict, pid: int) -> None:
+  """
+  Apply the limits of `MemoryLimit.child_settings` to the process `pid`, from
+  any process allowed to (e.g. its parent).
+  """
+  if "cgroup" in settings:
+    _write(os.path.join(settings["cgroup"], "cgroup.procs"), str(pid))
+  if "rlimit_as" in settings:
+    limit = settings["rlimit_as"]
+    resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+
+
+def apply_child_limits(settings: dict) -> None:
+  """
+  Apply the limits of `MemoryLimit.child_settings` in the child process. Only
+  safe in children of single-threaded processes, such as the fork servers.
+  """
+  apply_limits(settings, os.getpid())
+
+
+class MemoryLimit:
+  """The memory limit of a single evaluation."""
+
+  # Whether the limit has to be enforced by polling the process.
+  needs_polling = True
+
+  def __init__(self, child_settings: dict | None = None):
+    # JSON-serializable settings for `apply_child_limits`.
+    self.child_settings = child_settings or {}
+
+  def apply(self, pid: int) -> None:
+    """Apply the limit to the started (but held) process `pid`."""
+    apply_limits(self.child_settings, pid)
+
+  def exceeded(self, returncode: int, stderr: str) -> bool:
+    """Whether the process was stopped because it hit the limit."""
+    return False
+
+
+class PollEnforcer:
+  """Leaves the limit to `common_tools.monitor_memory`."""
+
+  name = "poll"
+
+  @contextlib.contextmanager
+  def limit(self, limit_mb: int | None):
+    yield MemoryLimit()
+
+
+class RlimitLimit(MemoryLimit):
+  needs_polling = False
+
+  def exceeded(self, returncode: int, stderr: str) -> bool:
+    lines = stderr.strip().splitlines()
+    return returncode != 0 and bool(lines) and "MemoryError" in lines[-1]
+
+
+class RlimitEnforcer:
+  """Sets `RLIMIT_AS` in the child."""
+
+  name = "rlimit"
+
+  @contextlib.contextmanager
+  def limit(self, limit_mb: int | None):
+    if not limit_mb:
+      yield MemoryLimit()
+      return
+    yield RlimitLimit({"rlimit_as": limit_mb * 1024 * 1024})
+
+
+class CgroupLimit(MemoryLimit):
+  needs_polling = False
+
+  def __init__(self, path: str):
+    super().__init__({"cgroup": path})
+    self.path = path
+    self.oom_killed = False
+    self._stopped = threading.Event()
+    self._watcher = threading.Thread(target=self._watch_oom, daemon=True)
+
+  def _read_events(self) -> dict:
+    with open(
+      os.path.join(self.path, "memory.events"), encoding="utf-8"
+    ) as f:
+      return dict(line.split() for line in f if line.strip())
+
+  def _watch_oom(self) -> None:
+    """
+    Wait for the OOM events of the cgroup, which the kernel notifies on
+    `memory.events`, and kill what is left of the process tree on the first
+    OOM kill.
+    """
+    poller = select.poll()
+    with open(
+      os.path.join(self.path, "memory.events"), encoding="utf-8"
+    ) as f:
+      poller.register(f, select.POLLPRI | select.POLLERR)
+      while not self._stopped.is_set():
+        f.seek(0)
+        events = dict(line.split() for line in f if line.strip())
+        if int(events.get("oom_kill", 0)) > 0:
+          logger.info("Evaluation OOM-killed in cgroup %s.", self.path)
+          self.oom_killed = True
+          with contextlib.suppress(OSError):
+            _write(os.path.join(self.path, "cgroup.kill"), "1")
+          return
+        poller.poll(OOM_WATCH_INTERVAL * 1000)
+
+  def watch(self) -> None:
+    self._watcher.start()
+
+  def stop(self) -> None:
+    self._stopped.set()
+    if self._watcher.is_alive():
+      self._watcher.join()
+
+  def exceeded(self, returncode: int, stderr: str) -> bool:
+    return self.oom_killed or int(self._read_events().get("oom_kill", 0)) > 0
+
+
+class CgroupEnforcer:
+  """Runs every evaluation in a child cgroup v2 with `memory.max` set."""
+
+  name = "cgroup"
+
+  def __init__(self, parent: str | None = None):
+    self.parent = parent or _own_cgroup()
+
+  def setup(self) -> None:
+    """
+    Enable the memory controller for the child cgroups. A cgroup v2 with
+    processes cannot delegate controllers, so the processes of the sandbox
+    move to a `hive-server` leaf first.
+    """
+    with open(
+      os.path.join(self.parent, "cgroup.controllers"), encoding="utf-8"
+    ) as f:
+      if "memory" not in f.read().split():
+        raise OSError("The memory controller is not available.")
+
+    server_dir = os.path.join(self.parent, "hive-server")
+    os.makedirs(server_dir, exist_ok=True)
+    with open(os.path.join(self.parent, "cgroup.procs"), encoding="utf-8") as f:
+      pids = f.read().split()
+    moved = []
+    try:
+      for pid in pids:
+        try:
+          _write(os.path.join(server_dir, "cgroup.procs"), pid)
+        except ProcessLookupError:
+          continue  # Exited meanwhile
+        moved.append(pid)
+      _write(os.path.join(self.parent, "cgroup.subtree_control"), "+memory")
+    except OSError:
+      # Leave the hierarchy as it was.
+      for pid in moved:
+        with contextlib.suppress(OSError):
+          _write(os.path.join(self.parent, "cgroup.procs"), pid)
+      with contextlib.suppress(OSError):
+        os.rmdir(server_dir)
+      raise
+
+  @contextlib.contextmanager
+  def limit(self, limit_mb: int | None):
+    if not limit_mb:
+      yield MemoryLimit()
+      return
+
+    path = os.path.join(self.parent, f"hive-eval-{uuid.uuid4().hex}")
+    os.mkdir(path)
+    try:
+      _write(os.path.join(path, "memory.max"), str(limit_mb * 1024 * 1024))
+      # Swapping would let the process tree exceed the limit unnoticed.
+      if os.path.exists(os.path.join(path, "memory.swap.max")):
+        _write(os.path.join(path, "memory.swap.max"), "0")
+      # Kill the whole process tree, not a single process, on OOM.
+      _write(os.path.join(path, "memory.oom.group"), "1")
+      limit = CgroupLimit(path)
+      limit.watch()
+      try:
+        yield limit
+      finally:
+        limit.stop()
+    finally:
+      _remove_cgroup(path)
+
+
+def _own_cgroup() -> str:
+  with open("/proc/self/cgroup", encoding="utf-8") as f:
+    for line in f:
+      hierarchy, _, path = line.strip().split(":", 2)
+      if hierarchy == "0":
+        return os.path.join(CGROUP_ROOT, path.lstrip("/"))
+  raise OSError("Not running in a cgroup v2 hierarchy.")
+
+
+def _write(path: str, value: str) -> None:
+  with open(path, "w", encoding="utf-8") as f:
+    f.write(value)
+
+
+def _remove_cgroup(path: str, timeout: float = 5.0) -> None:
+  """Kill the processes left in the cgroup at `path` and remove it."""
+  kill_file = os.path.join(path, "cgroup.kill")
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      os.rmdir(path)
+      return
+    except FileNotFoundError:
+      return
+    except OSError:
+      # Still populated, e.g. by background processes of the evaluator.
+      if time.monotonic() > deadline:
+        logger.warning("Failed to remove cgroup %s.", path)
+        return
+    if os.path.exists(kill_file):
+      _write(kill_file, "1")
+    else:
+      with open(os.path.join(path, "cgroup.procs"), encoding="utf-8") as f:
+        for pid in f.read().split():
+          with contextlib.suppress(ProcessLookupError):
+            os.kill(int(pid), signal.SIGKILL)
+    time.sleep(0.01)
+
+
+@contextlib.contextmanager
+def limit(limit_mb: int | None):
+  """
+  The `MemoryLimit` of an evaluation limited to `limit_mb`, if any. The
+  enforcer is only set up once a limit is requested.
+  """
+  if not limit_mb:
+    yield MemoryLimit()
+    return
+  with enforcer().limit(limit_mb) as memory_limit:
+    yield memory_limit
+
+
+@functools.cache
+def enforcer():
+  """The enforcer selected with `MEMORY_ENFORCEMENT`, set up on first use."""
+  name = os.getenv("MEMORY_ENFORCEMENT", "auto")
+  if name == "poll":
+    return PollEnforcer()
+  if name == "rlimit":
+    return RlimitEnforcer()
+
+  try:
+    cgroup = CgroupEnforcer()
+    cgroup.setup()
+  except (OSError, ValueError) as e:
+    if name == "cgroup":
+      raise
+    logger.info("cgroup memory limits are unavailable (%s), polling.", e)
+    return PollEnforcer()
+  logger.info("Enforcing memory limits with cgroups under %s.", cgroup.parent)
+  return cgroup
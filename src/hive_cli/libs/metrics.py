@@ -0,0 +1,85 @@
+"""
+Prometheus metrics of the sandbox server, exposed on `/metrics`.
+
+When `PROMETHEUS_MULTIPROC_DIR` is set (`serve.py` does it for gunicorn), the
+metrics of all worker processes are aggregated.
+"""
+
+import os
+
+from prometheus_client import (
+  CONTENT_TYPE_LATEST,
+  REGISTRY,
+  CollectorRegistry,
+  Counter,
+  Gauge,
+  Histogram,
+  generate_latest,
+  multiprocess,
+)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+_BUCKETS = (
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+  1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0,
+)  # fmt: skip
+
+# Stages: "decode" (request body), "parse" (fields and code deltas), "queue"
+# (waiting for a slot), "overlay" (build), "run" (evaluator process), "spawn"
+# (starting the evaluator process, part of "run"), "fallback" (reading partial
+# results or the checkpoint) and "evaluation" (everything after the request
+# body was decoded).
+STAGE_SECONDS = Histogram(
+  "sandbox_stage_seconds",
+  "Duration of the stages of an evaluation.",
+  ["stage"],
+  buckets=_BUCKETS,
+)
+EVALUATIONS = Counter(
+  "sandbox_evaluations_total",
+  "Evaluations by outcome: success, cached, failed, cancelled, invalid or "
+  "error.",
+  ["outcome"],
+)
+PROCESS_FAILURES = Counter(
+  "sandbox_process_failures_total",
+  "Failed evaluator processes by reason: timeout, memory, crash or error.",
+  ["reason"],
+)
+FALLBACKS = Counter(
+  "sandbox_fallbacks_total",
+  "Failed evaluator processes whose partial results or checkpoint were "
+  "recovered, or not.",
+  ["result"],
+)
+REJECTIONS = Counter(
+  "sandbox_rejections_total",
+  "Requests rejected by admission control: queue_full, queue_timeout or "
+  "pool_timeout (no fork server of the worker pool was free in time).",
+  ["reason"],
+)
+QUEUED = Gauge(
+  "sandbox_queued_requests",
+  "Requests waiting for an evaluation slot.",
+  multiprocess_mode="livesum",
+)
+RUNNING = Gauge(
+  "sandbox_running_evaluations",
+  "Evaluations holding a slot.",
+  multiprocess_mode="livesum",
+)
+
+
+def stage(name: str):
+  """Time the `with` block as stage `name`."""
+  return STAGE_SECONDS.labels(name).time()
+
+
+def render() -> bytes:
+  """The metrics in the Prometheus text format."""
+  if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+  return generate_latest(REGISTRY)
@@ -1,12 +1,77 @@
 """Overlays a directory structure (mimics the bevaviour of mount overlayfs)."""
 
+import contextlib
+import ctypes
+import fcntl
+import logging
 import os
+import queue
 import shutil
+import tempfile
+import threading
 from collections.abc import Sequence
 
+# ioctl(2) request to share the extents of a file (Linux, btrfs/XFS/...).
+FICLONE = 0x40049409
+MNT_DETACH = 2
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryIndex:
+  """
+  Caches directory listings and file contents read from a base directory, so
+  that building an overlay does not list and stat the same directories for
+  every request.
+
+  Entries are validated with a single `stat` on each use: a directory listing
+  is refreshed when the directory's mtime changes (i.e. entries were added,
+  removed or renamed), and file contents when the file's mtime or size does.
+  """
+
+  def __init__(self):
+    self._listings: dict[str, tuple[int, list[tuple[str, bool]]]] = {}
+    self._files: dict[str, tuple[tuple[int, int], str]] = {}
+
+  def warm(self, base_dir: str) -> None:
+    """Index every directory under `base_dir` ahead of the first request."""
+    for name, is_dir in self.list_dir(base_dir):
+      if name == ".git":
+        continue
+      if is_dir and not os.path.islink(os.path.join(base_dir, name)):
+        self.warm(os.path.join(base_dir, name))
+
+  def list_dir(self, path: str) -> list[tuple[str, bool]]:
+    """Return the (name, is_dir) entries of the directory at `path`."""
+    mtime = os.stat(path).st_mtime_ns
+    cached = self._listings.get(path)
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+
+    with os.scandir(path) as it:
+      entries = [(entry.name, entry.is_dir()) for entry in it]
+    self._listings[path] = (mtime, entries)
+    return entries
+
+  def read_text(self, path: str) -> str:
+    """Return the content of the text file at `path`."""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = self._files.get(path)
+    if cached is not None and cached[0] == version:
+      return cached[1]
+
+    with open(path, encoding="utf-8") as f:
+      content = f.read()
+    self._files[path] = (version, content)
+    return content
+
 
 def mirror_overlay(
-  base_dir: str, overlay_dir: str, target_file_relatives: Sequence[str]
+  base_dir: str,
+  overlay_dir: str,
+  target_file_relatives: Sequence[str],
+  index: DirectoryIndex | None = None,
 ) -> None:
   """
   Mirror base_dir into overlay_dir so that:
@@ -19,7 +84,11 @@ def mirror_overlay(
   :param overlay_dir: Where to create the overlay.
   :param target_file_relatives: A list of relative paths (from base_dir) to
     files to be overridden.
+  :param index: Cached listings of base_dir, shared across overlays.
   """
+  if index is None:
+    index = DirectoryIndex()
+
   # Normalize and decompose each target path into parts
   target_parts_set = set(
     tuple(rel_path.split(os.sep)) for rel_path in target_file_relatives
@@ -31,7 +100,7 @@ def mirror_overlay(
   os.makedirs(overlay_dir, exist_ok=True)
 
   # Process the top-level of base_dir.
-  for item in os.listdir(base_dir):
+  for item, is_dir in index.list_dir(base_dir):
     base_item = os.path.join(base_dir, item)
     overlay_item = os.path.join(overlay_dir, item)
 
@@ -41,8 +110,8 @@ def mirror_overlay(
     ]
 
     if sub_targets:
-      if os.path.isdir(base_item):
-        process_target_paths(base_item, overlay_item, sub_targets)
+      if is_dir:
+        process_target_paths(base_item, overlay_item, sub_targets, index)
       else:
         # File is itself a target, skip linking it
         continue
@@ -52,7 +121,10 @@ def mirror_overlay(
 
 
 def process_target_paths(
-  curr_base: str, curr_overlay: str, target_parts_list: Sequence[Sequence[str]]
+  curr_base: str,
+  curr_overlay: str,
+  target_parts_list: Sequence[Sequence[str]],
+  index: DirectoryIndex,
 ) -> None:
   """
   Recursively process the directory at curr_base, preserving real dirs for
@@ -61,13 +133,14 @@ def process_target_paths(
   :param curr_overlay: The corresponding overlay directory to populate.
   :param target_parts_list: A list of remaining path parts to target files under
     this subtree.
+  :param index: Cached listings of the base directory.
   """
   os.makedirs(curr_overlay, exist_ok=True)
 
   # Collect items that are on at least one target path
   items_on_target_path = set(parts[0] for parts in target_parts_list if parts)
 
-  for item in os.listdir(curr_base):
+  for item, is_dir in index.list_dir(curr_base):
     base_item = os.path.join(curr_base, item)
     overlay_item = os.path.join(curr_overlay, item)
 
@@ -77,8 +150,8 @@ def process_target_paths(
         parts[1:] for parts in target_parts_list if parts and parts[0] == item
       ]
 
-      if os.path.isdir(base_item):
-        process_target_paths(base_item, overlay_item, sub_targets)
+      if is_dir:
+        process_target_paths(base_item, overlay_item, sub_targets, index)
       else:
         # This file is a target — skip symlinking
         continue
@@ -98,13 +171,7 @@ def materialize_overrides(
     content.
   """
   for rel_path, content in file_content_map.items():
-    # Validate and sanitize the relative path
-    normalized_path = os.path.normpath(rel_path)
-    if normalized_path.startswith(os.sep) or ".." in normalized_path.split(
-      os.sep
-    ):
-      raise ValueError(f"Invalid relative path detected: {rel_path}")
-    full_path = os.path.join(overlay_dir, normalized_path)
+    full_path = os.path.join(overlay_dir, _normalize_relative(rel_path))
 
     parent_dir = os.path.dirname(full_path)
 
@@ -120,10 +187,21 @@ def materialize_overrides(
       f.write(content)
 
 
+def _normalize_relative(rel_path: str) -> str:
+  """Validate and sanitize a relative path of the overlay."""
+  normalized_path = os.path.normpath(rel_path)
+  if normalized_path.startswith(os.sep) or ".." in normalized_path.split(
+    os.sep
+  ):
+    raise ValueError(f"Invalid relative path detected: {rel_path}")
+  return normalized_path
+
+
 def mirror_overlay_and_overwrite(
   base_dir: str,
   overlay_dir: str,
   file_content_map: dict[str, str],
+  index: DirectoryIndex | None = None,
 ) -> None:
   """
   Create an overlay of base_dir into overlay_dir, then overwrite specified files
@@ -133,6 +211,391 @@ def mirror_overlay_and_overwrite(
   :param overlay_dir: Where to create the overlay.
   :param file_content_map: Dict[str, str], mapping from relative file path to
     content to overwrite.
+  :param index: Cached listings of base_dir, shared across overlays.
   """
-  mirror_overlay(base_dir, overlay_dir, file_content_map.keys())
+  mirror_overlay(base_dir, overlay_dir, file_content_map.keys(), index)
   materialize_overrides(overlay_dir, file_content_map)
+
+
+class SymlinkOverlay:
+  """
+  Overlay backend mirroring the base directory with symlinks, see
+  `mirror_overlay`. Works everywhere, but setup time grows with the number of
+  entries along the override paths and tools that resolve symlinks escape the
+  overlay.
+  """
+
+  name = "symlink"
+
+  def available(self, base_dir: str, work_dir: str) -> bool:
+    return True
+
+  @contextlib.contextmanager
+  def overlay(
+    self,
+    base_dir: str,
+    overlay_dir: str,
+    file_content_map: dict[str, str],
+    index: DirectoryIndex | None = None,
+  ):
+    """Populate `overlay_dir` for the duration of the `with` block."""
+    mirror_overlay_and_overwrite(base_dir, overlay_dir, file_content_map, index)
+    yield overlay_dir
+
+
+class ReflinkOverlay(SymlinkOverlay):
+  """
+  Overlay backend copying the base directory with reflinks (copy-on-write
+  clones sharing the file extents), so the overlay holds real files that can
+  be modified without touching the base directory. Requires the base and
+  overlay directories to live on the same reflink-capable filesystem.
+  """
+
+  name = "reflink"
+
+  def available(self, base_dir: str, work_dir: str) -> bool:
+    sample = next(
+      (
+        os.path.join(base_dir, name)
+        for name in sorted(os.listdir(base_dir))
+        if os.path.isfile(os.path.join(base_dir, name))
+      ),
+      None,
+    )
+    if sample is None:
+      return False
+    with tempfile.TemporaryDirectory(dir=work_dir) as probe_dir:
+      try:
+        _reflink(sample, os.path.join(probe_dir, "probe"))
+      except OSError:
+        return False
+    return True
+
+  @contextlib.contextmanager
+  def overlay(
+    self,
+    base_dir: str,
+    overlay_dir: str,
+    file_content_map: dict[str, str],
+    index: DirectoryIndex | None = None,
+  ):
+    _reflink_tree(base_dir, overlay_dir, index or DirectoryIndex())
+    materialize_overrides(overlay_dir, file_content_map)
+    yield overlay_dir
+
+
+class KernelOverlay(SymlinkOverlay):
+  """
+  Overlay backend mounting a real overlayfs with the base directory as the
+  lower layer and the overrides written to the upper layer beforehand, so
+  setup time does not depend on the size of the base directory.
+
+  Requires CAP_SYS_ADMIN, and `scratch_dir` (holding the upper layers) must not
+  itself be on an overlayfs, e.g. a tmpfs or emptyDir volume.
+  """
+
+  name = "overlayfs"
+
+  def __init__(self, scratch_dir: str | None = None):
+    self.scratch_dir = scratch_dir
+
+  def available(self, base_dir: str, work_dir: str) -> bool:
+    with tempfile.TemporaryDirectory(dir=work_dir) as probe_dir:
+      try:
+        with self.overlay(base_dir, probe_dir, {}):
+          return True
+      except OSError as e:
+        logger.info("overlayfs is unavailable: %s", e)
+        return False
+
+  @contextlib.contextmanager
+  def overlay(
+    self,
+    base_dir: str,
+    overlay_dir: str,
+    file_content_map: dict[str, str],
+    index: DirectoryIndex | None = None,
+  ):
+    with tempfile.TemporaryDirectory(dir=self.scratch_dir) as layers_dir:
+      upper_dir = os.path.join(layers_dir, "upper")
+      work_dir = os.path.join(layers_dir, "work")
+      os.makedirs(upper_dir)
+      os.makedirs(work_dir)
+      materialize_overrides(upper_dir, file_content_map)
+
+      _mount(
+        "overlay",
+        overlay_dir,
+        "overlay",
+        f"lowerdir={os.path.abspath(base_dir)},upperdir={upper_dir},"
+        f"workdir={work_dir}",
+      )
+      try:
+        yield overlay_dir
+      finally:
+        _umount(overlay_dir)
+
+
+class Workspace:
+  """
+  A persistent symlink overlay of `base_dir` at `path`, see `mirror_overlay`.
+
+  Instead of being rebuilt for every evaluation, the workspace is `reset`: the
+  directories expanded for earlier overrides are scanned, and any entry which
+  is not the symlink to its base entry (overridden files, evaluator outputs)
+  is removed and relinked.
+  """
+
+  def __init__(self, base_dir: str, path: str, index: DirectoryIndex):
+    self.base_dir = os.path.abspath(base_dir)
+    self.path = path
+    self.index = index
+    # Relative paths of the real directories of the workspace, "" is the root.
+    self.expanded = {""}
+    os.makedirs(path, exist_ok=True)
+    self.reset()
+
+  def prepare(self, file_content_map: dict[str, str]) -> None:
+    """Override the files of `file_content_map` in a clean workspace."""
+    for rel_path in file_content_map:
+      parts = _normalize_relative(rel_path).split(os.sep)
+      for depth in range(1, len(parts)):
+        self._expand(os.path.join(*parts[:depth]))
+    materialize_overrides(self.path, file_content_map)
+
+  def _expand(self, rel_dir: str) -> None:
+    """Replace the symlink to the base directory `rel_dir` by a real one."""
+    if rel_dir in self.expanded:
+      return
+    base = os.path.join(self.base_dir, rel_dir)
+    path = os.path.join(self.path, rel_dir)
+    if not os.path.isdir(base):
+      return  # A new directory, created (and later removed) as a whole
+    # A symlinked directory is expanded too (into links to the entries of its
+    # target), or the overrides would be written through it into the base.
+    os.unlink(path)
+    os.mkdir(path)
+    for name, _ in self.index.list_dir(base):
+      os.symlink(os.path.join(base, name), os.path.join(path, name))
+    self.expanded.add(rel_dir)
+
+  def _collapse(self, rel_dir: str) -> None:
+    self.expanded = {
+      rel
+      for rel in self.expanded
+      if rel != rel_dir and not rel.startswith(rel_dir + os.sep)
+    }
+
+  def reset(self) -> None:
+    """Restore the workspace to a plain mirror of the base directory."""
+    # Parents first, so that collapsed directories are skipped.
+    for rel_dir in sorted(
+      self.expanded, key=lambda rel: (rel.count(os.sep), rel)
+    ):
+      if rel_dir not in self.expanded:
+        continue
+      base = os.path.join(self.base_dir, rel_dir)
+      path = os.path.join(self.path, rel_dir)
+      expected = {
+        name: os.path.join(base, name) for name, _ in self.index.list_dir(base)
+      }
+
+      present = set()
+      with os.scandir(path) as it:
+        entries = list(it)
+      for entry in entries:
+        child = os.path.join(rel_dir, entry.name)
+        if child in self.expanded and entry.is_dir(follow_symlinks=False):
+          present.add(entry.name)
+        elif entry.is_symlink() and os.readlink(entry.path) == expected.get(
+          entry.name
+        ):
+          present.add(entry.name)
+        elif entry.is_dir(follow_symlinks=False):
+          shutil.rmtree(entry.path)
+        else:
+          os.unlink(entry.path)
+
+      for name, target in expected.items():
+        if name not in present:
+          os.symlink(target, os.path.join(path, name))
+          self._collapse(os.path.join(rel_dir, name))
+
+
+class WorkspacePool:
+  """
+  Reusable symlink overlays of `base_dir`, kept under `root_dir` (e.g. a
+  tmpfs). Workspaces are reset in a background thread once released, so
+  neither building nor deleting overlays is on the request path. The pool
+  grows beyond `size` when all workspaces are busy.
+  """
+
+  def __init__(
+    self,
+    base_dir: str,
+    root_dir: str,
+    size: int,
+    index: DirectoryIndex | None = None,
+  ):
+    self.base_dir = base_dir
+    self.root_dir = root_dir
+    self.index = index or DirectoryIndex()
+    self._count = 0
+    self._lock = threading.Lock()
+    self._idle = queue.SimpleQueue()
+    self._dirty = queue.SimpleQueue()
+
+    os.makedirs(root_dir, exist_ok=True)
+    for _ in range(size):
+      self._idle.put(self._create())
+    threading.Thread(
+      target=self._clean, name="workspace-cleaner", daemon=True
+    ).start()
+
+  @property
+  def idle(self) -> int:
+    """The number of clean workspaces, ready for an evaluation."""
+    return self._idle.qsize()
+
+  def _create(self) -> Workspace:
+    with self._lock:
+      self._count += 1
+      path = os.path.join(self.root_dir, f"workspace-{self._count}")
+    if os.path.lexists(path):  # Left over by an earlier server
+      shutil.rmtree(path)
+    return Workspace(self.base_dir, path, self.index)
+
+  def _clean(self) -> None:
+    while True:
+      workspace = self._dirty.get()
+      try:
+        workspace.reset()
+      except OSError:
+        logger.exception("Failed to reset %s, dropping it.", workspace.path)
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        continue
+      self._idle.put(workspace)
+
+  @contextlib.contextmanager
+  def overlay(self, file_content_map: dict[str, str]):
+    """Yield the path of a workspace with `file_content_map` overridden."""
+    try:
+      workspace = self._idle.get_nowait()
+    except queue.Empty:
+      workspace = self._create()
+    try:
+      workspace.prepare(file_content_map)
+      yield workspace.path
+    finally:
+      self._dirty.put(workspace)
+
+
+def remove_stale_workspace_dirs(parent_dir: str) -> None:
+  """
+  Delete the workspace directories of `parent_dir` (named after the pid of
+  their server process) whose process is gone, e.g. before a restart.
+  """
+  try:
+    names = os.listdir(parent_dir)
+  except FileNotFoundError:
+    return
+  for name in names:
+    if not name.isdigit():
+      continue
+    try:
+      os.kill(int(name), 0)
+      continue
+    except ProcessLookupError:
+      pass
+    except PermissionError:  # Alive, as another user
+      continue
+    path = os.path.join(parent_dir, name)
+    logger.info("Removing the workspaces of the exited server %s.", name)
+    if os.path.ismount(path):
+      with contextlib.suppress(OSError):
+        _umount(path)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def mount_tmpfs(path: str, size: str) -> None:
+  """Mount a tmpfs of `size` (e.g. "512m") at `path`."""
+  os.makedirs(path, exist_ok=True)
+  _mount("tmpfs", path, "tmpfs", f"size={size},mode=0755")
+
+
+OVERLAY_BACKENDS = {
+  backend.name: backend
+  for backend in (KernelOverlay, ReflinkOverlay, SymlinkOverlay)
+}
+
+
+def select_backend(
+  base_dir: str,
+  work_dir: str = ".",
+  name: str = "auto",
+  scratch_dir: str | None = None,
+  workspace_pool: bool = False,
+) -> SymlinkOverlay:
+  """
+  Return the overlay backend called `name`. With "auto", that is overlayfs if
+  it works for overlays of `base_dir` created under `work_dir`, else symlink,
+  which is also what a `workspace_pool` needs. Reflink copies every file for
+  every overlay and is only used when asked for.
+  """
+  if name != "auto":
+    logger.info("Using the %s overlay backend, as configured.", name)
+    if name == KernelOverlay.name:
+      return KernelOverlay(scratch_dir)
+    return OVERLAY_BACKENDS[name]()
+
+  if workspace_pool:
+    logger.info("Using the symlink overlay backend for the workspace pool.")
+    return SymlinkOverlay()
+  backend = KernelOverlay(scratch_dir)
+  try:
+    if os.path.isdir(base_dir) and backend.available(base_dir, work_dir):
+      logger.info("Using the overlayfs overlay backend.")
+      return backend
+  except OSError as e:
+    logger.info("overlayfs is unavailable: %s", e)
+  logger.info("Using the symlink overlay backend, overlayfs is unavailable.")
+  return SymlinkOverlay()
+
+
+def _reflink(src: str, dst: str) -> None:
+  with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+    fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+  shutil.copymode(src, dst)
+
+
+def _reflink_tree(base_dir: str, overlay_dir: str, index: DirectoryIndex):
+  os.makedirs(overlay_dir, exist_ok=True)
+  for item, is_dir in index.list_dir(base_dir):
+    base_item = os.path.join(base_dir, item)
+    overlay_item = os.path.join(overlay_dir, item)
+
+    # Symlinks and the (never modified) git metadata are linked as-is.
+    if item == ".git" or os.path.islink(base_item):
+      os.symlink(base_item, overlay_item)
+    elif is_dir:
+      _reflink_tree(base_item, overlay_item, index)
+    else:
+      _reflink(base_item, overlay_item)
+
+
+def _libc():
+  return ctypes.CDLL(None, use_errno=True)
+
+
+def _mount(source: str, target: str, fstype: str, options: str) -> None:
+  if _libc().mount(
+    source.encode(), target.encode(), fstype.encode(), 0, options.encode()
+  ):
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno), target)
+
+
+def _umount(target: str) -> None:
+  if _libc().umount2(target.encode(), MNT_DETACH):
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno), target)
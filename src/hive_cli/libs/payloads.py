@@ -0,0 +1,175 @@
+"""
+Decoding of compressed and delta-encoded `/run_code` payloads.
+
+Request bodies may be sent with `Content-Encoding: gzip` or `zstd`. In the
+`code` map, a file can be given either as its full content or as a delta:
+
+  {"base": "repo", "commit": <optional sha>, "edits": [[start, end, text]]}
+  {"base": <sha256 of a previously sent content>, "edits": [...]}
+
+where every edit replaces the lines `start:end` (0-based, end exclusive) of the
+base content with `text`. Edits refer to the base line numbers and must not
+overlap. The base is either the file in the repository, or any content the
+sandbox received (or resolved) recently, addressed by its SHA-256.
+"""
+
+import collections
+import hashlib
+import io
+import threading
+import zlib
+from collections.abc import Callable
+
+try:
+  import zstandard
+except ImportError:  # Only needed for zstd-encoded requests
+  zstandard = None
+
+# Upper bound of a decompressed request body.
+MAX_DECOMPRESSED_BYTES = 256 * 1024 * 1024
+
+
+class PayloadError(Exception):
+  """Raised when a payload cannot be decoded, with the HTTP status to use."""
+
+  def __init__(self, message: str, status: int = 400):
+    super().__init__(message)
+    self.status = status
+
+
+class UnknownBaseError(PayloadError):
+  """Raised when a delta refers to content the sandbox does not have."""
+
+  def __init__(self, message: str):
+    super().__init__(message, status=409)
+
+
+def content_hash(content: str) -> str:
+  return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def decode_body(data: bytes, encoding: str) -> bytes:
+  """Decompress a request body sent with `Content-Encoding: <encoding>`."""
+  encoding = encoding.strip().lower()
+  if encoding in ("", "identity"):
+    return data
+
+  if encoding in ("gzip", "x-gzip"):
+    try:
+      decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+      body = decompressor.decompress(data, MAX_DECOMPRESSED_BYTES + 1)
+    except zlib.error as e:
+      raise PayloadError(f"Invalid gzip body: {e}") from e
+  elif encoding == "zstd":
+    if zstandard is None:
+      raise PayloadError("zstd bodies are not supported.", status=415)
+    try:
+      with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as r:
+        body = r.read(MAX_DECOMPRESSED_BYTES + 1)
+    except zstandard.ZstdError as e:
+      raise PayloadError(f"Invalid zstd body: {e}") from e
+  else:
+    raise PayloadError(f"Unsupported Content-Encoding: {encoding}", status=415)
+
+  if len(body) > MAX_DECOMPRESSED_BYTES:
+    raise PayloadError("Decompressed body is too large.", status=413)
+  return body
+
+
+class ContentStore:
+  """The most recently seen file contents by hash, up to `max_bytes` total."""
+
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._contents = collections.OrderedDict()  # hash -> content, oldest first
+    self._lock = threading.Lock()
+
+  def get(self, key: str) -> str | None:
+    with self._lock:
+      content = self._contents.get(key)
+      if content is not None:
+        self._contents.move_to_end(key)
+      return content
+
+  def put(self, content: str) -> str:
+    key = content_hash(content)
+    with self._lock:
+      if key in self._contents:
+        self._contents.move_to_end(key)
+        return key
+      if len(content) > self.max_bytes:
+        return key
+      self._contents[key] = content
+      self.size += len(content)
+      while self.size > self.max_bytes:
+        _, old = self._contents.popitem(last=False)
+        self.size -= len(old)
+    return key
+
+
+def apply_edits(base: str, edits: list) -> str:
+  """Apply line-range `edits` (see the module docstring) to `base`."""
+  lines = base.splitlines(keepends=True)
+  previous_start = len(lines)
+  for edit in sorted(edits, key=lambda e: (e[0], e[1]), reverse=True):
+    try:
+      start, end, text = edit
+    except (TypeError, ValueError) as e:
+      raise PayloadError(f"Invalid edit: {edit}") from e
+    if not (
+      isinstance(start, int)
+      and isinstance(end, int)
+      and isinstance(text, str)
+      and 0 <= start <= end <= previous_start
+    ):
+      raise PayloadError(f"Invalid or overlapping edit: {edit}")
+    lines[start:end] = [text]
+    previous_start = start
+  return "".join(lines)
+
+
+def resolve_code(
+  code: dict,
+  read_repo_file: Callable[[str], str],
+  store: ContentStore,
+  repo_commit: str = "",
+) -> dict[str, str]:
+  """
+  Resolve the deltas in a `code` map to full contents, remembering every
+  content in `store` so that later requests can use it as a base.
+
+  :param read_repo_file: Returns the content of a repository file by path.
+  :param repo_commit: Commit of the repository, checked against the commit a
+    delta was computed for.
+  """
+  resolved = {}
+  for path, value in (code or {}).items():
+    if isinstance(value, str):
+      content = value
+    elif isinstance(value, dict):
+      base_ref = value.get("base", "repo")
+      if base_ref == "repo":
+        commit = value.get("commit")
+        if commit and repo_commit and commit != repo_commit:
+          raise UnknownBaseError(
+            f"Delta for {path} is against commit {commit}, the sandbox has "
+            f"{repo_commit}."
+          )
+        try:
+          base = read_repo_file(path)
+        except FileNotFoundError as e:
+          raise UnknownBaseError(f"{path} does not exist in the repo.") from e
+        except IsADirectoryError as e:
+          raise PayloadError(f"{path} is a directory in the repo.") from e
+      else:
+        base = store.get(base_ref)
+        if base is None:
+          raise UnknownBaseError(f"Unknown base content {base_ref} for {path}.")
+      content = apply_edits(base, value.get("edits", []))
+    else:
+      raise PayloadError(f"Invalid content for {path}.")
+
+    store.put(content)
+    resolved[path] = content
+  return resolved
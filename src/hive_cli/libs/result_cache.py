@@ -0,0 +1,95 @@
+"""A content-addressed, size-bounded on-disk cache of evaluation results."""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(**inputs) -> str:
+  """Hash the (JSON-serializable) inputs of an evaluation."""
+  payload = json.dumps(inputs, sort_keys=True, separators=(",", ":"))
+  return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+  """
+  Stores results as files named by their key under `directory`, evicting the
+  least recently used ones once they take more than `max_bytes`.
+
+  The recency order is kept in memory and rebuilt from the file mtimes at
+  startup, so it survives restarts of the sandbox.
+  """
+
+  def __init__(self, directory: str, max_bytes: int):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._entries = collections.OrderedDict()  # key -> size, oldest first
+    self._lock = threading.Lock()
+
+    os.makedirs(directory, exist_ok=True)
+    existing = []
+    for name in os.listdir(directory):
+      if name.startswith("."):  # A pending write, see `put`
+        continue
+      try:
+        stat = os.stat(os.path.join(directory, name))
+      except FileNotFoundError:
+        continue
+      existing.append((stat.st_mtime, name, stat.st_size))
+    for _, key, size in sorted(existing):
+      self._entries[key] = size
+      self.size += size
+    logger.info(
+      "Result cache in %s holds %d entries (%d bytes).",
+      directory,
+      len(self._entries),
+      self.size,
+    )
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self.directory, key)
+
+  def get(self, key: str) -> str | None:
+    """Return the result stored under `key`, if any."""
+    try:
+      with open(self._path(key), encoding="utf-8") as f:
+        result = f.read()
+      # Keep the recency order across restarts.
+      os.utime(self._path(key))
+    except FileNotFoundError:  # Possibly evicted by another worker meanwhile
+      return None
+
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+    return result
+
+  def put(self, key: str, result: str) -> None:
+    """Store `result` under `key`, evicting old entries as needed."""
+    data = result.encode("utf-8")
+    if len(data) > self.max_bytes:
+      return
+
+    # Write atomically, so that readers never see partial results.
+    fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+    os.replace(temp_path, self._path(key))
+
+    with self._lock:
+      self.size += len(data) - self._entries.pop(key, 0)
+      self._entries[key] = len(data)
+      while self.size > self.max_bytes:
+        old_key, old_size = self._entries.popitem(last=False)
+        self.size -= old_size
+        try:
+          os.unlink(self._path(old_key))
+        except FileNotFoundError:
+          pass
@@ -0,0 +1,102 @@
+"""
+The structured result channel between evaluators and the sandbox.
+
+Instead of printing its result, an evaluator may append JSON lines to
+`RESULT_FILE` in its working directory, e.g. one `{"score": ...}` record per
+finished stage of a long run. The records written so far can be polled while
+the evaluator runs (`GET /run_code/<id>/records`), and once it exits the
+server answers with a typed response:
+
+  {"output": <last record>, "metainfo": "Result", "final": true,
+   "records": <number of records>}
+
+When the evaluator fails (e.g. times out) after writing records, the last one
+is returned with `"final": false` and the error in `metainfo`, so the
+coordinator still gets the partial score and can prune the candidate early.
+Evaluators that write no records keep their stdout returned verbatim.
+
+Every evaluation starts without `RESULT_FILE` and `CHECKPOINT_FILE`, even if
+the repository has them, see `reset`.
+"""
+
+import json
+import os
+
+RESULT_FILE = "hive_results.jsonl"
+CHECKPOINT_FILE = "checkpoint.json"
+
+_NOT_FOUND = object()
+
+
+def reset(directory: str, keep=()) -> None:
+  """
+  Remove `RESULT_FILE` and `CHECKPOINT_FILE` from the overlay `directory`,
+  except the ones in `keep`. Their evaluator then creates them as files of its
+  own, rather than writing through the links of a symlink overlay to the
+  repository, or appending to the records committed there.
+  """
+  for name in (RESULT_FILE, CHECKPOINT_FILE):
+    path = os.path.join(directory, name)
+    if name not in keep and os.path.lexists(path):
+      os.unlink(path)
+
+
+def read_records(directory: str) -> list:
+  """
+  The records written to the result channel in `directory`. A trailing line
+  which is not valid JSON, e.g. because the evaluator was killed while writing
+  it, is ignored.
+  """
+  try:
+    with open(os.path.join(directory, RESULT_FILE), encoding="utf-8") as f:
+      lines = [line for line in f if line.strip()]
+  except FileNotFoundError:
+    return []
+
+  records = []
+  for i, line in enumerate(lines):
+    try:
+      records.append(json.loads(line))
+    except ValueError:
+      if i < len(lines) - 1:
+        raise
+  return records
+
+
+def response(records: list, error: str | None = None) -> str:
+  """The typed response body for the `records` of an evaluation."""
+  return json.dumps(
+    {
+      "output": records[-1],
+      "metainfo": "Result" if error is None else f"Partial: {error}",
+      "final": error is None,
+      "records": len(records),
+    }
+  )
+
+
+def _read_checkpoint(directory: str):
+  """The JSON data of the evaluator's checkpoint file, or `_NOT_FOUND`."""
+  try:
+    with open(os.path.join(directory, CHECKPOINT_FILE), encoding="utf-8") as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return _NOT_FOUND
+
+
+def fallback_response(directory: str, error: str) -> str | None:
+  """
+  The response for a failed evaluation: the partial result from the result
+  channel, else the checkpoint, else None.
+  """
+  try:
+    records = read_records(directory)
+  except ValueError:
+    records = []
+  if records:
+    return response(records, error)
+
+  checkpoint = _read_checkpoint(directory)
+  if checkpoint is not _NOT_FOUND:
+    return json.dumps({"output": checkpoint, "metainfo": "Checkpoint"})
+  return None
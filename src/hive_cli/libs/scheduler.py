@@ -0,0 +1,134 @@
+"""Admission control for concurrent evaluations on a sandbox."""
+
+import collections
+import contextlib
+import math
+import os
+import threading
+
+CGROUP_DIR = "/sys/fs/cgroup"
+
+
+class QueueFullError(Exception):
+  """Raised when all slots are busy and the wait queue is full."""
+
+
+class SlotTimeoutError(Exception):
+  """Raised when a request's deadline passes before a slot frees up."""
+
+
+class SlotScheduler:
+  """
+  Runs at most `slots` evaluations at a time, with up to `queue_size` requests
+  waiting (first come, first served) for a slot to free up.
+  """
+
+  def __init__(self, slots: int, queue_size: int = 0):
+    self.slots = slots
+    self.queue_size = queue_size
+    self.running = 0
+    self._waiting = collections.deque()
+    self._cond = threading.Condition()
+
+  @property
+  def waiting(self) -> int:
+    return len(self._waiting)
+
+  @contextlib.contextmanager
+  def slot(self, timeout: float | None = None):
+    """
+    Hold a slot for the duration of the `with` block.
+
+    :param timeout: Maximum number of seconds to wait in the queue, or None to
+      wait until a slot is free.
+    """
+    self._acquire(timeout)
+    try:
+      yield
+    finally:
+      with self._cond:
+        self.running -= 1
+        self._cond.notify_all()
+
+  def _acquire(self, timeout: float | None) -> None:
+    with self._cond:
+      if not self._waiting and self.running < self.slots:
+        self.running += 1
+        return
+      if len(self._waiting) >= self.queue_size:
+        raise QueueFullError(
+          f"All {self.slots} slots are busy and {self.queue_size} requests "
+          "are already waiting."
+        )
+
+      ticket = object()
+      self._waiting.append(ticket)
+      try:
+        if not self._cond.wait_for(
+          lambda: self._waiting[0] is ticket and self.running < self.slots,
+          timeout,
+        ):
+          raise SlotTimeoutError(
+            f"No evaluation slot became available within {timeout} seconds."
+          )
+        self.running += 1
+      finally:
+        self._waiting.remove(ticket)
+        # The head of the queue changed, let the next waiter re-check.
+        self._cond.notify_all()
+
+
+def _read_cgroup_file(*candidates: str) -> str | None:
+  for name in candidates:
+    try:
+      with open(os.path.join(CGROUP_DIR, name), encoding="utf-8") as f:
+        return f.read().strip()
+    except OSError:
+      continue
+  return None
+
+
+def cpu_limit() -> float:
+  """Number of CPUs available to this container (cgroup v2 or v1)."""
+  cpus = float(len(os.sched_getaffinity(0)))
+
+  cpu_max = _read_cgroup_file("cpu.max")
+  if cpu_max:
+    quota, _, period = cpu_max.partition(" ")
+    if quota != "max":
+      return min(cpus, int(quota) / int(period or 100000))
+    return cpus
+
+  quota = _read_cgroup_file(
+    "cpu/cpu.cfs_quota_us", "cpu,cpuacct/cpu.cfs_quota_us"
+  )
+  period = _read_cgroup_file(
+    "cpu/cpu.cfs_period_us", "cpu,cpuacct/cpu.cfs_period_us"
+  )
+  if quota and period and int(quota) > 0:
+    return min(cpus, int(quota) / int(period))
+  return cpus
+
+
+def memory_limit_mb() -> int | None:
+  """Memory limit of this container in MB (cgroup v2 or v1), if any."""
+  limit = _read_cgroup_file("memory.max", "memory/memory.limit_in_bytes")
+  if not limit or limit == "max":
+    return None
+  limit_mb = int(limit) // (1024 * 1024)
+  # cgroup v1 reports a huge number when unlimited.
+  if limit_mb >= 2**40:
+    return None
+  return limit_mb
+
+
+def default_slots(slot_memory_mb: int | None = None) -> int:
+  """
+  Derive the number of concurrent evaluations from the container limits: one
+  per CPU, and no more than fit into memory when `slot_memory_mb` is given.
+  """
+  slots = max(1, math.floor(cpu_limit()))
+  limit_mb = memory_limit_mb()
+  if slot_memory_mb and limit_mb:
+    slots = min(slots, max(1, limit_mb // slot_memory_mb))
+  return slots
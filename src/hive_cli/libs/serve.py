@@ -0,0 +1,92 @@
+"""
+Entry point of the sandbox server image.
+
+`SERVER_MODE` selects how the app in `main.py` is served:
+
+- "gunicorn" (default): a production server with `SERVER_WORKERS` processes of
+  `SERVER_THREADS` threads each, HTTP keep-alive and, on SIGTERM (e.g. a spot
+  preemption), a graceful drain of in-flight evaluations for up to
+  `SERVER_GRACEFUL_TIMEOUT` seconds. Their metrics are aggregated through
+  `PROMETHEUS_MULTIPROC_DIR` (a temporary directory unless set).
+- "dev": the Flask development server, as `python main.py`.
+
+Concurrent evaluations are served by the threads of a single worker, which is
+the default and the recommended setting. The state of `main.py` is not shared
+between worker processes, so with `SERVER_WORKERS` > 1:
+
+- every worker admits `SANDBOX_SLOTS` evaluations and queues on its own, the
+  pod runs up to `SERVER_WORKERS` times as many;
+- `DELETE /run_code/<id>` and `GET /run_code/<id>/records` only find the
+  evaluations of the worker they land on, and return 404 from the others;
+- the result cache files are shared, but every worker evicts them within its
+  own `RESULT_CACHE_MAX_BYTES`, from its own view of their use;
+- every worker has its own worker pools, workspace pool and overlay index, and
+  runs the warm-up, except the pre-processor which runs once per pod.
+"""
+
+import os
+import runpy
+import sys
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+
+class SandboxApplication(BaseApplication):
+  """Serves `main:app` with gunicorn, configured from `options`."""
+
+  def __init__(self, options: dict):
+    self.options = options
+    super().__init__()
+
+  def load_config(self):
+    for key, value in self.options.items():
+      self.cfg.set(key, value)
+
+  def load(self):
+    # Imported in the workers (after the fork) so that each of them starts its
+    # own fork servers, scheduler and overlay index.
+    import main
+
+    return main.app
+
+
+def child_exit(server, worker):
+  # Drop the live gauges of exited workers from the aggregated metrics.
+  from prometheus_client import multiprocess
+
+  multiprocess.mark_process_dead(worker.pid)
+
+
+def gunicorn_options() -> dict:
+  port = int(os.environ.get("PORT", "8080"))
+  return {
+    "bind": f"0.0.0.0:{port}",
+    "worker_class": "gthread",
+    "workers": int(os.getenv("SERVER_WORKERS", "1")),
+    # Queued requests hold a thread while they wait for an evaluation slot.
+    "threads": int(os.getenv("SERVER_THREADS", "64")),
+    # Keep connections from the coordinator open between evaluations.
+    "keepalive": int(os.getenv("SERVER_KEEPALIVE", "75")),
+    "graceful_timeout": int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30")),
+    "timeout": int(os.getenv("SERVER_TIMEOUT", "120")),
+    "loglevel": os.getenv("SERVER_LOG_LEVEL", "info"),
+    "child_exit": child_exit,
+  }
+
+
+if __name__ == "__main__":
+  if os.getenv("SERVER_MODE", "gunicorn") == "dev":
+    runpy.run_module("main", run_name="__main__")
+  else:
+    if int(os.getenv("SERVER_WORKERS", "1")) > 1:
+      print(
+        "SERVER_WORKERS > 1: evaluation slots, cancellations and the result "
+        "cache eviction are per worker, see serve.py.",
+        file=sys.stderr,
+      )
+    # Must be set before the workers import `prometheus_client`.
+    os.environ.setdefault(
+      "PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="hive-metrics-")
+    )
+    SandboxApplication(gunicorn_options()).run()
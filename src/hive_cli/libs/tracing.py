@@ -0,0 +1,136 @@
+"""
+Lightweight, OpenTelemetry-style tracing of the evaluation hot path.
+
+Spans are only recorded when `TRACE_EXPORTER` is set:
+
+- "none" (default): `span` is a no-op.
+- "file": finished spans are appended as JSON lines to `TRACE_FILE`, with the
+  field names of OTLP spans, for offline analysis.
+
+The trace of a request continues the one of the coordinator when it sends a
+W3C `traceparent` header.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+
+_TRACEPARENT = re.compile(
+  r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$"
+)
+
+
+class Span:
+  """A timed operation of a trace."""
+
+  def __init__(self, name: str, trace_id: str, parent_id: str | None):
+    self.name = name
+    self.trace_id = trace_id
+    self.span_id = os.urandom(8).hex()
+    self.parent_id = parent_id
+    self.attributes = {}
+    self.status = "ok"
+    self.start_time = time.time_ns()
+    self.end_time = None
+
+  def set_attribute(self, key: str, value) -> None:
+    self.attributes[key] = value
+
+  @property
+  def traceparent(self) -> str:
+    return f"00-{self.trace_id}-{self.span_id}-01"
+
+  def to_dict(self) -> dict:
+    return {
+      "trace_id": self.trace_id,
+      "span_id": self.span_id,
+      "parent_span_id": self.parent_id,
+      "name": self.name,
+      "start_time_unix_nano": self.start_time,
+      "end_time_unix_nano": self.end_time,
+      "attributes": self.attributes,
+      "status": self.status,
+    }
+
+
+class _NoopSpan:
+  trace_id = None
+  traceparent = None
+
+  def set_attribute(self, key: str, value) -> None:
+    pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class FileExporter:
+  """Appends finished spans to a JSON lines file."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+
+  def export(self, span: Span) -> None:
+    line = json.dumps(span.to_dict(), default=str) + "\n"
+    with self._lock, open(self.path, "a", encoding="utf-8") as f:
+      f.write(line)
+
+
+def _exporter():
+  name = os.getenv("TRACE_EXPORTER", "none")
+  if name == "file":
+    return FileExporter(os.getenv("TRACE_FILE", "traces.jsonl"))
+  if name != "none":
+    raise ValueError(f"Unknown TRACE_EXPORTER: {name}")
+  return None
+
+
+exporter = _exporter()
+
+# The innermost open span (or remote parent) of the current thread or task.
+_current = contextvars.ContextVar("span", default=None)
+
+
+def parse_traceparent(header: str | None) -> tuple[str, str] | None:
+  """The (trace ID, parent span ID) of a W3C `traceparent` header, if valid."""
+  match = _TRACEPARENT.match((header or "").strip().lower())
+  return (match[1], match[2]) if match else None
+
+
+@contextlib.contextmanager
+def span(name: str, traceparent: str | None = None, **attributes):
+  """
+  Record the `with` block as a span named `name`, child of the current span.
+  A root span continues the trace of the `traceparent` header, if given, or
+  starts a new trace. Yields the span, or a no-op one when tracing is off.
+  """
+  if exporter is None:
+    yield NOOP_SPAN
+    return
+
+  parent = _current.get()
+  if parent is not None:
+    trace_id, parent_id = parent.trace_id, parent.span_id
+  else:
+    trace_id, parent_id = parse_traceparent(traceparent) or (
+      os.urandom(16).hex(),
+      None,
+    )
+  current = Span(name, trace_id, parent_id)
+  current.attributes.update(attributes)
+  token = _current.set(current)
+  try:
+    yield current
+  except BaseException as e:
+    current.status = "error"
+    current.set_attribute("exception", repr(e))
+    raise
+  finally:
+    _current.reset(token)
+    current.end_time = time.time_ns()
+    exporter.export(current)
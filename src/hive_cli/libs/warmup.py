@@ -0,0 +1,195 @@
+"""
+Warm-up of a fresh sandbox before it reports ready on `/ready`.
+
+The steps listed in `WARMUP` (comma-separated) run in order in the background:
+
+- "preprocess": run the `PRE_PROCESSOR` script, whose outputs (in
+  `PRE_PROCESSOR_DATA_DIR`) are cached by repository commit, see `preprocess`.
+  It runs once even with several server processes, and the sandbox never
+  becomes ready if it fails.
+- "compile": compile the bytecode of the repository, if not done in the image.
+- "imports": import the `WARMUP_IMPORTS` modules once, loading them (and their
+  dependencies) into the page cache.
+- "dry_run": run the evaluation script once on the unmodified repository.
+
+Except for "preprocess", failing steps are logged and skipped.
+"""
+
+import fcntl
+import hashlib
+import importlib.util
+import logging
+import os
+import py_compile
+import tarfile
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+
+import common_tools
+
+logger = logging.getLogger(__name__)
+
+# Name of the file marking a data directory as already pre-processed.
+MARKER_FILE = ".hive-preprocessed"
+# Name of the file locked while a data directory is pre-processed.
+LOCK_FILE = ".hive-preprocess.lock"
+
+
+def preprocessor_key(script: str, commit: str) -> str:
+  """Key of the outputs of the pre-processor `script` at repository `commit`."""
+  return hashlib.sha256(f"{commit}\0{script}".encode("utf-8")).hexdigest()
+
+
+def preprocess(
+  script: str,
+  repo_dir: str,
+  data_dir: str,
+  key: str,
+  cache_dir: str | None = None,
+  timeout: float = 3600,
+) -> str:
+  """
+  Run the pre-processor `script` with `python -c` in `repo_dir`, unless its
+  outputs for `key` already are in `data_dir` (e.g. a persistent volume) or in
+  the archive cache `cache_dir`. Returns how the outputs were obtained: "run",
+  "marker" or "cache".
+
+  Runs once per pod: the server processes warming up at the same time wait
+  for the first one, then find its marker.
+  """
+  os.makedirs(data_dir, exist_ok=True)
+  with open(os.path.join(data_dir, LOCK_FILE), "w") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return _preprocess(script, repo_dir, data_dir, key, cache_dir, timeout)
+
+
+def _preprocess(
+  script: str,
+  repo_dir: str,
+  data_dir: str,
+  key: str,
+  cache_dir: str | None,
+  timeout: float,
+) -> str:
+  marker = os.path.join(data_dir, MARKER_FILE)
+  try:
+    with open(marker, encoding="utf-8") as f:
+      if f.read().strip() == key:
+        return "marker"
+  except FileNotFoundError:
+    pass
+
+  archive = os.path.join(cache_dir, f"{key}.tar") if cache_dir else None
+  if archive and os.path.exists(archive):
+    with tarfile.open(archive) as tar:
+      tar.extractall(data_dir, filter="data")
+    source = "cache"
+  else:
+    common_tools.run_command(["python", "-c", script], repo_dir, timeout)
+    source = "run"
+
+  with open(marker, "w", encoding="utf-8") as f:
+    f.write(key)
+
+  if archive and source == "run":
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=".")
+    with os.fdopen(fd, "wb") as f, tarfile.open(fileobj=f, mode="w") as tar:
+      tar.add(
+        data_dir,
+        arcname=".",
+        filter=lambda info: None if info.name == f"./{LOCK_FILE}" else info,
+      )
+    os.replace(temp_path, archive)
+  return source
+
+
+def _bytecode_is_current(source: str) -> bool:
+  """Whether the hash-based bytecode of `source` matches its content."""
+  try:
+    with open(importlib.util.cache_from_source(source), "rb") as f:
+      header = f.read(16)
+    with open(source, "rb") as f:
+      data = f.read()
+  except OSError:
+    return False
+  return (
+    header[:4] == importlib.util.MAGIC_NUMBER
+    and int.from_bytes(header[4:8], "little") & 0b1  # Hash-based
+    and header[8:16] == importlib.util.source_hash(data)
+  )
+
+
+def compile_repo(repo_dir: str) -> int:
+  """
+  Write the bytecode of the repository next to its sources, like the image
+  build does. The bytecode is validated against a hash of the sources rather
+  than their mtime, so it stays valid in overlays whatever their backend, and
+  is ignored for evolved files. Sources whose bytecode is current (e.g. from
+  the image) are skipped. Returns the number of files compiled.
+  """
+  compiled = 0
+  for root, dirs, files in os.walk(repo_dir):
+    dirs[:] = [d for d in dirs if d not in ("__pycache__", ".git")]
+    for name in files:
+      source = os.path.join(root, name)
+      if not name.endswith(".py") or _bytecode_is_current(source):
+        continue
+      try:
+        py_compile.compile(
+          source,
+          doraise=True,
+          invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+        )
+        compiled += 1
+      except (py_compile.PyCompileError, OSError) as e:
+        logger.debug("Could not compile %s: %s", source, e)
+  return compiled
+
+
+def import_modules(modules: list[str], cwd: str, timeout: float) -> None:
+  """Import `modules` in a throwaway interpreter."""
+  if modules:
+    common_tools.run_command(
+      ["python", "-c", f"import {', '.join(modules)}"], cwd, timeout
+    )
+
+
+class Warmup:
+  """Runs the warm-up steps in a background thread and tracks readiness."""
+
+  def __init__(self, steps: list[tuple[str, Callable[[], object], bool]]):
+    # (name, function, whether the sandbox cannot be ready if it fails)
+    self.steps = steps
+    self.state = "pending"
+    self.error = None
+    self.durations = {}
+
+  @property
+  def ready(self) -> bool:
+    return self.state == "ready"
+
+  def start(self) -> None:
+    threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+  def run(self) -> None:
+    self.state = "running"
+    for name, step, required in self.steps:
+      start = time.monotonic()
+      try:
+        result = step()
+      except Exception as e:
+        if required:
+          logger.exception("Warm-up step %s failed.", name)
+          self.state, self.error = "failed", f"{name}: {e}"
+          return
+        logger.warning("Warm-up step %s failed, skipping it: %s", name, e)
+      else:
+        logger.info("Warm-up step %s done (%s).", name, result)
+      self.durations[name] = time.monotonic() - start
+    self.state = "ready"
+
+  def status(self) -> dict:
+    return {"status": self.state, "steps": self.durations, "error": self.error}
@@ -0,0 +1,279 @@
+"""A pool of pre-warmed fork servers for running evaluation scripts."""
+
+import logging
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections.abc import Sequence
+
+import common_tools
+import forkserver
+import memory_limits
+
+FORKSERVER_SCRIPT = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), "forkserver.py"
+)
+
+# How often a request waiting for an idle fork server checks whether it was
+# cancelled, in seconds.
+ACQUIRE_CHECK_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+  """Raised when no fork server frees up before an evaluation's deadline."""
+
+
+class _ForkServer:
+  """A fork server process and the socket used to talk to it."""
+
+  def __init__(self, preload: Sequence[str], repo_dir: str | None = None):
+    self.sock, child_sock = socket.socketpair()
+    options = ["--repo-dir", repo_dir] if repo_dir else []
+    with child_sock:
+      self.proc = subprocess.Popen(
+        [
+          sys.executable,
+          FORKSERVER_SCRIPT,
+          str(child_sock.fileno()),
+          *options,
+          *preload,
+        ],
+        pass_fds=[child_sock.fileno()],
+      )
+
+  def alive(self) -> bool:
+    return self.proc.poll() is None
+
+  def close(self) -> None:
+    # Closing the socket makes the server exit once its current child is done.
+    self.sock.close()
+    try:
+      self.proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+      self.proc.kill()
+      self.proc.wait()
+
+
+class PooledProcess:
+  """
+  A script running in a child of a fork server.
+
+  Implements the subset of the `subprocess.Popen` interface used by
+  `common_tools.wait_for_process`, so pooled runs share the timeout, memory
+  limit and exit code semantics of `common_tools.run_command`.
+  """
+
+  def __init__(
+    self,
+    pool: "WorkerPool",
+    server: _ForkServer,
+    argv: list,
+    cwd: str,
+    limits: dict | None = None,
+    evolved: Sequence[str] = (),
+  ):
+    self.args = argv
+    self.returncode = None
+    self.cpu_time = None
+    self._pool = pool
+    self._server = server
+
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    try:
+      forkserver.send_message(
+        server.sock,
+        {
+          "argv": argv,
+          "cwd": cwd,
+          "limits": limits or {},
+          "evolved": list(evolved),
+        },
+        fds=(stdout_w, stderr_w),
+      )
+    except OSError:
+      os.close(stdout_r)
+      os.close(stderr_r)
+      raise
+    finally:
+      os.close(stdout_w)
+      os.close(stderr_w)
+    self.stdout = os.fdopen(stdout_r)
+    self.stderr = os.fdopen(stderr_r)
+    self.pid = self._recv()["pid"]
+
+  @property
+  def sentinel(self) -> int:
+    """File descriptor which becomes readable once the child has exited."""
+    return self._server.sock.fileno()
+
+  def _recv(self) -> dict:
+    message, _ = forkserver.recv_message(self._server.sock)
+    if message is None:
+      raise subprocess.SubprocessError("Fork server exited unexpectedly.")
+    return message
+
+  def _recv_exit(self) -> None:
+    message = self._recv()
+    self.returncode = message["returncode"]
+    self.cpu_time = message["cpu_time"]
+
+  def poll(self) -> int | None:
+    if self.returncode is None and common_tools.wait_readable(self.sentinel, 0):
+      self._recv_exit()
+    return self.returncode
+
+  def wait(self, timeout: float | None = None) -> int:
+    if self.returncode is None:
+      if not common_tools.wait_readable(self.sentinel, timeout):
+        raise subprocess.TimeoutExpired(self.args, timeout)
+      self._recv_exit()
+    return self.returncode
+
+  def kill(self) -> None:
+    if self.returncode is None:
+      try:
+        os.kill(self.pid, signal.SIGKILL)
+      except ProcessLookupError:
+        pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    healthy = True
+    try:
+      # The fork server only accepts a new job once this child is reaped.
+      self.kill()
+      self.wait()
+    except (OSError, EOFError, subprocess.SubprocessError):
+      healthy = False
+      raise
+    finally:
+      self.stdout.close()
+      self.stderr.close()
+      self._pool.release(self._server, healthy)
+
+
+class WorkerPool:
+  """
+  Keeps `size` fork servers with the `preload` modules already imported.
+
+  Each evaluation runs in a fresh child forked from an idle server, so it only
+  pays for a fork instead of interpreter startup plus imports.
+
+  Repository modules may only be preloaded when `repo_dir` is given (in-process
+  evaluation): children then evict the modules of the files a job evolved, see
+  `forkserver.evict_evolved_modules`. Otherwise the evolved files would be
+  shadowed by the versions imported at startup.
+  """
+
+  def __init__(
+    self, size: int, preload: Sequence[str] = (), repo_dir: str | None = None
+  ):
+    self._preload = [name.strip() for name in preload if name.strip()]
+    self._repo_dir = repo_dir
+    self._idle = queue.Queue()
+    for _ in range(size):
+      self._idle.put(_ForkServer(self._preload, repo_dir))
+    logger.info(
+      "Started %d fork servers with preloaded modules: %s",
+      size,
+      self._preload,
+    )
+
+  def _acquire(
+    self,
+    timeout: float | None,
+    cancellation: common_tools.Cancellation | None,
+  ) -> _ForkServer:
+    """Wait up to `timeout` seconds for an idle fork server."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      if cancellation is not None and cancellation.cancelled:
+        raise common_tools.EvaluationCancelledError("Cancelled")
+      wait = ACQUIRE_CHECK_INTERVAL
+      if deadline is not None:
+        wait = min(wait, deadline - time.monotonic())
+        if wait <= 0:
+          raise PoolTimeoutError(
+            f"No fork server was free within {timeout} seconds."
+          )
+      try:
+        return self._idle.get(timeout=wait)
+      except queue.Empty:
+        pass
+
+  def popen(
+    self,
+    argv: list,
+    cwd: str,
+    limits: dict | None = None,
+    evolved: Sequence[str] = (),
+    timeout: float | None = None,
+    cancellation: common_tools.Cancellation | None = None,
+  ) -> PooledProcess:
+    """
+    Start `python <argv>` in `cwd` on an idle fork server, applying the
+    `memory_limits.apply_child_limits` settings `limits` in the child.
+    `evolved` lists the repository files overridden in `cwd`. Raises
+    `PoolTimeoutError` if no server is idle within `timeout` seconds, and
+    `EvaluationCancelledError` once `cancellation` is cancelled.
+    """
+    server = self._acquire(timeout, cancellation)
+    if not server.alive():
+      logger.warning(
+        "Fork server exited with code %s, restarting it.",
+        server.proc.returncode,
+      )
+      server.close()
+      server = _ForkServer(self._preload, self._repo_dir)
+
+    try:
+      return PooledProcess(self, server, argv, cwd, limits, evolved)
+    except BaseException:
+      self.release(server, healthy=False)
+      raise
+
+  def release(self, server: _ForkServer, healthy: bool = True) -> None:
+    """Return `server` to the pool, shutting it down if it is out of sync."""
+    if not healthy:
+      server.close()
+    self._idle.put(server)
+
+  def run_script(
+    self,
+    argv: list,
+    cwd: str = ".",
+    timeout: float = 10.0,
+    memory_limit: int | None = None,
+    stats: common_tools.ExecutionStats | None = None,
+    evolved: Sequence[str] = (),
+    cancellation: common_tools.Cancellation | None = None,
+  ) -> str:
+    """
+    Pooled equivalent of `common_tools.run_command(["python", *argv])`. The
+    time spent waiting for an idle fork server counts towards `timeout`.
+    """
+    with memory_limits.limit(memory_limit) as limit:
+      spawn_start = time.monotonic()
+      with self.popen(
+        argv, cwd, limit.child_settings, evolved, timeout, cancellation
+      ) as process:
+        spawn_time = time.monotonic() - spawn_start
+        if stats is not None:
+          stats.spawn_time = spawn_time
+        return common_tools.wait_for_process(
+          process,
+          max(timeout - spawn_time, 0),
+          memory_limit,
+          limit,
+          stats,
+          cancellation,
+        )
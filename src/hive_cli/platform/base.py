@@ -8,7 +8,7 @@ from pathlib import Path
 import hive_cli
 from hive_cli.config import HiveConfig
 from hive_cli.runtime.runtime import Runtime
-from hive_cli.utils import git, image
+from hive_cli.utils import build_context, git, image
 from hive_cli.utils.logger import logger
 
 
@@ -64,6 +64,13 @@ class Platform(Runtime, ABC):
         logger.debug(f"The updated HiveConfig: {config}")
         return config
 
+    def target_platforms(self) -> list[str]:
+        """
+        The platforms of the sandbox image, unless set in the config: the one of
+        this machine, which builds it without emulation.
+        """
+        return [image.native_platform()]
+
     def prepare_images(self, config: HiveConfig, temp_dir: str, push: bool = False) -> str:
         """
         Build the Docker image for the experiment.
@@ -80,12 +87,14 @@ class Platform(Runtime, ABC):
 
         logger.debug(f"Preparing images for experiment '{self.experiment_name}' in {temp_dir}")
 
+        context = Path(temp_dir) / "sandbox"
         with pkg_resources.path(hive_cli, "libs") as lib_path:
             shutil.copytree(
                 lib_path,
-                temp_dir,
+                context,
                 dirs_exist_ok=True,
             )
+            libs_digest = image.tree_digest(lib_path)
 
         dest = Path(temp_dir) / "repo"
         hash = git.clone_repo(config.repo.url, dest, config.repo.branch)
@@ -98,16 +107,6 @@ class Platform(Runtime, ABC):
             # Generate Dockerfile for the experiment
             generate_dockerfile(dest)
 
-        logger.debug(f"Building temporary repo image in {dest}")
-        # build the repository image first
-        image.build_image(
-            image="temp-image:latest",
-            context=dest,
-            dockerfile=dest / "Dockerfile",
-            # this is a temporary image, so we don't push it
-            push=False,
-        )
-
         if config.cloud_provider.gcp and config.cloud_provider.gcp.enabled:
             image_registry = config.cloud_provider.gcp.image_registry
         elif config.cloud_provider.aws and config.cloud_provider.aws.enabled:
@@ -115,17 +114,43 @@ class Platform(Runtime, ABC):
         else:
             raise ValueError("Unsupported cloud provider configuration. Please enable GCP or AWS.")
 
-        # Use the git commit hash as the image tag to ensure uniqueness.
-        image_name = f"{image_registry}:{hash[:7]}"
+        # Use the git commit hash as the image tag to ensure uniqueness, and the
+        # content key to tell apart the images of different sandbox servers.
+        platforms = config.sandbox.platforms or self.target_platforms()
+        key = image.content_key(hash, libs_digest, dest / "Dockerfile", platforms)
+        image_name = f"{image_registry}:{hash[:7]}-{key[:7]}"
+
+        if push:
+            found = image.find_image(image_name, key, hash)
+            if found:
+                logger.info(f"Reusing image {image_name} found in the {found}, skipping the build.")
+                return image_name
+
+        # Only the tracked files of the repository are in `dest`, so no
+        # .gitignore patterns to add.
+        for build_dir in (dest, context):
+            build_context.check_context(
+                build_dir,
+                config.sandbox.build_context_warning_mb,
+                config.sandbox.build_context_limit_mb,
+            )
 
-        logger.debug(f"Building sandbox image {image_name} in {temp_dir} with push={push}")
-        # build the sandbox image
-        image.build_image(
+        logger.debug(
+            f"Building sandbox image {image_name} for {platforms} in {context} with push={push}"
+        )
+        # build the repository image and the sandbox image on top of it
+        image.bake_image(
             image=image_name,
-            context=temp_dir,
-            dockerfile=f"{temp_dir}/Dockerfile",
+            context=context,
+            repo_context=dest,
+            platforms=platforms,
             push=push,
+            build_args={"REPO_COMMIT": hash},
+            cache=config.sandbox.build_cache,
+            image_registry=image_registry,
         )
+        if push:
+            image.record_image(image_name, key, hash)
 
         logger.debug(
             f"Images {image_name} prepared for experiment '{self.experiment_name}' successfully."
@@ -147,22 +172,18 @@ def generate_dockerfile(dest: Path) -> None:
         "",
         "WORKDIR /app",
         "",
-        "# Install sandbox server dependencies",
+        "# Precompile the bytecode of the installed packages",
+        "ENV UV_COMPILE_BYTECODE=1",
+        "ENV UV_LINK_MODE=copy",
+        "",
     ]
-    if (dest / "pyproject.toml").exists():
-        lines.append("# Install repository dependencies from pyproject.toml")
-        lines.append("COPY pyproject.toml .")
-        lines.append("RUN uv pip install --system --requirement pyproject.toml")
-    elif (dest / "requirements.txt").exists():
-        lines.append("# Install repository dependencies from requirements.txt")
-        lines.append("COPY requirements.txt .")
-        lines.append("RUN uv pip install --system --requirement requirements.txt")
-
-    lines.extend(
-        [
-            "",
-            "# Copy server code and evaluation file",
-            "COPY . repo",
-        ]
-    )
+    # Only the dependency files are copied, so that the layers of this image
+    # are reused until they change. The sandbox image adds the sources.
+    for requirements in ("pyproject.toml", "requirements.txt"):
+        if (dest / requirements).exists():
+            lines.append(f"# Install repository dependencies from {requirements}")
+            lines.append(f"COPY {requirements} .")
+            lines.append("RUN --mount=type=cache,target=/root/.cache/uv \\")
+            lines.append(f"    uv pip install --system --requirement {requirements}")
+            break
     (dest / "Dockerfile").write_text("\n".join(lines), encoding="utf-8")
@@ -16,6 +16,8 @@ RESOURCE = "Experiment"
 RESOURCE_PLURAL = "experiments"
 # TODO: remove this once we support custom namespace
 NAMESPACE = "default"
+# Built for when the architectures of the cluster nodes are unknown.
+FALLBACK_PLATFORMS = ["linux/amd64", "linux/arm64"]
 
 
 class K8sPlatform(Platform):
@@ -26,6 +28,28 @@ class K8sPlatform(Platform):
         self.client = client.CustomObjectsApi()
         self.core_client = client.CoreV1Api()
 
+    def target_platforms(self) -> list[str]:
+        """
+        The platforms of the nodes of the cluster, or `FALLBACK_PLATFORMS` if
+        they cannot be listed.
+        """
+        try:
+            nodes = self.core_client.list_node().items
+        except Exception as e:  # An API error, or an unreachable cluster
+            logger.warning(
+                f"Failed to list the nodes of the cluster ({e}), building the sandbox image for "
+                f"{', '.join(FALLBACK_PLATFORMS)}. Set `sandbox.platforms` in the config to "
+                "pick the platforms."
+            )
+            return list(FALLBACK_PLATFORMS)
+
+        platforms = {
+            f"{node.status.node_info.operating_system}/{node.status.node_info.architecture}"
+            for node in nodes
+            if node.status and node.status.node_info
+        }
+        return sorted(platforms) or list(FALLBACK_PLATFORMS)
+
     def create(self, config: HiveConfig):
         logger.info(f"Creating experiment '{self.experiment_name}' on Kubernetes...")
         config = self.setup_environment(config)
@@ -155,6 +179,12 @@ def construct_experiment(name: str, namespace: str, config: HiveConfig) -> dict:
     else:
         envs = None
 
+    # The sandbox server runs the pre-processor during its warm-up.
+    if config.sandbox.pre_processor and not any(
+        env["name"] == "PRE_PROCESSOR" for env in envs or []
+    ):
+        envs = (envs or []) + [{"name": "PRE_PROCESSOR", "value": config.sandbox.pre_processor}]
+
     if config.sandbox.resources is not None:
         resources = config.sandbox.resources.model_dump()
     else:
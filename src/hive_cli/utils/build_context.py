@@ -0,0 +1,97 @@
+import os
+import re
+from pathlib import Path
+
+from hive_cli.utils.logger import logger
+
+# Always left out of the build contexts.
+DEFAULT_IGNORES = [".git", "**/__pycache__", "**/*.pyc"]
+
+
+def write_dockerignore(context: Path) -> list[str]:
+    """
+    Write the `.dockerignore` of `context`: its own patterns, if any, after the
+    `DEFAULT_IGNORES`. Returns the patterns.
+    """
+    dockerignore = context / ".dockerignore"
+    patterns = list(DEFAULT_IGNORES)
+    if dockerignore.exists():
+        patterns += read_patterns(dockerignore.read_text(encoding="utf-8"))
+    dockerignore.write_text("\n".join(patterns) + "\n", encoding="utf-8")
+    return patterns
+
+
+def read_patterns(text: str) -> list[str]:
+    """The patterns of a `.dockerignore` file, without comments and blank lines."""
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.startswith("#")]
+
+
+def _pattern_regex(pattern: str) -> re.Pattern:
+    parts = []
+    for token in re.split(r"(\*\*/|\*\*|\*|\?)", pattern.strip("/")):
+        if token == "**/":
+            parts.append("(.*/)?")
+        elif token == "**":
+            parts.append(".*")
+        elif token == "*":
+            parts.append("[^/]*")
+        elif token == "?":
+            parts.append("[^/]")
+        else:
+            parts.append(re.escape(token))
+    # A pattern matching a directory also excludes its contents.
+    return re.compile("".join(parts) + "(/.*)?")
+
+
+def is_ignored(path: str, patterns: list[str]) -> bool:
+    """
+    Whether `path` (relative to the context, with "/" separators) is excluded
+    by the `.dockerignore` `patterns`, the last matching one winning.
+    """
+    ignored = False
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        if _pattern_regex(pattern.removeprefix("!")).fullmatch(path):
+            ignored = not negated
+    return ignored
+
+
+def context_size(context: Path, patterns: list[str]) -> tuple[int, int]:
+    """The size in bytes and the number of the files of `context` sent to the builder."""
+    size = files = 0
+    for root, dirs, names in os.walk(context):
+        relative_root = Path(root).relative_to(context).as_posix()
+        prefix = "" if relative_root == "." else f"{relative_root}/"
+        # Excluded directories are not walked, unless an exception may re-include
+        # some of their contents.
+        if not any(p.startswith("!") for p in patterns):
+            dirs[:] = [d for d in dirs if not is_ignored(prefix + d, patterns)]
+        for name in names:
+            path = Path(root) / name
+            if not path.is_symlink() and not is_ignored(prefix + name, patterns):
+                size += path.stat().st_size
+                files += 1
+    return size, files
+
+
+def check_context(context: Path, warning_mb: int | None = None, limit_mb: int | None = None) -> int:
+    """
+    Write the `.dockerignore` of `context` and report the size of what is sent
+    to the builder. Warns above `warning_mb` megabytes and fails above
+    `limit_mb`. Returns the size in bytes.
+    """
+    patterns = write_dockerignore(context)
+    size, files = context_size(context, patterns)
+    size_mb = size / 1024**2
+    logger.info(f"Build context {context.name}: {size_mb:.1f} MB in {files} files.")
+    if limit_mb is not None and size_mb > limit_mb:
+        raise ValueError(
+            f"The build context {context.name} is {size_mb:.1f} MB, over the limit of "
+            f"{limit_mb} MB. Exclude large files with a .dockerignore in the repository."
+        )
+    if warning_mb is not None and size_mb > warning_mb:
+        logger.warning(
+            f"The build context {context.name} is {size_mb:.1f} MB, consider excluding "
+            "large files (data, notebooks, ...) with a .dockerignore in the repository."
+        )
+    return size
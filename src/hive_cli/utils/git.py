@@ -1,28 +1,101 @@
+import contextlib
+import fcntl
+import hashlib
 import os
-import shutil
+import tarfile
+import tempfile
 from pathlib import Path
 
 import git
 
+from hive_cli.utils.logger import logger
+
+# Bare mirrors of the remote repositories, fetched incrementally.
+CACHE_DIR = os.path.expandvars("$HOME/.hive/cache/git")
+
 
 def clone_repo(repo_dir: str, output_dir: str, branch: str = "main") -> str:
-    """Clone a repository into the output directory."""
+    """
+    Write the tracked files of the repository at `branch` (the current commit
+    for a local directory) into the output directory, without its git metadata.
+    Returns the commit.
+    """
     dest = Path(output_dir)
     dest.mkdir(parents=True, exist_ok=True)
     if repo_dir.startswith("https://"):
-        token = os.getenv("GITHUB_TOKEN")
-        if token:
-            # Inject token into the URL for authentication
-            repo_dir = repo_dir.replace("https://", f"https://x-access-token:{token}@")
-        repo = git.Repo.clone_from(repo_dir, dest)
-        repo.git.checkout(branch)
+        repo, commit = fetch_commit(repo_dir, branch)
     else:  # We assume `repo_dir` is a directory in this machine.
         repo_path = Path(repo_dir).resolve()
         if not repo_path.exists():
             raise FileNotFoundError(f"Repository directory {repo_dir} does not exist")
         if not repo_path.is_dir():
             raise NotADirectoryError(f"{repo_dir} is not a directory")
-        shutil.copytree(repo_path, dest, dirs_exist_ok=True)
-        repo = git.Repo(dest)
+        repo = git.Repo(repo_path)
+        commit = repo.head.commit.hexsha
+        if repo.is_dirty(untracked_files=True):
+            logger.warning(
+                f"Repository {repo_dir} has uncommitted changes, only commit {commit[:7]} is used."
+            )
+
+    export_tree(repo, commit, dest)
+    return commit
+
+
+def mirror_path(url: str) -> Path:
+    """The bare mirror of the repository at `url` in the cache."""
+    return Path(CACHE_DIR) / f"{hashlib.sha256(url.encode()).hexdigest()[:16]}.git"
+
+
+@contextlib.contextmanager
+def mirror_lock(path: Path):
+    """Hold an exclusive lock on the mirror at `path`, across processes."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def fetch_commit(url: str, branch: str) -> tuple[git.Repo, str]:
+    """
+    Fetch the tip of `branch` (or a tag or commit) of the repository at `url`
+    into its mirror, without history. Returns the mirror and the commit.
+
+    Concurrent fetches into the same mirror (e.g. parallel `hive` commands)
+    take turns, as they would otherwise conflict on its shallow file, refs and
+    FETCH_HEAD.
+    """
+    path = mirror_path(url)
+    token = os.getenv("GITHUB_TOKEN")
+    if token:
+        # Inject token into the URL for authentication, it is not stored in the mirror.
+        url = url.replace("https://", f"https://x-access-token:{token}@")
+    with mirror_lock(path):
+        mirror = git.Repo(path) if path.exists() else git.Repo.init(path, bare=True, mkdir=True)
+        mirror.git.fetch("--depth", "1", "--no-tags", url, branch)
+        commit = mirror.git.rev_parse("FETCH_HEAD^{commit}")
+        # Keep the fetched commit reachable, for the next fetch to build on.
+        mirror.git.update_ref(f"refs/hive/{branch}", commit)
+    return mirror, commit
+
+
+def export_tree(repo: git.Repo, commit: str, dest: Path) -> None:
+    """
+    Write the files tracked at `commit` into `dest`, with the ones of the
+    submodules checked out in the working tree of `repo`, at the commits
+    recorded in `commit`. A mirror has no submodules checked out.
+    """
+    with tempfile.TemporaryFile() as archive:
+        repo.archive(archive, commit, format="tar")
+        archive.seek(0)
+        with tarfile.open(fileobj=archive) as tar:
+            tar.extractall(dest, filter="tar")
 
-    return repo.head.commit.hexsha
+    for line in repo.git.ls_tree("-r", commit).splitlines():
+        mode, kind, sha, path = line.split(maxsplit=3)
+        if kind != "commit":
+            continue
+        checkout = Path(repo.working_tree_dir or "", path)
+        if repo.working_tree_dir is None or not (checkout / ".git").exists():
+            logger.warning(f"Submodule {path} is not checked out, its files are left out.")
+            continue
+        export_tree(git.Repo(checkout), sha, Path(dest) / path)
@@ -1,37 +1,138 @@
+import hashlib
+import json
 import logging
+import os
+import platform
 import subprocess
+import time
+from pathlib import Path
 
 from hive_cli.utils.logger import logger
 
+# Sandbox images pushed from this machine, by name, so that experiments on the
+# same content reuse them without building again.
+BUILD_MANIFEST = os.path.expandvars("$HOME/.hive/cache/images.json")
 
-def build_image(
+
+# Local BuildKit cache of the image layers, shared by the builds of all experiments.
+BUILD_CACHE_DIR = os.path.expandvars("$HOME/.hive/cache/buildkit")
+
+# `platform.machine()` names of the architectures, in OCI platforms.
+_ARCHITECTURES = {"x86_64": "amd64", "amd64": "amd64", "aarch64": "arm64", "arm64": "arm64"}
+
+
+def native_platform() -> str:
+    """The platform of this machine, built without emulation."""
+    machine = platform.machine().lower()
+    return f"linux/{_ARCHITECTURES.get(machine, machine)}"
+
+
+def cache_options(cache: str, image_registry: str, scope: str = "") -> tuple[list[str], list[str]]:
+    """
+    The BuildKit cache sources and destinations of `cache`: "local" (in
+    `BUILD_CACHE_DIR`), "registry" (the `buildcache` tag of `image_registry`)
+    or "none". Builds running in parallel use distinct `scope`s.
+    """
+    if cache == "local":
+        cache_dir = os.path.join(BUILD_CACHE_DIR, scope) if scope else BUILD_CACHE_DIR
+        cache_from = [f"type=local,src={cache_dir}"]
+        if not os.path.exists(os.path.join(cache_dir, "index.json")):
+            cache_from = []
+        return cache_from, [f"type=local,dest={cache_dir},mode=max"]
+    if cache == "registry":
+        ref = f"{image_registry}:buildcache" + (f"-{scope}" if scope else "")
+        return (
+            [f"type=registry,ref={ref}"],
+            [f"type=registry,ref={ref},mode=max,image-manifest=true,oci-mediatypes=true"],
+        )
+    if cache == "none":
+        return [], []
+    raise ValueError(f"Unsupported build cache: {cache}")
+
+
+def split_platforms(platforms: list[str], push: bool) -> bool:
+    """
+    Whether the platforms are built as separate images, in parallel, then
+    stitched into a manifest list. Only pushed images can be stitched.
+    """
+    return push and len(platforms) > 1
+
+
+def platform_name(target: str) -> str:
+    """A name of the `target` platform usable in tags, e.g. "arm64-v8"."""
+    return target.removeprefix("linux/").replace("/", "-")
+
+
+def platform_tag(image: str, target: str) -> str:
+    """The tag of the `target` platform image of a manifest list."""
+    return f"{image}-{platform_name(target)}"
+
+
+def bake_definition(
     image: str,
-    platforms: str = "linux/amd64,linux/arm64",
-    context: str = ".",
-    dockerfile: str = "Dockerfile",
+    context: str,
+    repo_context: str,
+    platforms: list[str],
     push: bool = False,
     build_args: dict = None,
-):
-    cmd = [
-        "docker",
-        "buildx",
-        "build",
-        "--platform",
-        platforms,
-        "--file",
-        dockerfile,
-        "--tag",
-        image,
-        "--load",
-        context,
-    ]
-    if push:
-        cmd.append("--push")
-
-    if build_args:
-        for key, value in build_args.items():
-            cmd.extend(["--build-arg", f"{key}={value}"])
+    cache: str = "none",
+    image_registry: str = None,
+) -> dict:
+    """
+    The `docker buildx bake` definition of the sandbox image, its "sandbox"
+    group: the Dockerfile in `context` built on top of the repository image
+    (a "repo" target, built from the Dockerfile in `repo_context`), with the
+    repository sources as its "repo" context. Both are built in the same
+    BuildKit solve, so the repository image never goes through the local image
+    store. See `split_platforms` for the builds of several platforms.
+    """
+    # (name, platforms, tag) of the builds
+    if split_platforms(platforms, push):
+        builds = [(platform_name(p), [p], platform_tag(image, p)) for p in platforms]
+    else:
+        builds = [("", platforms, image)]
+
+    targets = {}
+    for name, target_platforms, tag in builds:
+        suffix = f"-{name}" if name else ""
+        cache_from, cache_to = cache_options(cache, image_registry, name)
+        targets[f"repo{suffix}"] = {
+            "context": str(repo_context),
+            "dockerfile": "Dockerfile",
+            "platforms": target_platforms,
+        }
+        targets[f"sandbox{suffix}"] = {
+            "context": str(context),
+            "dockerfile": "Dockerfile",
+            "contexts": {"repo-image": f"target:repo{suffix}", "repo": str(repo_context)},
+            "platforms": target_platforms,
+            "tags": [tag],
+            "args": build_args or {},
+            "output": ["type=registry" if push else "type=docker"],
+            "cache-from": cache_from,
+            "cache-to": cache_to,
+        }
+    return {
+        "group": {"sandbox": {"targets": [name for name in targets if name.startswith("sandbox")]}},
+        "target": targets,
+    }
+
+
+def bake_image(image: str, context: str, repo_context: str, platforms: list[str], **options):
+    """Build the sandbox image, see `bake_definition` for the `options`."""
+    definition = bake_definition(image, context, repo_context, platforms, **options)
+    bake_file = Path(context).parent / "docker-bake.json"
+    bake_file.write_text(json.dumps(definition, indent=2), encoding="utf-8")
+    run_docker(["docker", "buildx", "bake", "--file", str(bake_file), "sandbox"])
+
+    if split_platforms(platforms, options.get("push", False)):
+        run_docker(
+            ["docker", "buildx", "imagetools", "create", "--tag", image]
+            + [platform_tag(image, p) for p in platforms]
+        )
+
 
+def run_docker(cmd: list[str]):
     try:
         if logger.isEnabledFor(logging.DEBUG):
             capture_output = False
@@ -47,3 +148,94 @@ def build_image(
     except subprocess.CalledProcessError as e:
         print("Build STDERR:\n", e.stderr)
         raise
+
+
+def tree_digest(path: str) -> str:
+    """Digest of the files (names and contents) under `path`, bytecode excluded."""
+    digest = hashlib.sha256()
+    root = Path(path)
+    for file in sorted(root.rglob("*")):
+        if file.is_file() and "__pycache__" not in file.parts:
+            digest.update(str(file.relative_to(root)).encode() + b"\0")
+            digest.update(file.read_bytes() + b"\0")
+    return digest.hexdigest()
+
+
+def content_key(commit: str, libs_digest: str, dockerfile: str, platforms: list[str]) -> str:
+    """
+    Key of the sandbox image built for `platforms` from the repository at
+    `commit`, the sandbox server with digest `libs_digest` and the repository
+    `dockerfile`.
+    """
+    digest = hashlib.sha256()
+    for part in (
+        commit.encode(),
+        libs_digest.encode(),
+        Path(dockerfile).read_bytes(),
+        ",".join(sorted(platforms)).encode(),
+    ):
+        digest.update(part + b"\0")
+    return digest.hexdigest()
+
+
+def image_exists(image: str) -> bool:
+    """Whether the registry has a manifest for `image`."""
+    try:
+        result = subprocess.run(
+            ["docker", "buildx", "imagetools", "inspect", image],
+            capture_output=True,
+            text=True,
+        )
+    except FileNotFoundError:
+        return False
+    return result.returncode == 0
+
+
+def load_manifest(path: str | None = None) -> dict:
+    try:
+        with open(path or BUILD_MANIFEST, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def record_image(image: str, key: str, commit: str, path: str | None = None):
+    """Record in the build manifest (`BUILD_MANIFEST` by default) that `image` was pushed."""
+    path = path or BUILD_MANIFEST
+    manifest = load_manifest(path)
+    manifest[image] = {"key": key, "commit": commit, "pushed_at": int(time.time())}
+    write_manifest(manifest, path)
+
+
+def forget_image(image: str, path: str | None = None):
+    """Drop `image` from the build manifest (`BUILD_MANIFEST` by default)."""
+    path = path or BUILD_MANIFEST
+    manifest = load_manifest(path)
+    if manifest.pop(image, None) is not None:
+        write_manifest(manifest, path)
+
+
+def write_manifest(manifest: dict, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temp_path, path)
+
+
+def find_image(image: str, key: str, commit: str, path: str | None = None) -> str | None:
+    """
+    Where the already pushed `image` was found: "manifest" (the local build
+    manifest, confirmed by the registry) or "registry", or None if it must be
+    built. Manifest entries of images gone from the registry are dropped.
+    """
+    if load_manifest(path).get(image, {}).get("key") == key:
+        if image_exists(image):
+            return "manifest"
+        logger.info(f"Image {image} is no longer in the registry, rebuilding it.")
+        forget_image(image, path)
+        return None
+    if image_exists(image):
+        record_image(image, key, commit, path)
+        return "registry"
+    return None
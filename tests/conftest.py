@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The sandbox server modules in `libs` import each other as top-level modules.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "hive_cli", "libs"))
+
+# The benchmarks of the sandbox server, which are not part of the package.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("gunicorn")
+pytest.importorskip("prometheus_client")
+
+import benchmark  # noqa: E402
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+
+    assert benchmark.percentile(values, 50) == 50
+    assert benchmark.percentile(values, 99) == 99
+    assert benchmark.percentile([3.0], 95) == 3
+
+
+def test_benchmark_reports_latency_and_stages():
+    report = benchmark.run(files=20, depth=2, concurrency=2, requests=4, warmup_requests=1)
+
+    assert report["requests"] == 4
+    assert report["errors"] == 0
+    assert set(report["latency"]) == {"p50", "p95", "p99", "mean"}
+    assert {"overlay", "spawn", "run"} <= set(report["stages"])
@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip("rich")
+
+from hive_cli.utils import build_context  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "path, ignored",
+    [
+        (".git/HEAD", True),
+        ("pkg/__pycache__/mod.cpython-312.pyc", True),
+        ("data", True),
+        ("data/train.csv", True),
+        ("data/keep.csv", False),
+        ("pkg/data/train.csv", False),
+        ("notebook.ipynb", True),
+        ("pkg/notebook.ipynb", True),
+        ("main.py", False),
+    ],
+)
+def test_is_ignored(path, ignored):
+    patterns = build_context.DEFAULT_IGNORES + ["data", "!data/keep.csv", "**/*.ipynb"]
+
+    assert build_context.is_ignored(path, patterns) == ignored
+
+
+def test_check_context_respects_the_repository_dockerignore(tmp_path):
+    (tmp_path / ".dockerignore").write_text("# data\ndata\n")
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "train.csv").write_bytes(b"0" * 2 * 1024**2)
+    (tmp_path / "main.py").write_text("print(1)\n")
+
+    size = build_context.check_context(tmp_path, warning_mb=1, limit_mb=1)
+
+    assert (tmp_path / ".dockerignore").read_text().splitlines()[-1] == "data"
+    assert size == len("print(1)\n") + len((tmp_path / ".dockerignore").read_text())
+    (tmp_path / ".dockerignore").unlink()
+    with pytest.raises(ValueError, match="over the limit"):
+        build_context.check_context(tmp_path, limit_mb=1)
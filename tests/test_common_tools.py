@@ -0,0 +1,129 @@
+import sys
+import threading
+import time
+
+import psutil
+import pytest
+
+common_tools = pytest.importorskip("common_tools")
+memory_limits = pytest.importorskip("memory_limits")
+
+
+@pytest.fixture
+def enforcement(monkeypatch):
+    def select(name):
+        monkeypatch.setenv("MEMORY_ENFORCEMENT", name)
+        memory_limits.enforcer.cache_clear()
+
+    yield select
+    memory_limits.enforcer.cache_clear()
+
+
+@pytest.mark.parametrize("name", ["poll", "rlimit"])
+def test_run_command_memory_limit(enforcement, name):
+    enforcement(name)
+    allocate = "import time; x = bytearray(512 * 1024 * 1024); time.sleep(2)"
+
+    with pytest.raises(common_tools.FunctionExecutionError, match="Memory limit exceeded"):
+        common_tools.run_command([sys.executable, "-c", allocate], memory_limit=128)
+
+    assert common_tools.run_command([sys.executable, "-c", "print(1)"], memory_limit=128) == "1\n"
+
+
+def test_run_command_returns_on_exit_with_stats(enforcement):
+    enforcement("poll")
+    stats = common_tools.ExecutionStats()
+
+    output = common_tools.run_command(
+        [sys.executable, "-c", "print(1)"], memory_limit=1024, stats=stats
+    )
+
+    assert output == "1\n"
+    # The memory is sampled every second, but the exit is noticed right away.
+    assert stats.wall_time < 0.9
+    assert stats.cpu_time > 0
+
+
+def test_run_command_bounds_captured_output(monkeypatch, tmp_path):
+    monkeypatch.setattr(common_tools, "OUTPUT_LIMIT", 100)
+    monkeypatch.setattr(common_tools, "OUTPUT_SPILL_DIR", str(tmp_path))
+    stats = common_tools.ExecutionStats()
+
+    output = common_tools.run_command(
+        [sys.executable, "-c", "for i in range(100000): print(i)"], stats=stats
+    )
+
+    assert output.startswith("0\n1\n") and output.endswith("99998\n99999\n")
+    assert "characters truncated" in output and len(output) < 200
+    assert stats.stdout_truncated and not stats.stderr_truncated
+    with open(stats.stdout_file) as f:
+        assert f.read() == "".join(f"{i}\n" for i in range(100000))
+
+
+def test_run_command_deletes_unreported_spill_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(common_tools, "OUTPUT_LIMIT", 100)
+    monkeypatch.setattr(common_tools, "OUTPUT_SPILL_DIR", str(tmp_path))
+
+    common_tools.run_command([sys.executable, "-c", "for i in range(100000): print(i)"])
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_run_command_without_limit_does_not_set_up_enforcer(enforcement):
+    enforcement("cgroup")
+
+    assert common_tools.run_command([sys.executable, "-c", "print(1)"]) == "1\n"
+    assert memory_limits.enforcer.cache_info().currsize == 0
+
+
+def test_cgroup_setup_rolls_back_on_failure(tmp_path):
+    (tmp_path / "cgroup.controllers").write_text("cpu memory\n")
+    (tmp_path / "cgroup.procs").write_text("1\n2\n")
+    # Writing the controllers fails, e.g. in a cgroup that cannot delegate.
+    (tmp_path / "cgroup.subtree_control").mkdir()
+
+    with pytest.raises(OSError):
+        memory_limits.CgroupEnforcer(str(tmp_path)).setup()
+
+    # The processes moved to the leaf are written back to the parent.
+    assert (tmp_path / "cgroup.procs").read_text() == "2"
+
+
+def test_run_command_timeout_covers_background_processes():
+    start = time.monotonic()
+
+    # The background sleep keeps stdout open after the shell exits.
+    with pytest.raises(common_tools.ExecutionTimeoutError):
+        common_tools.run_command(["sh", "-c", "sleep 8 & echo hi"], timeout=2)
+
+    assert time.monotonic() - start < 4
+
+
+def test_cancellation_kills_daemonized_processes(tmp_path):
+    pid_file = tmp_path / "pid"
+    # The subshell exits right away, re-parenting its sleep away from the shell.
+    script = f"(sleep 30 >/dev/null 2>&1 & echo $! > {pid_file}); sleep 30"
+    cancellation = common_tools.Cancellation()
+
+    def cancel():
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            time.sleep(0.05)
+        cancellation.cancel()
+
+    canceller = threading.Thread(target=cancel)
+    canceller.start()
+    with pytest.raises(common_tools.EvaluationCancelledError):
+        common_tools.run_command(["sh", "-c", script], timeout=20, cancellation=cancellation)
+    canceller.join()
+
+    daemon = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            if psutil.Process(daemon).status() == psutil.STATUS_ZOMBIE:
+                break
+        except psutil.NoSuchProcess:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail("the daemonized process survived the cancellation")
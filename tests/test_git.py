@@ -0,0 +1,86 @@
+import concurrent.futures
+import subprocess
+
+import pytest
+
+pytest.importorskip("git")
+
+from hive_cli.utils import git  # noqa: E402
+
+
+def run_git(path, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", *args], cwd=path, check=True
+    )
+
+
+@pytest.fixture
+def origin(tmp_path):
+    path = tmp_path / "origin"
+    path.mkdir()
+    run_git(path, "init", "-q", "-b", "main")
+    for version in range(3):
+        (path / "lib.py").write_text(f"VERSION = {version}\n")
+        run_git(path, "add", ".")
+        run_git(path, "commit", "-q", "-m", f"v{version}")
+    return path
+
+
+def test_clone_local_repo_exports_the_tracked_tree(origin, tmp_path):
+    (origin / "untracked.py").write_text("")
+    head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=origin, text=True).strip()
+
+    commit = git.clone_repo(str(origin), tmp_path / "dest")
+
+    assert commit == head
+    assert sorted(p.name for p in (tmp_path / "dest").iterdir()) == ["lib.py"]
+
+
+def test_clone_local_repo_exports_submodules(origin, tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    run_git(library, "init", "-q", "-b", "main")
+    (library / "util.py").write_text("X = 1\n")
+    run_git(library, "add", ".")
+    run_git(library, "commit", "-q", "-m", "v0")
+    run_git(
+        origin,
+        "-c",
+        "protocol.file.allow=always",
+        "submodule",
+        "add",
+        "-q",
+        str(library),
+        "vendor/library",
+    )
+    run_git(origin, "commit", "-q", "-m", "Add library")
+
+    git.clone_repo(str(origin), tmp_path / "dest")
+
+    assert (tmp_path / "dest" / "vendor" / "library" / "util.py").read_text() == "X = 1\n"
+
+
+def test_fetch_commit_is_shallow_and_incremental(origin, tmp_path, monkeypatch):
+    monkeypatch.setattr(git, "CACHE_DIR", str(tmp_path / "cache"))
+    url = f"file://{origin}"
+
+    mirror, first = git.fetch_commit(url, "main")
+    (origin / "lib.py").write_text("VERSION = 3\n")
+    run_git(origin, "commit", "-q", "-am", "v3")
+    mirror, second = git.fetch_commit(url, "main")
+    git.export_tree(mirror, second, tmp_path / "dest")
+
+    assert first != second
+    assert mirror.git.rev_list("--count", second) == "1"
+    assert (tmp_path / "dest" / "lib.py").read_text() == "VERSION = 3\n"
+
+
+def test_concurrent_fetches_share_the_mirror(origin, tmp_path, monkeypatch):
+    monkeypatch.setattr(git, "CACHE_DIR", str(tmp_path / "cache"))
+    url = f"file://{origin}"
+    head = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=origin, text=True).strip()
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: git.fetch_commit(url, "main"), range(8)))
+
+    assert {commit for _, commit in results} == {head}
@@ -0,0 +1,124 @@
+import subprocess
+
+import pytest
+
+pytest.importorskip("git")
+pytest.importorskip("pydantic")
+
+from hive_cli.config import HiveConfig  # noqa: E402
+from hive_cli.platform import onprem  # noqa: E402
+from hive_cli.utils import image  # noqa: E402
+
+
+def git(path, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", *args], cwd=path, check=True
+    )
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = tmp_path / "src"
+    path.mkdir()
+    (path / "evaluator.py").write_text("print(1)\n")
+    git(path, "init", "-q")
+    git(path, "add", ".")
+    git(path, "commit", "-q", "-m", "init")
+    return path
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    """A stand-in for the image registry, and the builds pushed to it."""
+    monkeypatch.setattr(image, "BUILD_MANIFEST", str(tmp_path / "images.json"))
+    pushed = []
+
+    def bake_image(image, context, repo_context, push=False, **options):
+        if push:
+            pushed.append(image)
+
+    monkeypatch.setattr(image, "bake_image", bake_image)
+    monkeypatch.setattr(image, "image_exists", lambda image: image in pushed)
+    return pushed
+
+
+def config(repo) -> HiveConfig:
+    return HiveConfig(
+        project_name="test",
+        repo={"url": str(repo), "evolve_files_and_ranges": "evaluator.py"},
+        sandbox={},
+        cloud_provider={"gcp": {"enabled": True, "image_registry": "registry/test"}},
+    )
+
+
+def test_prepare_images_builds_each_content_once(repo, registry, tmp_path):
+    platform = onprem.OnPremPlatform("test")
+
+    names = [
+        platform.prepare_images(config(repo), str(tmp_path / f"build{i}"), push=True)
+        for i in range(3)
+    ]
+    (repo / "evaluator.py").write_text("print(2)\n")
+    uncommitted = platform.prepare_images(config(repo), str(tmp_path / "uncommitted"), push=True)
+    git(repo, "commit", "-q", "-am", "change")
+    changed = platform.prepare_images(config(repo), str(tmp_path / "changed"), push=True)
+
+    assert len(set(names)) == 1
+    assert uncommitted == names[0]
+    assert registry == [names[0], changed]
+
+
+def test_find_image_asks_the_registry(registry, tmp_path):
+    registry.append("registry/test:abc")
+
+    assert image.find_image("registry/test:def", "key", "commit") is None
+    assert image.find_image("registry/test:abc", "key", "commit") == "registry"
+    assert image.find_image("registry/test:abc", "key", "commit") == "manifest"
+
+
+def test_find_image_drops_stale_manifest_entries(registry):
+    registry.append("registry/test:abc")
+    image.record_image("registry/test:abc", "key", "commit")
+    registry.clear()
+
+    assert image.find_image("registry/test:abc", "key", "commit") is None
+    assert "registry/test:abc" not in image.load_manifest()
+
+
+def test_bake_definition_builds_the_repository_image_inline(tmp_path, monkeypatch):
+    monkeypatch.setattr(image, "BUILD_CACHE_DIR", str(tmp_path / "cache"))
+
+    definition = image.bake_definition(
+        "registry/test:tag",
+        "/build/sandbox",
+        "/build/repo",
+        ["linux/amd64"],
+        push=True,
+        cache="local",
+    )
+
+    assert definition["group"]["sandbox"]["targets"] == ["sandbox"]
+    sandbox = definition["target"]["sandbox"]
+    assert sandbox["contexts"] == {"repo-image": "target:repo", "repo": "/build/repo"}
+    assert sandbox["output"] == ["type=registry"]
+    assert sandbox["cache-from"] == []
+    assert sandbox["cache-to"] == [f"type=local,dest={tmp_path / 'cache'},mode=max"]
+
+
+def test_bake_definition_splits_pushed_platforms():
+    definition = image.bake_definition(
+        "registry/test:tag",
+        "/build/sandbox",
+        "/build/repo",
+        ["linux/amd64", "linux/arm64/v8"],
+        push=True,
+        cache="registry",
+        image_registry="registry/test",
+    )
+
+    assert definition["group"]["sandbox"]["targets"] == ["sandbox-amd64", "sandbox-arm64-v8"]
+    arm = definition["target"]["sandbox-arm64-v8"]
+    assert arm["platforms"] == ["linux/arm64/v8"]
+    assert arm["tags"] == ["registry/test:tag-arm64-v8"]
+    assert arm["contexts"]["repo-image"] == "target:repo-arm64-v8"
+    assert arm["cache-from"] == ["type=registry,ref=registry/test:buildcache-arm64-v8"]
@@ -0,0 +1,32 @@
+import types
+
+import pytest
+
+pytest.importorskip("kubernetes")
+
+from hive_cli.platform import k8s  # noqa: E402
+
+
+def make_platform(list_node):
+    platform = object.__new__(k8s.K8sPlatform)
+    platform.core_client = types.SimpleNamespace(list_node=list_node)
+    return platform
+
+
+def node(os, arch):
+    info = types.SimpleNamespace(operating_system=os, architecture=arch)
+    return types.SimpleNamespace(status=types.SimpleNamespace(node_info=info))
+
+
+def test_target_platforms_are_the_ones_of_the_nodes():
+    nodes = [node("linux", "arm64"), node("linux", "amd64"), node("linux", "arm64")]
+    platform = make_platform(lambda: types.SimpleNamespace(items=nodes))
+
+    assert platform.target_platforms() == ["linux/amd64", "linux/arm64"]
+
+
+def test_target_platforms_fall_back_when_the_cluster_is_unreachable():
+    def unreachable():
+        raise ConnectionRefusedError("Connection refused")
+
+    assert make_platform(unreachable).target_platforms() == k8s.FALLBACK_PLATFORMS
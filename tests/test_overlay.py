@@ -0,0 +1,111 @@
+import os
+
+import overlay
+import pytest
+
+
+def make_repo(root):
+    (root / "pkg" / "sub").mkdir(parents=True)
+    (root / "pkg" / "sub" / "model.py").write_text("x = 0\n")
+    (root / "pkg" / "util.py").write_text("y = 0\n")
+    (root / "evaluator.py").write_text("print(1)\n")
+
+
+def test_mirror_overlay_and_overwrite(tmp_path):
+    base, target = tmp_path / "base", tmp_path / "overlay"
+    make_repo(base)
+
+    overlay.mirror_overlay_and_overwrite(
+        str(base), str(target), {"pkg/sub/model.py": "x = 1\n"}, overlay.DirectoryIndex()
+    )
+
+    assert os.path.islink(target / "evaluator.py")
+    assert os.path.islink(target / "pkg" / "util.py")
+    assert not os.path.islink(target / "pkg" / "sub")
+    assert (target / "pkg" / "sub" / "model.py").read_text() == "x = 1\n"
+    assert (base / "pkg" / "sub" / "model.py").read_text() == "x = 0\n"
+
+
+def test_directory_index_refreshes_changed_entries(tmp_path):
+    make_repo(tmp_path)
+    index = overlay.DirectoryIndex()
+    index.warm(str(tmp_path))
+
+    assert index.read_text(str(tmp_path / "evaluator.py")) == "print(1)\n"
+    (tmp_path / "evaluator.py").write_text("print(22)\n")
+    (tmp_path / "new.py").write_text("")
+
+    assert index.read_text(str(tmp_path / "evaluator.py")) == "print(22)\n"
+    assert ("new.py", False) in index.list_dir(str(tmp_path))
+
+
+@pytest.mark.parametrize("backend", [overlay.KernelOverlay(), overlay.ReflinkOverlay()])
+def test_overlay_backends(tmp_path, backend):
+    base, target = tmp_path / "base", tmp_path / "overlay"
+    make_repo(base)
+    target.mkdir()
+    if not backend.available(str(base), str(tmp_path)):
+        pytest.skip(f"{backend.name} overlays are not supported here")
+
+    with backend.overlay(str(base), str(target), {"pkg/util.py": "y = 1\n"}):
+        assert not os.path.islink(target / "evaluator.py")
+        assert (target / "pkg" / "util.py").read_text() == "y = 1\n"
+        (target / "evaluator.py").write_text("print(2)\n")
+
+    assert (base / "pkg" / "util.py").read_text() == "y = 0\n"
+    assert (base / "evaluator.py").read_text() == "print(1)\n"
+
+
+def test_workspace_resets_to_a_clean_mirror(tmp_path):
+    base, path = tmp_path / "base", tmp_path / "workspace"
+    make_repo(base)
+    workspace = overlay.Workspace(str(base), str(path), overlay.DirectoryIndex())
+
+    workspace.prepare({"pkg/sub/model.py": "x = 1\n", "new/file.py": ""})
+    (path / "checkpoint.json").write_text("{}")
+    (path / "pkg" / "sub" / "outputs").mkdir()
+    workspace.reset()
+    workspace.prepare({"pkg/util.py": "y = 1\n"})
+
+    assert sorted(os.listdir(path)) == ["evaluator.py", "pkg"]
+    assert sorted(os.listdir(path / "pkg" / "sub")) == ["model.py"]
+    assert os.readlink(path / "pkg" / "sub" / "model.py") == str(base / "pkg" / "sub" / "model.py")
+    assert (path / "pkg" / "util.py").read_text() == "y = 1\n"
+    assert (base / "pkg" / "util.py").read_text() == "y = 0\n"
+    assert (base / "pkg" / "sub" / "model.py").read_text() == "x = 0\n"
+
+
+def test_remove_stale_workspace_dirs(tmp_path):
+    for name in (str(os.getpid()), "999999999", "shared"):
+        (tmp_path / name / "workspace-1").mkdir(parents=True)
+
+    overlay.remove_stale_workspace_dirs(str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == sorted([str(os.getpid()), "shared"])
+
+
+def test_workspace_expands_symlinked_directories(tmp_path):
+    base, path = tmp_path / "base", tmp_path / "workspace"
+    make_repo(base)
+    (base / "alias").symlink_to(base / "pkg")
+    workspace = overlay.Workspace(str(base), str(path), overlay.DirectoryIndex())
+
+    workspace.prepare({"alias/util.py": "y = 1\n"})
+
+    assert (path / "alias" / "util.py").read_text() == "y = 1\n"
+    assert (base / "pkg" / "util.py").read_text() == "y = 0\n"
+    workspace.reset()
+    assert os.readlink(path / "alias" / "util.py") == str(base / "alias" / "util.py")
+
+
+def test_select_backend_prefers_overlayfs_and_never_picks_reflink(tmp_path, monkeypatch):
+    make_repo(tmp_path)
+    monkeypatch.setattr(overlay.ReflinkOverlay, "available", lambda *args: True)
+    monkeypatch.setattr(overlay.KernelOverlay, "available", lambda *args: True)
+
+    assert overlay.select_backend(str(tmp_path)).name == "overlayfs"
+    assert overlay.select_backend(str(tmp_path), workspace_pool=True).name == "symlink"
+    assert overlay.select_backend(str(tmp_path), name="reflink").name == "reflink"
+
+    monkeypatch.setattr(overlay.KernelOverlay, "available", lambda *args: False)
+    assert overlay.select_backend(str(tmp_path)).name == "symlink"
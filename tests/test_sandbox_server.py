@@ -0,0 +1,356 @@
+import concurrent.futures
+import gzip
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("psutil")
+pytest.importorskip("prometheus_client")
+
+import main  # noqa: E402
+import payloads  # noqa: E402
+import tracing  # noqa: E402
+import werkzeug.serving  # noqa: E402
+
+EVALUATOR = "import json\nfrom lib import f\nprint(json.dumps({'score': f()}))\n"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "evaluator.py").write_text(EVALUATOR)
+    (repo / "lib.py").write_text("def f():\n    return 0\n")
+    monkeypatch.setattr(main, "REPO_DIR", str(repo))
+    monkeypatch.chdir(tmp_path)
+    return main.app.test_client()
+
+
+def test_run_code(client):
+    resp = client.post(
+        "/run_code", json={"code": {"lib.py": "def f():\n    return 1\n"}, "timeout": 10}
+    )
+
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == {"score": 1}
+
+
+def test_run_code_batch_streams_every_candidate(client):
+    resp = client.post(
+        "/run_code_batch",
+        json={
+            "timeout": 10,
+            "code": {"lib.py": "def f():\n    return 1\n"},
+            "candidates": [{}, {"code": {"lib.py": "def f():\n    return 2\n"}}, {"timeout": 0}],
+        },
+    )
+
+    lines = sorted((json.loads(line) for line in resp.data.splitlines()), key=lambda r: r["index"])
+    assert [line["status"] for line in lines] == [200, 200, 400]
+    assert json.loads(lines[0]["response"]) == {"score": 1}
+    assert json.loads(lines[1]["response"]) == {"score": 2}
+
+
+def test_run_code_caches_results(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        main, "results", main.result_cache.ResultCache(str(tmp_path / "cache"), 1024)
+    )
+    payload = {"code": {"lib.py": "def f():\n    return 1\n"}, "timeout": 10}
+
+    first = client.post("/run_code", json=payload)
+    second = client.post("/run_code", json=payload)
+    other = client.post("/run_code", json={**payload, "args": [1]})
+
+    assert "X-Cached" not in first.headers
+    assert second.headers["X-Cached"] == "true"
+    assert second.data == first.data
+    assert "X-Cached" not in other.headers
+
+
+def test_run_code_serves_cached_results_without_a_slot(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        main, "results", main.result_cache.ResultCache(str(tmp_path / "cache"), 1024)
+    )
+    slots = main.scheduler.SlotScheduler(slots=1, queue_size=0)
+    monkeypatch.setattr(main, "slot_scheduler", slots)
+    payload = {"code": {"lib.py": "def f():\n    return 1\n"}, "timeout": 10}
+    first = client.post("/run_code", json=payload)
+
+    with slots.slot():
+        cached = client.post("/run_code", json=payload)
+        missed = client.post("/run_code", json={**payload, "args": [1]})
+
+    assert cached.status_code == 200
+    assert cached.headers["X-Cached"] == "true"
+    assert cached.data == first.data
+    assert missed.status_code == 429
+
+
+def test_run_code_does_not_cache_partial_results(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        main, "results", main.result_cache.ResultCache(str(tmp_path / "cache"), 1024)
+    )
+    (tmp_path / "repo" / "partial.py").write_text(
+        "with open('hive_results.jsonl', 'a') as f:\n"
+        "    f.write('{\"score\": 1}\\n')\n"
+        "raise SystemExit(1)\n"
+    )
+    payload = {"code": {}, "timeout": 10, "evaluation_script": "partial.py"}
+
+    first = client.post("/run_code", json=payload)
+    second = client.post("/run_code", json=payload)
+
+    assert json.loads(first.data)["final"] is False
+    assert "X-Cached" not in second.headers
+
+
+def test_result_cache_treats_evicted_entries_as_misses(tmp_path, monkeypatch):
+    cache = main.result_cache.ResultCache(str(tmp_path), 1024)
+    cache.put("key", "result")
+
+    def evicted(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(main.result_cache.os, "utime", evicted)
+    assert cache.get("key") is None
+
+
+def test_spilled_output_is_fetched_once(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(main.common_tools, "OUTPUT_LIMIT", 100)
+    monkeypatch.setattr(main.common_tools, "OUTPUT_SPILL_DIR", str(tmp_path))
+    lib = "for i in range(1000):\n    print(i)\ndef f():\n    return 1\n"
+
+    resp = client.post("/run_code", json={"code": {"lib.py": lib}, "timeout": 10})
+    name = resp.headers["X-Stdout-File"]
+    output = client.get(f"/output/{name}")
+
+    assert resp.headers["X-Output-Truncated"] == "stdout"
+    assert output.data.decode() == "".join(f"{i}\n" for i in range(1000)) + '{"score": 1}\n'
+    assert not (tmp_path / name).exists()
+    assert client.get(f"/output/{name}").status_code == 404
+
+
+def test_run_code_accepts_gzip_and_deltas(client):
+    body = {
+        "code": {"lib.py": {"base": "repo", "edits": [[1, 2, "    return 3\n"]]}},
+        "timeout": 10,
+    }
+    resp = client.post(
+        "/run_code",
+        data=gzip.compress(json.dumps(body).encode()),
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+    )
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == {"score": 3}
+
+    # The resolved content can now serve as the base of other deltas.
+    base = payloads.content_hash("def f():\n    return 3\n")
+    delta = {"base": base, "edits": [[1, 2, "    return 4\n"]]}
+    resp = client.post("/run_code", json={"code": {"lib.py": delta}, "timeout": 10})
+    assert json.loads(resp.data) == {"score": 4}
+
+    unknown = {"base": "0" * 64, "edits": []}
+    resp = client.post("/run_code", json={"code": {"lib.py": unknown}, "timeout": 10})
+    assert resp.status_code == 409
+
+
+def test_run_code_rejects_deltas_against_directories(client, tmp_path):
+    (tmp_path / "repo" / "pkg").mkdir()
+    delta = {"base": "repo", "edits": []}
+
+    resp = client.post("/run_code", json={"code": {"pkg": delta}, "timeout": 10})
+
+    assert resp.status_code == 400
+    assert json.loads(resp.data)["metainfo"] == "pkg is a directory in the repo."
+
+
+def test_run_code_returns_result_channel_records(client, tmp_path):
+    (tmp_path / "repo" / "staged.py").write_text(
+        "import sys, time\n"
+        "for stage in range(2):\n"
+        "    with open('hive_results.jsonl', 'a') as f:\n"
+        "        f.write('{\"score\": %d}\\n' % stage)\n"
+        "if sys.argv[1:] == ['1']:\n"
+        "    time.sleep(10)\n"
+    )
+    payload = {"code": {}, "timeout": 10, "evaluation_script": "staged.py"}
+
+    done = client.post("/run_code", json=payload)
+    hung = client.post("/run_code", json={**payload, "args": [1], "timeout": 1})
+
+    assert json.loads(done.data) == {
+        "output": {"score": 1},
+        "metainfo": "Result",
+        "final": True,
+        "records": 2,
+    }
+    assert hung.status_code == 200
+    assert json.loads(hung.data)["output"] == {"score": 1}
+    assert json.loads(hung.data)["metainfo"] == "Partial: Timeout"
+
+
+def test_run_code_records_are_per_evaluation(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "overlay_backend", main.overlay.SymlinkOverlay())
+    repo_records = tmp_path / "repo" / "hive_results.jsonl"
+    repo_records.write_text('{"score": -1}\n')
+    (tmp_path / "repo" / "staged.py").write_text(
+        "with open('hive_results.jsonl', 'a') as f:\n    f.write('{\"score\": 1}\\n')\n"
+    )
+
+    resp = client.post(
+        "/run_code", json={"code": {}, "timeout": 10, "evaluation_script": "staged.py"}
+    )
+
+    assert json.loads(resp.data)["records"] == 1
+    assert repo_records.read_text() == '{"score": -1}\n'
+
+
+def test_run_code_records_can_be_polled(client, tmp_path):
+    (tmp_path / "repo" / "staged.py").write_text(
+        "import time\n"
+        "with open('hive_results.jsonl', 'a') as f:\n    f.write('{\"score\": 1}\\n')\n"
+        "time.sleep(30)\n"
+    )
+    payload = {"code": {}, "timeout": 30, "evaluation_script": "staged.py"}
+    pool = concurrent.futures.ThreadPoolExecutor(1)
+    future = pool.submit(client.post, "/run_code", json=payload, headers={"X-Evaluation-Id": "e1"})
+
+    start = time.monotonic()
+    while True:
+        resp = client.get("/run_code/e1/records")
+        if resp.status_code == 200 and json.loads(resp.data)["records"] == [[{"score": 1}]]:
+            break
+        assert time.monotonic() - start < 10
+        time.sleep(0.05)
+    client.delete("/run_code/e1")
+    future.result(timeout=10)
+
+    assert client.get("/run_code/e1/records").status_code == 404
+
+
+def test_run_code_is_cancelled_when_the_client_disconnects(client, tmp_path, monkeypatch):
+    (tmp_path / "repo" / "hang.py").write_text("import time\ntime.sleep(30)\n")
+    stage = main.metrics.stage
+
+    def slow_decode(name):
+        # Lets the disconnect watcher see the body if it was not read first.
+        if name == "decode":
+            time.sleep(2 * main.evaluations.DISCONNECT_CHECK_INTERVAL)
+        return stage(name)
+
+    monkeypatch.setattr(main.metrics, "stage", slow_decode)
+    body = json.dumps(
+        {"code": {"pad.py": "#" * 256 * 1024}, "timeout": 30, "evaluation_script": "hang.py"}
+    ).encode()
+    server = werkzeug.serving.make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        sock = socket.create_connection(("127.0.0.1", server.port))
+        sock.sendall(
+            b"POST /run_code HTTP/1.1\r\nHost: localhost\r\nX-Evaluation-Id: e1\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+        )
+        start = time.monotonic()
+        while not any(c.work_dir for c in main.in_flight.get("e1")):
+            assert time.monotonic() - start < 10
+            time.sleep(0.05)
+        sock.close()
+
+        while main.in_flight.get("e1"):
+            assert time.monotonic() - start < 10
+            time.sleep(0.05)
+    finally:
+        server.shutdown()
+
+
+def test_run_code_can_be_cancelled(client, tmp_path):
+    (tmp_path / "repo" / "hang.py").write_text("import time\ntime.sleep(30)\n")
+    payload = {"code": {}, "timeout": 30, "evaluation_script": "hang.py"}
+    pool = concurrent.futures.ThreadPoolExecutor(1)
+    future = pool.submit(client.post, "/run_code", json=payload, headers={"X-Evaluation-Id": "e1"})
+
+    start = time.monotonic()
+    while client.delete("/run_code/e1").status_code == 404:
+        assert time.monotonic() - start < 10
+        time.sleep(0.05)
+    resp = future.result(timeout=10)
+
+    assert resp.status_code == 409
+    assert resp.headers["X-Evaluation-Id"] == "e1"
+    assert client.delete("/run_code/e1").status_code == 404
+
+
+def test_metrics_count_evaluations_and_stages(client):
+    client.post("/run_code", json={"code": {}, "timeout": 10})
+    client.post("/run_code", json={"code": {}, "timeout": 0})
+
+    metrics = client.get("/metrics").data.decode()
+
+    assert 'sandbox_evaluations_total{outcome="success"}' in metrics
+    assert 'sandbox_process_failures_total{reason="timeout"}' in metrics
+    assert 'sandbox_stage_seconds_count{stage="overlay"}' in metrics
+    assert 'sandbox_stage_seconds_count{stage="run"}' in metrics
+
+
+def test_run_code_traces_stages(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "exporter", tracing.FileExporter(str(tmp_path / "traces.jsonl")))
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+    resp = client.post(
+        "/run_code",
+        json={"code": {}, "timeout": 10},
+        headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"},
+    )
+
+    spans = [json.loads(line) for line in (tmp_path / "traces.jsonl").read_text().splitlines()]
+    assert resp.headers["X-Trace-Id"] == trace_id
+    assert {span["trace_id"] for span in spans} == {trace_id}
+    assert {span["name"] for span in spans} == {
+        "/run_code",
+        "execute_python_function",
+        "overlay",
+        "run_command",
+    }
+
+
+def test_ready_waits_for_warmup(client, monkeypatch):
+    monkeypatch.setattr(main, "sandbox_warmup", main.warmup.Warmup([]))
+
+    assert client.get("/ready").status_code == 503
+    main.sandbox_warmup.run()
+    assert client.get("/ready").status_code == 200
+
+
+def test_run_code_reuses_workspaces(client, tmp_path, monkeypatch):
+    pool = main.overlay.WorkspacePool(str(tmp_path / "repo"), str(tmp_path / "ws"), 1)
+    monkeypatch.setattr(main, "workspaces", pool)
+    (tmp_path / "repo" / "cwd.py").write_text(
+        "import json, os\nfrom lib import f\nprint(json.dumps([os.getcwd(), f()]))\n"
+    )
+    payload = {"timeout": 10, "evaluation_script": "cwd.py"}
+
+    first = client.post(
+        "/run_code", json={**payload, "code": {"lib.py": "def f():\n    return 1\n"}}
+    )
+    start = time.monotonic()
+    while pool.idle < 1:  # Reset in the background
+        assert time.monotonic() - start < 10
+        time.sleep(0.01)
+    second = client.post("/run_code", json={**payload, "code": {}})
+
+    workspace = str(tmp_path / "ws" / "workspace-1")
+    assert json.loads(first.data) == [workspace, 1]
+    assert json.loads(second.data) == [workspace, 0]
+    assert os.listdir(tmp_path / "ws") == ["workspace-1"]
+
+
+def test_run_code_rejects_non_object_bodies(client):
+    assert client.post("/run_code", json=[1, 2]).status_code == 400
+    assert client.post("/run_code_batch", json={"candidates": [1]}).status_code == 400
+    assert client.post("/run_code_batch", json={"candidates": [], "code": "x"}).status_code == 400
@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+import scheduler
+
+
+def test_rejects_when_queue_is_full():
+    slots = scheduler.SlotScheduler(slots=1, queue_size=0)
+
+    with slots.slot():
+        with pytest.raises(scheduler.QueueFullError):
+            with slots.slot():
+                pass
+
+    with slots.slot():
+        assert slots.running == 1
+
+
+def test_queued_request_times_out():
+    slots = scheduler.SlotScheduler(slots=1, queue_size=1)
+
+    with slots.slot():
+        with pytest.raises(scheduler.SlotTimeoutError):
+            with slots.slot(timeout=0.05):
+                pass
+        assert slots.waiting == 0
+
+
+def test_queued_request_runs_when_slot_frees():
+    slots = scheduler.SlotScheduler(slots=1, queue_size=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def hold_slot():
+        with slots.slot():
+            started.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold_slot)
+    holder.start()
+    started.wait()
+    threading.Timer(0.05, release.set).start()
+
+    with slots.slot(timeout=5):
+        assert slots.running == 1
+    holder.join()
@@ -0,0 +1,76 @@
+import concurrent.futures
+
+import pytest
+
+pytest.importorskip("psutil")
+warmup = pytest.importorskip("warmup")
+
+SCRIPT = "import pathlib\npathlib.Path('{data}/out.txt').write_text('prepared')\n"
+
+
+def test_preprocess_reuses_marked_and_cached_outputs(tmp_path):
+    script = SCRIPT.format(data=tmp_path / "data")
+    key = warmup.preprocessor_key(script, "abc")
+    cache = str(tmp_path / "cache")
+
+    assert warmup.preprocess(script, str(tmp_path), str(tmp_path / "data"), key, cache) == "run"
+    assert warmup.preprocess(script, str(tmp_path), str(tmp_path / "data"), key, cache) == "marker"
+
+    # A restarted pod with an empty data directory restores the cached outputs.
+    fresh = tmp_path / "fresh"
+    assert warmup.preprocess(script, str(tmp_path), str(fresh), key, cache) == "cache"
+    assert (fresh / "out.txt").read_text() == "prepared"
+
+
+def test_preprocess_runs_once_per_data_dir(tmp_path):
+    script = (
+        "import pathlib, time\n"
+        "with open('{data}/runs.txt', 'a') as f:\n    f.write('run\\n')\n"
+        "time.sleep(0.5)\n"
+    ).format(data=tmp_path / "data")
+    key = warmup.preprocessor_key(script, "abc")
+
+    with concurrent.futures.ThreadPoolExecutor(3) as pool:
+        sources = list(
+            pool.map(
+                lambda _: warmup.preprocess(script, str(tmp_path), str(tmp_path / "data"), key),
+                range(3),
+            )
+        )
+
+    assert sorted(sources) == ["marker", "marker", "run"]
+    assert (tmp_path / "data" / "runs.txt").read_text() == "run\n"
+
+
+def test_warmup_fails_on_required_steps_only():
+    def fail():
+        raise RuntimeError("boom")
+
+    optional = warmup.Warmup([("compile", fail, False)])
+    optional.run()
+    required = warmup.Warmup([("preprocess", fail, True), ("compile", lambda: None, False)])
+    required.run()
+
+    assert optional.ready
+    assert not required.ready
+    assert required.status() == {"status": "failed", "steps": {}, "error": "preprocess: boom"}
+
+
+def test_compile_repo_writes_hash_based_bytecode(tmp_path):
+    (tmp_path / "lib.py").write_text("X = 1\n")
+
+    warmup.compile_repo(str(tmp_path))
+
+    (pyc,) = (tmp_path / "__pycache__").iterdir()
+    # Flags of the pyc header (PEP 552): hash-based and checked.
+    assert int.from_bytes(pyc.read_bytes()[4:8], "little") == 0b11
+
+
+def test_compile_repo_skips_current_bytecode(tmp_path):
+    (tmp_path / "lib.py").write_text("X = 1\n")
+    (tmp_path / "other.py").write_text("Y = 1\n")
+
+    assert warmup.compile_repo(str(tmp_path)) == 2
+    assert warmup.compile_repo(str(tmp_path)) == 0
+    (tmp_path / "lib.py").write_text("X = 2\n")
+    assert warmup.compile_repo(str(tmp_path)) == 1
@@ -0,0 +1,97 @@
+import concurrent.futures
+import shutil
+import time
+
+import pytest
+
+common_tools = pytest.importorskip("common_tools")
+worker_pool = pytest.importorskip("worker_pool")
+
+
+@pytest.fixture(scope="module")
+def pool():
+    return worker_pool.WorkerPool(1)
+
+
+def test_run_script_returns_stdout(pool, tmp_path):
+    (tmp_path / "evaluator.py").write_text("import sys\nprint(sys.argv[1:])\n")
+
+    assert pool.run_script(["evaluator.py", "a"], str(tmp_path)) == "['a']\n"
+
+
+def test_run_script_matches_run_command_errors(pool, tmp_path):
+    (tmp_path / "evaluator.py").write_text("import time\ntime.sleep(5)\n")
+
+    with pytest.raises(common_tools.FunctionExecutionError, match="Timeout"):
+        pool.run_script(["evaluator.py"], str(tmp_path), timeout=0.5)
+
+    (tmp_path / "evaluator.py").write_text("import sys\nsys.exit('failed')\n")
+
+    with pytest.raises(common_tools.FunctionExecutionError, match="failed"):
+        pool.run_script(["evaluator.py"], str(tmp_path), memory_limit=1024)
+
+
+def test_in_process_pool_swaps_evolved_modules(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "lib.py").write_text("def f():\n    return 0\n")
+    (repo / "helper.py").write_text("from lib import f\n\ndef g():\n    return f()\n")
+    (repo / "untouched.py").write_text("import os\nPID = os.getpid()\n")
+    overlay = tmp_path / "overlay"
+    shutil.copytree(repo, overlay)
+    (overlay / "lib.py").write_text("def f():\n    return 1\n")
+    (overlay / "evaluator.py").write_text(
+        "import os, helper, untouched\nprint(helper.g(), untouched.PID != os.getpid())\n"
+    )
+
+    pool = worker_pool.WorkerPool(1, ["lib", "helper", "untouched"], repo_dir=str(repo))
+
+    # `helper` refers to the evolved `lib` and is reloaded, `untouched` is reused.
+    output = pool.run_script(["evaluator.py"], str(overlay), evolved=["lib.py"])
+    assert output == "1 True\n"
+
+
+def test_in_process_pool_reimports_packages_of_evolved_modules(tmp_path):
+    repo = tmp_path / "repo"
+    (repo / "pkg").mkdir(parents=True)
+    (repo / "pkg" / "__init__.py").write_text("")
+    (repo / "pkg" / "lib.py").write_text("VALUE = 0\n")
+    overlay = tmp_path / "overlay"
+    shutil.copytree(repo, overlay)
+    (overlay / "pkg" / "lib.py").write_text("VALUE = 1\n")
+    (overlay / "evaluator.py").write_text("from pkg import lib\nprint(lib.VALUE)\n")
+
+    # `pkg.lib` itself was never imported in the fork server.
+    pool = worker_pool.WorkerPool(1, ["pkg"], repo_dir=str(repo))
+
+    assert pool.run_script(["evaluator.py"], str(overlay), evolved=["pkg/lib.py"]) == "1\n"
+
+
+def test_run_script_path_matches_a_fresh_interpreter(pool, tmp_path):
+    (tmp_path / "evaluator.py").write_text(
+        "import importlib.util, sys\n"
+        "print(sys.path[0], [importlib.util.find_spec(m) for m in ('scheduler', 'memory_limits')])\n"
+    )
+
+    assert pool.run_script(["evaluator.py"], str(tmp_path)) == f"{tmp_path} [None, None]\n"
+
+
+def test_run_script_waits_for_a_server_within_the_timeout(tmp_path):
+    (tmp_path / "hang.py").write_text("import time\ntime.sleep(5)\n")
+    pool = worker_pool.WorkerPool(1)
+    busy = concurrent.futures.ThreadPoolExecutor(1).submit(
+        pool.run_script, ["hang.py"], str(tmp_path), timeout=3
+    )
+    time.sleep(0.5)
+
+    start = time.monotonic()
+    with pytest.raises(worker_pool.PoolTimeoutError):
+        pool.run_script(["hang.py"], str(tmp_path), timeout=0.5)
+    assert time.monotonic() - start < 1.5
+
+    cancellation = common_tools.Cancellation()
+    cancellation.cancel()
+    with pytest.raises(common_tools.EvaluationCancelledError):
+        pool.run_script(["hang.py"], str(tmp_path), timeout=5, cancellation=cancellation)
+    with pytest.raises(common_tools.ExecutionTimeoutError):
+        busy.result()